@@ -70,7 +70,10 @@ class ProjectsClient(BaseClient):
         url = (
             f"/projects/{self.projectid}"
             f"/_upload?runtime={zfile.runtime_name}&version={zfile.version}"
+            f"&format={zfile.format_type}"
         )
+        if zfile.digest:
+            url = f"{url}&digest={zfile.digest}"
 
         r = self._http.post(
             url,
@@ -79,12 +82,43 @@ class ProjectsClient(BaseClient):
         if r.status_code != 201 and r.status_code != 204:
             raise ProjectUploadError(self.projectid)
 
-    def projects_build(self, spec: types.RuntimeSpec, version: str) -> Union[str, None]:
-        rsp = self._http.post(
-            f"/projects/{self.projectid}/_build?version={version}", json=spec.dict()
+    def projects_bundle_exists(
+        self, digest: str, fmt: str = defaults.BUNDLE_FORMAT
+    ) -> bool:
+        r = self._http.head(
+            f"/projects/{self.projectid}/_bundles/{digest}?format={fmt}"
         )
-        if rsp.status_code == 202:
-            return rsp.json()["execid"]
+        return r.status_code == 200
+
+    def projects_bundle_link(
+        self,
+        manifest: types.runtimes.BundleManifest,
+        fmt: str = defaults.BUNDLE_FORMAT,
+    ) -> bool:
+        """Use a bundle already uploaded with the same digest and format
+        for the runtime and version of the manifest"""
+        r = self._http.post(
+            f"/projects/{self.projectid}/_bundles/{manifest.digest}"
+            f"?runtime={manifest.runtime_name}&version={manifest.version}"
+            f"&format={fmt}"
+        )
+        return r.status_code == 201
+
+    def projects_build(
+        self,
+        spec: types.RuntimeSpec,
+        version: str,
+        fmt: str = defaults.BUNDLE_FORMAT,
+        digest: Optional[str] = None,
+    ) -> Union[types.runtimes.BuildCtx, None]:
+        """If ctx.enqueued is False, the runtime was already built
+        from a bundle with the same digest"""
+        url = f"/projects/{self.projectid}/_build?version={version}&format={fmt}"
+        if digest:
+            url = f"{url}&digest={digest}"
+        rsp = self._http.post(url, json=spec.dict())
+        if rsp.status_code == 202 or rsp.status_code == 200:
+            return types.runtimes.BuildCtx(**rsp.json())
         return None
 
     def projects_create_agent(self) -> Union[str, None]:
@@ -164,6 +198,12 @@ class ProjectsClient(BaseClient):
         runtimes = [types.RuntimeData(**dict_) for dict_ in data.json()]
         return runtimes
 
+    def runtime_by_build_key(self, build_key: str) -> Union[types.RuntimeData, None]:
+        rsp = self._http.get(f"/runtimes/{self.projectid}/_build_keys/{build_key}")
+        if rsp.status_code == 200:
+            return types.RuntimeData(**rsp.json())
+        return None
+
     def runtime_create(self, req: types.RuntimeReq):
 
         rsp = self._http.post(f"/runtimes/{self.projectid}", json=req.dict())
@@ -5,6 +5,7 @@ import sys
 import click
 from rich.logging import RichHandler
 
+from labfunctions import defaults
 from labfunctions.conf.server_settings import settings
 
 # from labfunctions.control_plane import rqscheduler
@@ -56,8 +57,36 @@ def agentcli():
     default=False,
     help="Debug log",
 )
+@click.option(
+    "--prepull-workers",
+    "-P",
+    default=defaults.AGENT_PREPULL_WORKERS,
+    help="Images of new runtimes pulled at the same time, 0 to disable it",
+)
+@click.option(
+    "--images-watermark",
+    default=defaults.AGENT_IMAGES_HIGH_WATERMARK,
+    help="Disk usage (0-1) where old runtime images are removed, 1 to disable it",
+)
+@click.option(
+    "--images-low-watermark",
+    default=defaults.AGENT_IMAGES_LOW_WATERMARK,
+    help="Disk usage (0-1) where the removal of images stops",
+)
 @click.option("--machine-id", "-m", default=f"localhost/ba/{hostname}")
-def runcli(redis, workers, qnames, cluster, ip_address, agent_name, machine_id, debug):
+def runcli(
+    redis,
+    workers,
+    qnames,
+    cluster,
+    ip_address,
+    agent_name,
+    machine_id,
+    debug,
+    prepull_workers,
+    images_watermark,
+    images_low_watermark,
+):
     """Run the agent"""
     # pylint: disable=import-outside-toplevel
     # from labfunctions.control_plane import agent
@@ -88,6 +117,12 @@ def runcli(redis, workers, qnames, cluster, ip_address, agent_name, machine_id,
         heartbeat_check_every=settings.AGENT_HEARTBEAT_CHECK,
         agent_name=agent_name,
         workers_n=workers,
+        prepull_workers=prepull_workers,
+        images_high_watermark=images_watermark,
+        images_low_watermark=images_low_watermark,
+        warm_pool_size=settings.AGENT_WARM_POOL_SIZE,
+        warm_max_reuse=settings.AGENT_WARM_MAX_REUSE,
+        warm_max_age=settings.AGENT_WARM_MAX_AGE,
     )
 
     agent.run(conf)
@@ -86,6 +86,21 @@ def local(from_file, url_service, local, wfid):
         console.print(f"=>[bold green] WFID: {rsp.wfid} locally executed[/]")
 
 
+@executorscli.command()
+@click.option(
+    "--max-runs",
+    default=defaults.AGENT_WARM_MAX_REUSE,
+    help="Executions before exiting",
+)
+def warm(max_runs):
+    """Used by the agents to keep warm containers, it runs the executions
+    received in stdin"""
+    # pylint: disable=import-outside-toplevel
+    from labfunctions.executors.warm_pool import warm_loop
+
+    warm_loop(max_runs)
+
+
 # @executorscli.command()
 # @click.option(
 #     "--from-file",
@@ -201,6 +201,33 @@ def agent(sql, scopes, username, action, admin, exp):
             console.print(f"=> [magenta]{ag}[/]")
 
 
+@managercli.command(name="kv-decompress")
+@click.option("--prefix", "-p", default="", help="Only keys under this prefix")
+@click.option(
+    "--before",
+    "-b",
+    default=None,
+    type=float,
+    help="Only keys modified before this unix time, like the time of the upgrade",
+)
+def kv_decompress(prefix, before):
+    """Decompress the .gz and .bz2 values of the projects store written by
+    older versions, it should run once after upgrading"""
+    # pylint: disable=import-outside-toplevel
+    from labfunctions.io.kvspec import GenericKVSpec, decompress_legacy
+
+    # the underlying store, legacy values are never behind the cas refs
+    kv = GenericKVSpec.create(
+        settings.PROJECTS_STORE_CLASS_SYNC,
+        settings.PROJECTS_STORE_BUCKET,
+        dict(settings.PROJECTS_STORE_OPTS),
+    )
+    rewritten = decompress_legacy(kv, prefix=prefix, before=before)
+    for key in rewritten:
+        console.print(f"=> [magenta]{key}[/]")
+    console.print(f"[bold green]{len(rewritten)} values decompressed[/]")
+
+
 @managercli.command()
 def shell():
     """starts a IPython REPL console with db objects and models"""
@@ -30,6 +30,20 @@ def runtimescli():
     """
 
 
+def _send_build(c, spec, version: str, watch: bool, fmt: str, digest=None):
+    ctx = c.projects_build(spec, version, fmt, digest)
+    if not ctx:
+        console.print("[bold red](x) Error sending build task [/]")
+        sys.exit(-1)
+    if not ctx.enqueued:
+        console.print(f"=> Runtime already built from this bundle: {ctx.reuse}")
+        return
+
+    console.print(f"=> Build task sent with execid: [bold magenta]{ctx.execid}[/]")
+    if watch:
+        watcher(c, ctx.execid, stats=False)
+
+
 @runtimescli.command()
 @click.option(
     "--from-file",
@@ -84,6 +98,14 @@ def runtimescli():
     default=False,
     help="Build runtime locally",
 )
+@click.option(
+    "--format",
+    "-F",
+    "fmt",
+    type=click.Choice(defaults.BUNDLE_FORMATS),
+    default=defaults.BUNDLE_FORMAT,
+    help="Format of the bundle, tar bundles are extracted while they are downloaded",
+)
 @click.option(
     "--requirements",
     "-r",
@@ -102,6 +124,7 @@ def build(
     watch,
     name,
     local,
+    fmt,
     requirements,
 ):
     """Freeze and build a runtime for your project into the server"""
@@ -122,9 +145,22 @@ def build(
         console.print(f"[red bold](x) Runtime {name} doesn't exists[/]")
         sys.exit(-1)
 
+    try:
+        manifest = runtimes.bundle_manifest(spec, pv, stash, current)
+    except AttributeError:
+        manifest = None
+    remote = not only_bundle and not local
+    if remote and manifest and c.projects_bundle_exists(manifest.digest, fmt):
+        if c.projects_bundle_link(manifest, fmt):
+            console.print("=> Bundle unchanged, the uploaded one will be used")
+            _send_build(c, spec, manifest.version, watch, fmt, manifest.digest)
+            return
+
     console.print(f"=> Bundling runtime [bold magenta]{name}[/]")
     try:
-        zfile = runtimes.bundle_project(c.working_area, spec, pv, stash, current)
+        zfile = runtimes.bundle_project(
+            c.working_area, spec, pv, stash, current, manifest=manifest, fmt=fmt
+        )
     except KeyError:
         console.print(
             f"[red bold](x) requirements file missing "
@@ -149,14 +185,7 @@ def build(
         try:
             c.projects_upload(zfile)
             console.print("[bold green]=> Succesfully uploaded file[/]")
-            execid = c.projects_build(spec, zfile.version)
-            if not execid:
-                console.print("[bold red](x) Error sending build task [/]")
-                sys.exit(-1)
-
-            console.print(f"=> Build task sent with execid: [bold magenta]{execid}[/]")
-            if watch:
-                watcher(c, execid, stats=False)
+            _send_build(c, spec, zfile.version, watch, fmt, zfile.digest)
         except ProjectUploadError:
             console.print("[bold red](x) Error uploading file[/]")
     elif local:
@@ -172,8 +201,9 @@ def build(
             zfile.version,
             PROJECTS_STORE_CLASS,
             PROJECTS_STORE_BUCKET,
+            bundle_format=fmt,
         )
-        kv.put_stream(ctx.download_zip, kv.from_file_gen(zfile.filepath))
+        kv.put_file(ctx.download_zip, zfile.filepath)
         with progress:
             task = progress.add_task(
                 f" Building docker image for {name}", start=False, total=1
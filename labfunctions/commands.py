@@ -4,6 +4,7 @@ import os
 import shlex
 import subprocess
 import sys
+import time
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Union
 
@@ -64,18 +65,21 @@ def shell(
     return proc
 
 
-def docker_low_build(path, dockerfile, tag, rm=False) -> DockerBuildLowLog:
+def docker_low_build(path, dockerfile, tag, rm=False, target=None) -> DockerBuildLowLog:
     """It uses the low API of python sdk.
     :param path: path to the Dockerfile
     :param dockerfile: name of the Dockerfile
     :param tag: fullname of the dokcer image to build
     :param rm: remove intermediate build images
+    :param target: stage of the Dockerfile to build
     """
 
     # obj = _open_dockerfile(dockerfile)
     # build(fileobj=obj...
     _client = docker.APIClient(base_url="unix://var/run/docker.sock")
-    generator = _client.build(path=path, dockerfile=dockerfile, tag=tag, rm=rm)
+    generator = _client.build(
+        path=path, dockerfile=dockerfile, tag=tag, rm=rm, target=target
+    )
     error = False
     log_messages = ""
     while True:
@@ -173,7 +177,14 @@ class DockerCommand:
         return DockerRunResult(msg=logs, status=status_code)
 
     def build(
-        self, path: str, dockerfile: str, tag: str, version: str, rm=False, push=False
+        self,
+        path: str,
+        dockerfile: str,
+        tag: str,
+        version: str,
+        rm=False,
+        push=False,
+        target=None,
     ) -> DockerBuildLog:
         """Build docker
         :param path: path to the Dockerfile
@@ -181,13 +192,14 @@ class DockerCommand:
         :param tag: fullname of the dokcer image to build
         :param rm: remove intermediate build images
         :param push: Push docker image to a repository
+        :param target: stage of the Dockerfile to build
         """
 
         error = False
         error_build = False
         error_push = False
 
-        build_log = docker_low_build(path, dockerfile, tag, rm)
+        build_log = docker_low_build(path, dockerfile, tag, rm, target=target)
         if not build_log.error:
             img = self.docker.images.get(tag)
             img.tag(tag, tag=version)
@@ -205,6 +217,88 @@ class DockerCommand:
 
         return DockerBuildLog(build_log=build_log, push_log=push_log, error=error)
 
+    def ensure_image(self, image: str) -> Union[float, None]:
+        """Pull the image if it isn't local. It returns the seconds
+        spent pulling it, None if it wasn't needed or the pull failed"""
+        try:
+            self.docker.images.get(image)
+            return None
+        except docker.errors.ImageNotFound:
+            pass
+        except docker.errors.APIError as e:
+            log.error_logger.error(str(e))
+            return None
+        started = time.time()
+        try:
+            self.docker.images.pull(image)
+        except docker.errors.APIError as e:
+            log.error_logger.error(str(e))
+            return None
+        return round(time.time() - started, 2)
+
+    def remove_image(self, image: str) -> bool:
+        """It returns False if the image is in use or it failed"""
+        try:
+            self.docker.images.remove(image)
+        except docker.errors.ImageNotFound:
+            pass
+        except docker.errors.APIError as e:
+            log.error_logger.error(str(e))
+            return False
+        return True
+
+    def root_dir(self) -> str:
+        """Where docker stores the images, "/" if it isn't visible
+        from here, like when the agent itself runs in a container"""
+        try:
+            root = self.docker.info().get("DockerRootDir", "/")
+        except docker.errors.APIError:
+            root = "/"
+        if not os.path.isdir(root):
+            root = "/"
+        return root
+
+    def image_exists(self, tag: str, pull=False) -> bool:
+        """If the image is local, or it could be pulled from its registry"""
+        try:
+            self.docker.images.get(tag)
+            return True
+        except docker.errors.ImageNotFound:
+            pass
+        if not pull:
+            return False
+        try:
+            self.docker.images.pull(tag)
+        except docker.errors.APIError:
+            return False
+        return True
+
+    def retag(self, src: str, tag: str, version: str, push=False) -> DockerBuildLog:
+        """Tag an image already built, pulling it if it isn't local.
+        :param src: full name of the image, with its version
+        :param tag: fullname of the docker image, without the version
+        """
+        try:
+            try:
+                img = self.docker.images.get(src)
+            except docker.errors.ImageNotFound:
+                img = self.docker.images.pull(src)
+            img.tag(tag, tag=version)
+        except docker.errors.APIError as e:
+            log.error_logger.error(str(e))
+            build_log = DockerBuildLowLog(logs=str(e), error=True)
+            return DockerBuildLog(build_log=build_log, error=True)
+
+        build_log = DockerBuildLowLog(
+            logs=f"{src} tagged as {tag}:{version}", error=False
+        )
+        push_log = None
+        if push:
+            push_log = self.push_image(f"{tag}:{version}")
+
+        error = push_log.error if push_log else False
+        return DockerBuildLog(build_log=build_log, push_log=push_log, error=error)
+
     def push_image(self, tag) -> DockerPushLog:
         """
         Push to docker registry
@@ -5,6 +5,7 @@ from typing import Any, Dict, List, Optional
 
 from labfunctions import defaults, errors
 from labfunctions.executors.execid import ExecID
+from labfunctions.runtimes.context import runtime_image
 from labfunctions.types import ExecutionNBTask, ExecutionResult, NBTask
 from labfunctions.types.runtimes import RuntimeData
 from labfunctions.utils import get_version, today_string
@@ -32,9 +33,7 @@ def prepare_runtime(runtime: Optional[RuntimeData] = None) -> str:
         version = get_version()
         _runtime = f"{defaults.DOCKERFILE_IMAGE}:{version}"
     else:
-        _runtime = f"{runtime.docker_name}:{runtime.version}"
-        if runtime.registry:
-            _runtime = f"{runtime.registry}/{runtime}"
+        _runtime = runtime_image(runtime)
     return _runtime
 
 
@@ -88,4 +87,6 @@ def create_notebook_ctx(
         created_at=_now,
         notifications_ok=task.notifications_ok,
         notifications_fail=task.notifications_fail,
+        compiled=task.compiled,
+        compiled_output=task.compiled_output,
     )
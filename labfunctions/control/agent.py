@@ -11,6 +11,9 @@ from libq.scheduler import Scheduler
 # from .worker import start_worker
 from libq.worker import AsyncWorker
 
+from labfunctions.commands import DockerCommand
+from labfunctions.control.images import ImageCollector, ImagePuller
+from labfunctions.executors.warm_pool import WarmPool
 from labfunctions.hashes import generate_random
 from labfunctions.redis_conn import create_pool
 from labfunctions.types import ServerSettings
@@ -66,5 +69,26 @@ def run(conf: AgentConfig):
         metadata=node.dict(),
         max_jobs=conf.workers_n,
     )
+    if conf.prepull_workers > 0:
+        puller = ImagePuller(conf.redis_dsn, conf.cluster, workers=conf.prepull_workers)
+        puller.start()
+    warm_pool = None
+    if conf.warm_pool_size > 0:
+        warm_pool = WarmPool(
+            DockerCommand(),
+            size=conf.warm_pool_size,
+            max_reuse=conf.warm_max_reuse,
+            max_age=conf.warm_max_age,
+        )
+        warm_pool.start_refill()
+    if conf.images_high_watermark < 1:
+        collector = ImageCollector(
+            conf.redis_dsn,
+            cluster_queues,
+            high_watermark=conf.images_high_watermark,
+            low_watermark=conf.images_low_watermark,
+            warm_pool=warm_pool,
+        )
+        collector.start()
 
     worker.run()
@@ -0,0 +1,291 @@
+"""
+Docker images of the runtimes in the agents.
+
+When a runtime is registered the server publishes it in the channels of
+the clusters of its spec (see :func:`publish_runtime`), and the agents of
+those clusters pull the image in background (:class:`ImagePuller`), so the
+first execution doesn't wait for it. Messages published while an agent is
+down are lost, executions still pull missing images before starting.
+
+Each use of an image is recorded by :func:`mark_used`, as the mtime of a
+file in AGENT_IMAGES_DIR. When the disk usage goes over the high watermark,
+:class:`ImageCollector` removes the least recently used images until it's
+below the low watermark. Only images recorded are removed, and never the
+ones needed by the jobs waiting in the queues of the agent. With a warm
+pool it drains the pool of an image before removing it (see
+:class:`labfunctions.executors.warm_pool.WarmPool`).
+"""
+import asyncio
+import hashlib
+import logging
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+import orjson
+from libq.types import Prefixes
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from labfunctions import defaults
+from labfunctions.commands import DockerCommand
+from labfunctions.executors.warm_pool import WarmPool
+from labfunctions.redis_conn import create_pool
+from labfunctions.runtimes.context import runtime_image
+from labfunctions.types.runtimes import RuntimeData
+from labfunctions.utils import mkdir_p
+
+logger = logging.getLogger(__name__)
+
+
+def _marker(image: str, state_dir: str) -> Path:
+    return Path(state_dir) / hashlib.sha1(image.encode()).hexdigest()
+
+
+def mark_used(image: str, state_dir: str = defaults.AGENT_IMAGES_DIR):
+    """Record the use of an image, processes running executions and the
+    collector share only the state_dir"""
+    mkdir_p(state_dir)
+    fp = _marker(image, state_dir)
+    if not fp.exists():
+        fp.write_text(image)
+    fp.touch()
+
+
+def images_used(state_dir: str = defaults.AGENT_IMAGES_DIR) -> List[Tuple[float, str]]:
+    """Images recorded with the time of their last use, oldest first"""
+    used = []
+    for fp in Path(state_dir).glob("*"):
+        try:
+            used.append((fp.stat().st_mtime, fp.read_text()))
+        except FileNotFoundError:
+            continue
+    return sorted(used)
+
+
+def disk_usage(path: str) -> float:
+    usage = shutil.disk_usage(path)
+    return usage.used / usage.total
+
+
+def runtimes_channels(clusters: Optional[List[str]]) -> List[str]:
+    if not clusters:
+        return [f"{defaults.RUNTIMES_CHANNEL}{defaults.RUNTIMES_CHANNEL_ALL}"]
+    return [f"{defaults.RUNTIMES_CHANNEL}{c}" for c in clusters]
+
+
+async def publish_runtime(redis: Redis, rd: RuntimeData) -> int:
+    """It returns how many agents received it"""
+    received = 0
+    for channel in runtimes_channels(rd.spec.clusters):
+        received += await redis.publish(channel, rd.json())
+    return received
+
+
+class ImagePuller:
+    """
+    It listens the runtimes registered for a cluster and pulls their
+    images, at most `workers` at the same time. The time of the last
+    AGENT_PREPULL_HISTORY pulls is kept in `pulls` (image -> seconds) and
+    logged. If the connection to redis fails it subscribes again, waiting
+    longer after each failure.
+    """
+
+    def __init__(
+        self,
+        redis_dsn: str,
+        cluster: str,
+        *,
+        workers: int = defaults.AGENT_PREPULL_WORKERS,
+        state_dir: str = defaults.AGENT_IMAGES_DIR,
+        docker_cmd: Optional[DockerCommand] = None,
+    ):
+        self.redis_dsn = redis_dsn
+        self.state_dir = state_dir
+        self.channels = runtimes_channels([cluster]) + runtimes_channels(None)
+        self.pulls: "OrderedDict[str, float]" = OrderedDict()
+        self._cmd = docker_cmd
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pulling: Set[str] = set()
+        self._lock = threading.Lock()
+        self._backoff = 1
+
+    @property
+    def cmd(self) -> DockerCommand:
+        if not self._cmd:
+            self._cmd = DockerCommand()
+        return self._cmd
+
+    def pull(self, image: str) -> Optional[float]:
+        """Pull the image if it isn't local, a pull of the same image
+        already running is not repeated"""
+        with self._lock:
+            if image in self._pulling:
+                return None
+            self._pulling.add(image)
+        try:
+            secs = self.cmd.ensure_image(image)
+            mark_used(image, self.state_dir)
+            if secs is not None:
+                logger.info("Image %s pre-pulled in %.2f secs", image, secs)
+                with self._lock:
+                    self.pulls.pop(image, None)
+                    self.pulls[image] = secs
+                    while len(self.pulls) > defaults.AGENT_PREPULL_HISTORY:
+                        self.pulls.popitem(last=False)
+            return secs
+        finally:
+            with self._lock:
+                self._pulling.discard(image)
+
+    def submit(self, rd: RuntimeData):
+        self._executor.submit(self.pull, runtime_image(rd))
+
+    async def _subscribe(self):
+        redis = create_pool(self.redis_dsn)
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(*self.channels)
+            logger.info("Listening runtimes in %s", ", ".join(self.channels))
+            self._backoff = 1
+            async for msg in pubsub.listen():
+                if msg["type"] != "message":
+                    continue
+                try:
+                    rd = RuntimeData.parse_raw(msg["data"])
+                except ValueError:
+                    logger.warning("Bad runtime message in %s", msg["channel"])
+                    continue
+                self.submit(rd)
+        finally:
+            await pubsub.close()
+            await redis.close()
+
+    async def listen(self):
+        while True:
+            try:
+                await self._subscribe()
+            except (RedisError, OSError) as e:
+                logger.warning(
+                    "Runtimes subscription failed, retry in %s secs: %s",
+                    self._backoff,
+                    e,
+                )
+            await asyncio.sleep(self._backoff)
+            self._backoff = min(self._backoff * 2, defaults.AGENT_PREPULL_MAX_BACKOFF)
+
+    def start(self) -> threading.Thread:
+        """It listens in a daemon thread with its own loop"""
+        th = threading.Thread(
+            target=lambda: asyncio.run(self.listen()), name="image-puller", daemon=True
+        )
+        th.start()
+        return th
+
+
+class ImageCollector:
+    """
+    It removes runtime images in LRU order when the disk is full.
+    Images used in the last min_idle seconds are kept, they could belong
+    to a job already taken from the queue but not started yet.
+
+    :param queues: full name of the queues of the agent
+    :param warm_pool: warm containers of the agent, if enabled
+    """
+
+    def __init__(
+        self,
+        redis_dsn: str,
+        queues: List[str],
+        *,
+        state_dir: str = defaults.AGENT_IMAGES_DIR,
+        high_watermark: float = defaults.AGENT_IMAGES_HIGH_WATERMARK,
+        low_watermark: float = defaults.AGENT_IMAGES_LOW_WATERMARK,
+        min_idle: int = defaults.AGENT_IMAGES_MIN_IDLE,
+        every: int = defaults.AGENT_IMAGES_GC_EVERY,
+        docker_cmd: Optional[DockerCommand] = None,
+        warm_pool: Optional[WarmPool] = None,
+    ):
+        if low_watermark > high_watermark:
+            raise ValueError("low_watermark is greater than high_watermark")
+        self.redis_dsn = redis_dsn
+        self.queues = queues
+        self.state_dir = state_dir
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.min_idle = min_idle
+        self.every = every
+        self.warm_pool = warm_pool
+        self._cmd = docker_cmd
+
+    @property
+    def cmd(self) -> DockerCommand:
+        if not self._cmd:
+            self._cmd = DockerCommand()
+        return self._cmd
+
+    async def queued_images(self, redis: Redis) -> Set[str]:
+        """Runtimes of the jobs waiting in the queues"""
+        images = set()
+        for q in self.queues:
+            execids = await redis.lrange(f"{Prefixes.queue_jobs.value}{q}", 0, -1)
+            if not execids:
+                continue
+            keys = [f"{Prefixes.job.value}{_str(e)}" for e in execids]
+            for data in await redis.mget(keys):
+                if not data:
+                    continue
+                params = orjson.loads(data).get("params") or {}
+                runtime = (params.get("data") or {}).get("runtime")
+                if runtime:
+                    images.add(runtime)
+        return images
+
+    def collect(self, keep: Set[str]) -> List[str]:
+        """Remove images until the disk usage is below the low watermark.
+        It returns the images removed"""
+        root = self.cmd.root_dir()
+        if disk_usage(root) < self.high_watermark:
+            return []
+        removed = []
+        idle_since = time.time() - self.min_idle
+        for last_use, image in images_used(self.state_dir):
+            if disk_usage(root) < self.low_watermark or last_use > idle_since:
+                break
+            if image in keep:
+                continue
+            if self.warm_pool:
+                self.warm_pool.drain(image)
+            if self.cmd.remove_image(image):
+                _marker(image, self.state_dir).unlink(missing_ok=True)
+                logger.info("Image %s removed, last use %s", image, last_use)
+                removed.append(image)
+        if disk_usage(root) >= self.high_watermark:
+            logger.warning("Disk usage over the watermark after removing images")
+        return removed
+
+    async def run(self):
+        redis = create_pool(self.redis_dsn)
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                keep = await self.queued_images(redis)
+                await loop.run_in_executor(None, self.collect, keep)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Image collection failed: %s", e)
+            await asyncio.sleep(self.every)
+
+    def start(self) -> threading.Thread:
+        th = threading.Thread(
+            target=lambda: asyncio.run(self.run()), name="image-gc", daemon=True
+        )
+        th.start()
+        return th
+
+
+def _str(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
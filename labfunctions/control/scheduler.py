@@ -1,8 +1,11 @@
+import hashlib
 from typing import Optional, Union
 
 from libq import JobStoreSpec, Queue, RedisJobStore, Scheduler, create_pool
 from libq.errors import JobNotFound
 from libq.jobs import Job
+from libq.types import JobStatus
+from libq.utils import parse_timeout
 from redis.asyncio import ConnectionPool
 
 from labfunctions import cluster, conf, defaults, types
@@ -11,6 +14,14 @@ from labfunctions.managers import runtimes_mg, workflows_mg
 from labfunctions.notebooks import create_notebook_ctx
 from labfunctions.runtimes.context import create_build_ctx
 
+_BUILD_PENDING = {
+    JobStatus.created.name,
+    JobStatus.queued.name,
+    JobStatus.running.name,
+    JobStatus.retrying.name,
+}
+_ENQUEUE_GRACE = 30  # seconds
+
 
 async def create_task_ctx(
     session, projectid: str, task: types.NBTask, prefix=None
@@ -33,6 +44,7 @@ class JobManager:
 
     tasks = {
         "workflow": "labfunctions.control.tasks.workflow_dispatcher",
+        "kv_gc": "labfunctions.control.tasks.kv_gc",
     }
 
     def __init__(self, conn: ConnectionPool = None, *, store: JobStoreSpec = None):
@@ -63,6 +75,28 @@ class JobManager:
         )
         await self.enqueue_job(wd.wfid)
 
+    async def register_kv_gc(
+        self,
+        *,
+        control_queue=defaults.CONTROL_QUEUE,
+        interval: str,
+        task: Optional[types.storage.KVGCTask] = None,
+    ):
+        """Run the gc of the projects store every interval ("24h"),
+        the job is replaced if it already exists."""
+        task = task or types.storage.KVGCTask()
+        await self.scheduler.create_job(
+            self.tasks["kv_gc"],
+            queue=control_queue,
+            jobid=defaults.KV_GC_JOBID,
+            params={"data": task.dict()},
+            timeout="1h",
+            interval=interval,
+            background=True,
+            repeat=None,
+        )
+        await self.enqueue_job(defaults.KV_GC_JOBID)
+
     async def unregister_workflow(self, wfid: str, remove_job=True):
         await self.scheduler.unregister_job(wfid)
         if remove_job:
@@ -92,6 +126,7 @@ class SchedulerExec:
         "create_instance": "labfunctions.control.tasks.create_instance",
         "destroy_instance": "labfunctions.control.tasks.destroy_instance",
         "deploy_agent": "labfunctions.control.tasks.deploy_agent",
+        "kv_gc": "labfunctions.control.tasks.kv_gc",
     }
 
     def __init__(
@@ -142,25 +177,92 @@ class SchedulerExec:
         projectid: str,
         runtime: types.RuntimeSpec,
         version: Optional[str] = None,
+        bundle_format: str = defaults.BUNDLE_FORMAT,
+        bundle_digest: Optional[str] = None,
     ) -> types.runtimes.BuildCtx:
+        """
+        Builds are deduplicated:
+
+        - if the same version was already built from the same bundle
+          (same build_key), nothing is enqueued and ctx.enqueued is False.
+        - if another version was built from the same bundle, ctx.reuse is
+          set and the builder only tags its image.
+        - if an identical request is in flight, its ctx is returned.
+        """
+        store_class = self.settings.PROJECTS_STORE_CLASS_SYNC
+        store_opts = dict(self.settings.PROJECTS_STORE_OPTS)
+        if self.settings.PROJECTS_STORE_CAS:
+            store_opts["store_class"] = store_class
+            store_class = "labfunctions.io.kv_cas.KVCas"
         ctx = create_build_ctx(
             projectid,
             runtime,
             version,
-            project_store_class=self.settings.PROJECTS_STORE_CLASS_SYNC,
+            project_store_class=store_class,
             project_store_bucket=self.settings.PROJECTS_STORE_BUCKET,
             registry=self.settings.DOCKER_REGISTRY,
+            project_store_opts=store_opts,
+            bundle_format=bundle_format,
+            bundle_digest=bundle_digest,
         )
-        job = await self.build_q.enqueue(
-            self.tasks["build"],
-            execid=ctx.execid,
-            timeout=self._build_ts,
-            params={"data": ctx.dict()},
-            background=True,
-        )
+        if ctx.build_key:
+            built = await runtimes_mg.get_by_build_key(
+                session, projectid, ctx.build_key
+            )
+            if built and built.version == ctx.version:
+                ctx.reuse = built.runtimeid
+                ctx.enqueued = False
+                return ctx
+            if built:
+                ctx.reuse = built.runtimeid
+
+        key = self._inflight_key(ctx)
+        inflight = await self._inflight_build(key, ctx)
+        if inflight:
+            return inflight
+
+        try:
+            job = await self.build_q.enqueue(
+                self.tasks["build"],
+                execid=ctx.execid,
+                timeout=self._build_ts,
+                params={"data": ctx.dict()},
+                background=True,
+            )
+        except Exception:
+            await self.conn.delete(key)
+            raise
 
         return ctx
 
+    def _inflight_key(self, ctx: types.runtimes.BuildCtx) -> str:
+        h = hashlib.sha256()
+        h.update((ctx.build_key or ctx.spec.json(sort_keys=True)).encode())
+        h.update(f"\0{ctx.version}\0{ctx.bundle_format}".encode())
+        return f"{defaults.BUILD_INFLIGHT_PREFIX}{ctx.projectid}.{h.hexdigest()}"
+
+    async def _inflight_build(
+        self, key: str, ctx: types.runtimes.BuildCtx
+    ) -> Union[types.runtimes.BuildCtx, None]:
+        """
+        It registers ctx as the build in flight for its request, unless
+        another build for the same request is still queued or running,
+        in that case that build is returned.
+        """
+        ttl = parse_timeout(self._build_ts)
+        while not await self.conn.set(key, ctx.json(), nx=True, ex=ttl):
+            data = await self.conn.get(key)
+            if data:
+                other = types.runtimes.BuildCtx.parse_raw(data)
+                task = await self.get_task(other.execid)
+                if task and task.status in _BUILD_PENDING:
+                    return other
+                # registered but not enqueued yet
+                if not task and await self.conn.ttl(key) > ttl - _ENQUEUE_GRACE:
+                    return other
+            await self.conn.delete(key)
+        return None
+
     async def enqueue_workflow(
         self, session, *, projectid: str, wfid: str
     ) -> Union[types.ExecutionNBTask, None]:
@@ -176,6 +278,17 @@ class SchedulerExec:
             return ctx
         return None
 
+    async def enqueue_kv_gc(self, task: types.storage.KVGCTask) -> Job:
+        execid = str(ExecID())
+        job = await self.control_q.enqueue(
+            self.tasks["kv_gc"],
+            execid=execid,
+            params={"data": task.dict()},
+            timeout="1h",
+            max_retry=1,
+        )
+        return job
+
     async def enqueue_instance_creation(self, ctx: cluster.CreateRequest) -> Job:
         execid = str(ExecID())
         job = await self.control_q.enqueue(
@@ -1,13 +1,17 @@
 from datetime import datetime
 from functools import partial
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 from tenacity import retry, stop_after_attempt, wait_random
 
-from labfunctions import client, cluster, log, types
+from labfunctions import client, cluster, defaults, log, types
 from labfunctions.conf import load_server
+from labfunctions.db.nosync import AsyncSQL
 from labfunctions.executors import ExecID
 from labfunctions.executors.docker_exec import docker_exec
+from labfunctions.io.kv_gc import KVCollector, next_projects
+from labfunctions.io.kvspec import GenericKVSpec
+from labfunctions.managers import projects_mg
 from labfunctions.redis_conn import create_pool
 from labfunctions.runtimes.builder import builder_exec
 from labfunctions.utils import get_version, run_async, today_string
@@ -168,3 +172,53 @@ async def deploy_agent(data: Dict[str, Any]):
     )
 
     return response.dict()
+
+
+async def _list_projects(settings: types.ServerSettings) -> List[str]:
+    db = AsyncSQL(settings.ASQL)
+    await db.init(pool_size=1)
+    try:
+        async with db.session() as session:
+            projects = await projects_mg.list_all(session)
+    finally:
+        await db.engine.dispose()
+    return [p.projectid for p in projects or []]
+
+
+def _projects_store(settings: types.ServerSettings) -> GenericKVSpec:
+    store_class = settings.PROJECTS_STORE_CLASS_SYNC
+    opts = dict(settings.PROJECTS_STORE_OPTS)
+    if settings.PROJECTS_STORE_CAS:
+        opts["store_class"] = store_class
+        store_class = "labfunctions.io.kv_cas.KVCas"
+    return GenericKVSpec.create(store_class, settings.PROJECTS_STORE_BUCKET, opts)
+
+
+async def kv_gc(data: Dict[str, Any]):
+    """Apply the retention rules of the settings to the projects store
+    and save the usage of each project in the web redis.
+    See labfunctions.io.kv_gc"""
+    settings = load_server()
+    task = types.storage.KVGCTask(**data)
+    redis = create_pool(settings.WEB_REDIS)
+
+    projects = task.projects or await _list_projects(settings)
+    cursor = await redis.get(defaults.KV_GC_CURSOR)
+    selected = next_projects(projects, cursor, task.max_projects)
+
+    collector = KVCollector(
+        _projects_store(settings),
+        settings.KV_RETENTION,
+        batch_size=settings.KV_GC_BATCH_SIZE,
+        dry_run=task.dry_run,
+    )
+    results = []
+    for projectid in selected:
+        usage = await run_async(collector.collect, projectid)
+        if not task.dry_run:
+            await redis.set(f"{defaults.KV_GC_USAGE_PREFIX}{projectid}", usage.json())
+        results.append(usage.dict())
+    if task.max_projects and selected:
+        await redis.set(defaults.KV_GC_CURSOR, selected[-1])
+    log.server_logger.info(f"KV gc finished for {len(selected)} projects")
+    return results
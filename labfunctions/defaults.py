@@ -22,6 +22,9 @@ NOTEBOOKS_DIR = "notebooks/"
 
 # Builder
 ZIP_GIT_PREFIX = "src/"
+# images with the dependencies of a runtime: [docker_name]-deps:[hash]
+DOCKER_DEPS_SUFFIX = "-deps"
+DOCKER_DEPS_KEY_LEN = 16
 
 # Secrets and security
 SECRETS_FILENAME = ".secrets"
@@ -31,6 +34,14 @@ PRIVKEY_VAR_NAME = "PRIVATE_KEY"
 
 # Client DEFAULT OPTIONS
 CLIENT_TMP_FOLDER = ".nb_tmp"
+LABIGNORE_FILE = ".labignore"  # gitignore syntax, see labfunctions.runtimes.ignore
+BUNDLE_COMPRESS_LEVEL = 6
+BUNDLE_MAX_INMEMORY = 16 * 1024 * 1024  # bigger files are compressed serially
+# zip bundles are downloaded before extracting them, tar bundles are
+# extracted while they are downloaded. tar.zst requires zstandard
+BUNDLE_FORMATS = ["zip", "tar.zst", "tar.gz"]
+BUNDLE_FORMAT = "zip"
+BUNDLE_ZSTD_LEVEL = 3
 CLIENT_HOME_DIR = ".labfunctions/"
 CLIENT_TIMEOUT = 60
 CLIENT_CREDS_FILE = "credentials.json"
@@ -49,6 +60,29 @@ DOCKER_APP_GID = 1090
 SANIC_APP_NAME = "labfunctions"
 
 NB_OUTPUTS = "outputs"
+NB_COMPILED_DIR = ".nb_compiled"  # see labfunctions.notebooks.compiled
+
+# Cache (labfunctions.io.cache)
+CACHE_LOCAL_DIR = "/tmp/labcache"
+CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 GiB
+CACHE_MEMORY_MAX_BYTES = 256 * 1024 * 1024  # 256 MiB
+CACHE_LOCK_TIMEOUT = 10 * 60  # seconds
+
+# KV stores (labfunctions.io)
+KV_CONCURRENCY = 10  # parallel operations for batch calls
+KV_CHUNK_SIZE = 1024 * 1024  # 1 MiB, used to stream files
+KV_STREAM_QUEUE_SIZE = 8  # chunks buffered between a thread and the event loop
+KV_CAS_PREFIX = "_cas"  # see labfunctions.io.kv_cas
+KV_CACHE_DIR = "/tmp/labkvcache"  # see labfunctions.io.kv_disk_cache
+KV_CACHE_MAX_BYTES = 5 * 1024 * 1024 * 1024  # 5 GiB
+KV_CACHE_SCAN_EVERY = 300  # secs, size of the disk cache recounted
+KV_PART_SIZE = 32 * 1024 * 1024  # see labfunctions.io.kv_multipart
+KV_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+KV_PART_RETRIES = 3
+KV_GC_BATCH_SIZE = 100  # keys by delete_many call, see labfunctions.io.kv_gc
+KV_GC_USAGE_PREFIX = "lf.kv.usage."
+KV_GC_CURSOR = "lf.kv.gc.cursor"
+KV_GC_JOBID = "kv_gc"
 
 EXECUTIONTASK_VAR = "LF_EXECUTION_TASK"
 JUPYTERCTX_VAR = "LF_JUPYTER_CTX"
@@ -56,6 +90,7 @@ JUPYTERCTX_VAR = "LF_JUPYTER_CTX"
 BASE_PATH_ENV = "LF_BASE_PATH"
 
 PROJECT_UPLOADS = "uploads"
+PROJECT_BUNDLES = "bundles"  # bundles uploaded, by digest
 PROJECT_HISTORY = "history"
 
 # see https://zelark.github.io/nano-id-cc/
@@ -75,6 +110,28 @@ CLUSTER_NAME = "default"
 AGENT_HOMEDIR = "/home/op"
 AGENT_DOCKER_IMG = "nuxion/labfunctions"
 AGENT_ENV_TPL = "agent.docker.envfile"
+AGENT_PREPULL_WORKERS = 2  # concurrent pulls of new runtimes, 0 disables it
+AGENT_PREPULL_HISTORY = 100  # pulls kept by ImagePuller.pulls
+AGENT_PREPULL_MAX_BACKOFF = 60  # max seconds between subscription retries
+# runtimes registered are published in [RUNTIMES_CHANNEL][cluster]
+RUNTIMES_CHANNEL = "lf.runtimes."
+RUNTIMES_CHANNEL_ALL = "_all"
+# runtime images gc, see labfunctions.control.images.ImageCollector
+AGENT_IMAGES_DIR = "/tmp/labimages"  # last use of each image
+AGENT_IMAGES_GC_EVERY = 5 * 60  # seconds
+AGENT_IMAGES_HIGH_WATERMARK = 0.85  # disk usage starting an eviction
+AGENT_IMAGES_LOW_WATERMARK = 0.70  # disk usage where the eviction stops
+AGENT_IMAGES_MIN_IDLE = 10 * 60  # seconds, images used recently are kept
+# warm containers, see labfunctions.executors.warm_pool
+AGENT_WARM_DIR = "/tmp/labwarm"  # locks of the containers in use
+AGENT_WARM_MAX_REUSE = 20  # executions by container
+AGENT_WARM_MAX_AGE = 60 * 60  # seconds, idle containers older are replaced
+AGENT_WARM_REFILL_EVERY = 5  # seconds
+# warm kernels, see labfunctions.executors.kernel_pool
+KERNEL_POOL_ENV = "LF_KERNEL_POOL"
+KERNEL_PREIMPORT_ENV = "LF_KERNEL_PREIMPORT"
+KERNEL_MAX_REUSE = 50  # executions by kernel
+KERNEL_START_TIMEOUT = 60  # seconds
 
 NVIDIA_GPG_VERSION = "2004"
 NVIDIA_GPG_KEY = "3bf863cc"
@@ -85,3 +142,5 @@ ERROR_LOG = "lab.error"
 CLIENT_LOG = "lab.client"
 CONTROL_QUEUE = "default.control"
 BUILD_QUEUE = "default.build"
+# execid of the builds in flight, by project and build request
+BUILD_INFLIGHT_PREFIX = "lf.build.inflight."
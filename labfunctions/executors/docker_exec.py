@@ -4,12 +4,15 @@ import os
 from datetime import datetime, timedelta
 
 from labfunctions import client, defaults, secrets
+from labfunctions.commands import DockerCommand
+from labfunctions.conf import load_server
 
 # from labfunctions.executors import context
 # from labfunctions.conf.server_settings import settings
 from labfunctions.types import ExecutionNBTask, ExecutionResult
 
 from .nbtask_base import NBTaskDocker
+from .warm_pool import WarmPool
 
 
 def docker_exec(ctx: ExecutionNBTask) -> ExecutionResult:
@@ -24,9 +27,18 @@ def docker_exec(ctx: ExecutionNBTask) -> ExecutionResult:
         - and getconf -a | grep ARG_MAX # (value in kib)
     """
 
+    settings = load_server()
+    pool = None
+    if settings.AGENT_WARM_POOL_SIZE > 0:
+        pool = WarmPool(
+            DockerCommand(),
+            size=settings.AGENT_WARM_POOL_SIZE,
+            max_reuse=settings.AGENT_WARM_MAX_REUSE,
+            max_age=settings.AGENT_WARM_MAX_AGE,
+        )
     nbclient = client.from_env()
     print("NB Addr: ", nbclient._addr)
-    runner = NBTaskDocker(nbclient)
+    runner = NBTaskDocker(nbclient, pool=pool)
     result = runner.run(ctx)
     if result.error and not os.getenv("DEBUG"):
         runner.register(result)
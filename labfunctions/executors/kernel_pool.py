@@ -0,0 +1,154 @@
+"""
+Jupyter kernels started ahead of the executions of :class:`NBTaskLocal`.
+
+Papermill starts a kernel for each notebook, paying the start of python
+and the imports of the notebook every time. A :class:`KernelPool` keeps
+started kernels, optionally with some modules already imported, and
+gives them to papermill. After each execution the namespace of the
+kernel is cleared and the kernel goes back to the pool, only for the same
+key (project and runtime), because the modules imported by the notebook
+are still loaded.
+
+Kernels inherit the environment of the process when they start, so the
+environment of each execution is set in the kernel when it's acquired.
+
+It's useful only in long lived processes, like the warm containers of
+:mod:`labfunctions.executors.warm_pool`. Runtimes enable it with
+`kernels` and `preimport` in their container spec, set in the image as
+the KERNEL_POOL_ENV and KERNEL_PREIMPORT_ENV variables.
+"""
+import logging
+import os
+from typing import Dict, List, Mapping, Optional
+
+from jupyter_client import KernelManager
+
+from labfunctions import defaults
+
+logger = logging.getLogger(__name__)
+
+_RESET = "get_ipython().run_line_magic('reset', '-f')\nimport os\nos.chdir({cwd!r})"
+_ENV = "import os\nos.environ.clear()\nos.environ.update({env!r})"
+
+
+class KernelPool:
+    """
+    :param size: idle kernels kept by key
+    :param preimport: modules imported when a kernel starts
+    :param max_reuse: executions by kernel
+    """
+
+    def __init__(
+        self,
+        size: int = 1,
+        *,
+        preimport: Optional[List[str]] = None,
+        max_reuse: int = defaults.KERNEL_MAX_REUSE,
+        kernel_name: str = "python3",
+        cwd: Optional[str] = None,
+    ):
+        self.size = size
+        self.preimport = preimport or []
+        self.max_reuse = max_reuse
+        self.kernel_name = kernel_name
+        self.cwd = cwd or os.getcwd()
+        # kernels without key were not used yet
+        self._idle: Dict[Optional[str], List[KernelManager]] = {}
+        self._runs: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls) -> Optional["KernelPool"]:
+        size = int(os.getenv(defaults.KERNEL_POOL_ENV, "0"))
+        if size <= 0:
+            return None
+        preimport = os.getenv(defaults.KERNEL_PREIMPORT_ENV, "")
+        return cls(size, preimport=[m for m in preimport.split(",") if m])
+
+    def _execute(self, km: KernelManager, code: str):
+        kc = km.blocking_client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=defaults.KERNEL_START_TIMEOUT)
+            reply = kc.execute_interactive(
+                code, timeout=defaults.KERNEL_START_TIMEOUT, store_history=False
+            )
+        finally:
+            kc.stop_channels()
+        if reply["content"]["status"] != "ok":
+            raise RuntimeError(f"{reply['content'].get('ename')} running {code!r}")
+
+    def start(self, env: Optional[Mapping[str, str]] = None) -> KernelManager:
+        km = KernelManager(kernel_name=self.kernel_name)
+        if env is None:
+            km.start_kernel(cwd=self.cwd)
+        else:
+            km.start_kernel(cwd=self.cwd, env=dict(env))
+        if self.preimport:
+            try:
+                self._execute(km, "\n".join(f"import {m}" for m in self.preimport))
+            except RuntimeError as e:
+                # the notebook will fail by itself if it needs the module
+                logger.warning("Preimport failed: %s", e)
+        return km
+
+    def fill(self):
+        """Start kernels until there are size idle kernels"""
+        total = sum(len(idle) for idle in self._idle.values())
+        idle = self._idle.setdefault(None, [])
+        for _ in range(self.size - total):
+            idle.append(self.start())
+
+    def acquire(
+        self, key: str, env: Optional[Mapping[str, str]] = None
+    ) -> KernelManager:
+        """A kernel already used by key, or a new one, with env as its
+        environment (the environment of the process by default)"""
+        env = dict(os.environ if env is None else env)
+        for k in (key, None):
+            idle = self._idle.get(k, [])
+            while idle:
+                km = idle.pop()
+                if not km.is_alive():
+                    self._shutdown(km)
+                    continue
+                try:
+                    self._execute(km, _ENV.format(env=env))
+                except (RuntimeError, TimeoutError) as e:
+                    logger.warning("Kernel environment failed: %s", e)
+                    self._shutdown(km)
+                    continue
+                return km
+        return self.start(env)
+
+    def release(self, key: str, km: KernelManager):
+        """Clear the namespace of km and keep it for the next execution
+        of key, it's shutdown after max_reuse executions or if it fails"""
+        runs = self._runs.get(km.kernel_id, 0) + 1
+        if runs >= self.max_reuse or not km.is_alive():
+            self._shutdown(km)
+            return
+        try:
+            self._execute(km, _RESET.format(cwd=self.cwd))
+        except (RuntimeError, TimeoutError) as e:
+            logger.warning("Kernel reset failed: %s", e)
+            self._shutdown(km)
+            return
+        self._runs[km.kernel_id] = runs
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.size:
+            idle.append(km)
+        else:
+            self._shutdown(km)
+
+    def _shutdown(self, km: KernelManager):
+        self._runs.pop(km.kernel_id, None)
+        try:
+            km.shutdown_kernel(now=True)
+        except RuntimeError:
+            pass
+
+    def shutdown(self):
+        for idle in self._idle.values():
+            for km in idle:
+                self._shutdown(km)
+        self._idle = {}
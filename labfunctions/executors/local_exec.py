@@ -4,26 +4,29 @@ import os
 import shutil
 import time
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 from labfunctions import client, defaults
 from labfunctions.conf import load_client
 from labfunctions.types import ExecutionNBTask, ExecutionResult, NBTask
 
+from .kernel_pool import KernelPool
 from .nbtask_base import NBTaskLocal
 
 # from labfunctions.notebooks import nb_job_executor
 
 
-def local_exec_env() -> ExecutionResult:
+def local_exec_env(kernels: Optional[KernelPool] = None) -> ExecutionResult:
     """
     Control the notebook execution.
     TODO: implement notifications
     TODO: base executor class?
+
+    :param kernels: warm kernels used by long lived processes
     """
     # Init
     nbclient = client.from_env()
-    runner = NBTaskLocal(nbclient)
+    runner = NBTaskLocal(nbclient, kernels=kernels)
     ctx_str = os.getenv(defaults.EXECUTIONTASK_VAR)
 
     etask = ExecutionNBTask(**json.loads(ctx_str))
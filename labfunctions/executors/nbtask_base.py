@@ -2,37 +2,37 @@ import json
 import logging
 import os
 import shutil
+import subprocess
+import sys
 import time
 import warnings
 from copy import deepcopy
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from labfunctions import defaults
 from labfunctions.client.diskclient import DiskClient
 from labfunctions.client.nbclient import NBClient
 from labfunctions.commands import DockerCommand, DockerRunResult
+from labfunctions.control.images import mark_used
+from labfunctions.notebooks.compiled import (
+    NotCompilable,
+    failed_cell,
+    load_compiled,
+    reconstruct,
+    render_script,
+)
 from labfunctions.types import ExecutionNBTask, ExecutionResult, NBTask
-from labfunctions.types.runtimes import RuntimeData
-from labfunctions.utils import get_version, today_string
+from labfunctions.utils import today_string
 
 from .execid import ExecID
+from .kernel_pool import KernelPool
+from .warm_pool import WarmPool
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 
-def _prepare_runtime(runtime: Optional[RuntimeData] = None) -> str:
-    if not runtime:
-        version = get_version()
-        _runtime = f"{defaults.DOCKERFILE_IMAGE}:{version}"
-    else:
-        _runtime = f"{runtime.docker_name}:{runtime.version}"
-        if runtime.registry:
-            _runtime = f"{runtime.registry}/{runtime}"
-    return _runtime
-
-
 def _simple_retry(func, params, max_retries=3, wait_time=5):
     status = False
     tries = 0
@@ -77,6 +77,12 @@ class NBTaskExecBase:
 class NBTaskDocker(NBTaskExecBase):
     cmd = "lab exec local"
 
+    def __init__(
+        self, client: Union[NBClient, DiskClient], pool: Optional[WarmPool] = None
+    ):
+        super().__init__(client)
+        self.pool = pool
+
     def build_env(self, data: Dict[str, Any]) -> Dict[str, Any]:
         priv_key = self.client.projects_private_key(data["projectid"])
         if not priv_key:
@@ -101,14 +107,29 @@ class NBTaskDocker(NBTaskExecBase):
             }
         )
         cmd = DockerCommand()
-        result = cmd.run(
-            self.cmd, ctx.runtime, timeout=ctx.timeout, env_data=env, require_gpu=ctx
-        )
+        # images not pre-pulled by the agent (see labfunctions.control.images)
+        # are pulled before starting, so the pull doesn't eat the timeout
+        pull_secs = cmd.ensure_image(ctx.runtime)
+        mark_used(ctx.runtime)
+        result = None
+        if self.pool:
+            result = self.pool.run(ctx.runtime, env, timeout=ctx.timeout)
+        if not result:
+            result = cmd.run(
+                self.cmd,
+                ctx.runtime,
+                timeout=ctx.timeout,
+                env_data=env,
+                require_gpu=ctx.gpu_support,
+            )
         error = False
         if result.status != 0:
             error = True
 
-        elapsed = round(time.time() - _started)
+        elapsed = round(time.time() - _started - (pull_secs or 0))
+        if self.pool:
+            # the agent refills it for the next executions of this runtime
+            self.pool.want(ctx.runtime, require_gpu=ctx.gpu_support)
         return ExecutionResult(
             projectid=ctx.projectid,
             name=ctx.nb_name,
@@ -126,6 +147,7 @@ class NBTaskDocker(NBTaskExecBase):
             error=error,
             error_msg=result.msg,
             created_at=ctx.created_at,
+            pull_secs=pull_secs,
         )
 
     def notificate(self, ctx: ExecutionNBTask, result: ExecutionResult):
@@ -133,22 +155,32 @@ class NBTaskDocker(NBTaskExecBase):
 
 
 class NBTaskLocal(NBTaskExecBase):
-    def run(self, ctx: ExecutionNBTask) -> ExecutionResult:
-        import papermill as pm
+    def __init__(
+        self,
+        client: Union[NBClient, DiskClient],
+        kernels: Optional[KernelPool] = None,
+    ):
+        super().__init__(client)
+        self.kernels = kernels
 
+    def run(self, ctx: ExecutionNBTask) -> ExecutionResult:
         _started = time.time()
-        _error = False
-        _error_msg = None
         Path(ctx.output_dir).mkdir(parents=True, exist_ok=True)
         print(f"Current dir: {Path.cwd()}")
         print(f"Input: {ctx.pm_input}")
-        try:
-            pm.execute_notebook(ctx.pm_input, ctx.pm_output, parameters=ctx.params)
-        except pm.exceptions.PapermillExecutionError as e:
-            self.logger.error(f"jobdid:{ctx.wfid} execid:{ctx.execid} failed {e}")
-            _error = True
-            _error_msg = str(e)
-            self._error_handler(ctx)
+        output_name = ctx.output_name
+        script = None
+        if ctx.compiled:
+            try:
+                script = load_compiled(ctx.pm_input)
+            except NotCompilable as e:
+                self.logger.warning(f"{e}, running it with papermill")
+        if script:
+            _error, _error_msg = self._run_compiled(ctx, script)
+            if not _error and not ctx.compiled_output:
+                output_name = None
+        else:
+            _error, _error_msg = self._run_papermill(ctx)
 
         elapsed = time.time() - _started
         return ExecutionResult(
@@ -162,7 +194,7 @@ class NBTaskLocal(NBTaskExecBase):
             params=ctx.params,
             input_=ctx.pm_input,
             output_dir=ctx.output_dir,
-            output_name=ctx.output_name,
+            output_name=output_name,
             error_dir=ctx.error_dir,
             error=_error,
             error_msg=_error_msg,
@@ -170,6 +202,62 @@ class NBTaskLocal(NBTaskExecBase):
             created_at=ctx.created_at,
         )
 
+    def _run_papermill(self, ctx: ExecutionNBTask) -> Tuple[bool, Optional[str]]:
+        import papermill as pm
+
+        _error = False
+        _error_msg = None
+        km = None
+        key = f"{ctx.projectid}/{ctx.runtime}"
+        if self.kernels:
+            # pooled kernels started before the env of this execution
+            km = self.kernels.acquire(key, env=os.environ)
+        try:
+            pm.execute_notebook(
+                ctx.pm_input, ctx.pm_output, parameters=ctx.params, km=km
+            )
+        except pm.exceptions.PapermillExecutionError as e:
+            self.logger.error(f"jobdid:{ctx.wfid} execid:{ctx.execid} failed {e}")
+            _error = True
+            _error_msg = str(e)
+            self._error_handler(ctx)
+        finally:
+            if km:
+                self.kernels.release(key, km)
+        return _error, _error_msg
+
+    def _run_compiled(
+        self, ctx: ExecutionNBTask, script: str
+    ) -> Tuple[bool, Optional[str]]:
+        """Run the script with python, from stdin so the current folder
+        is in its path as in a kernel. The output notebook is rebuilt
+        from the source notebook and the logs"""
+        script = render_script(script, ctx.params)
+        try:
+            proc = subprocess.run(
+                [sys.executable, "-"],
+                input=script.encode(),
+                capture_output=True,
+                timeout=ctx.timeout,
+            )
+            code, stdout, stderr = proc.returncode, proc.stdout, proc.stderr
+        except subprocess.TimeoutExpired as e:
+            code, stdout = -1, e.stdout or b""
+            stderr = (e.stderr or b"") + f"\n{e}\n".encode()
+        logs = (stdout + stderr).decode("utf-8", errors="replace")
+        print(logs)
+        if code == 0:
+            if ctx.compiled_output:
+                reconstruct(ctx.pm_input, ctx.pm_output, ctx.params, logs)
+            return False, None
+
+        self.logger.error(f"jobdid:{ctx.wfid} execid:{ctx.execid} failed")
+        cell = failed_cell(script, "<stdin>", logs)
+        error_output = f"{ctx.error_dir}/{ctx.output_name}"
+        reconstruct(ctx.pm_input, error_output, ctx.params, logs, cell)
+        lines = stderr.decode("utf-8", errors="replace").strip().splitlines()
+        return True, lines[-1] if lines else f"exit status {code}"
+
     def notificate(self, ctx: ExecutionNBTask, result: ExecutionResult):
         pass
 
@@ -0,0 +1,384 @@
+"""
+Idle containers by runtime, ready to run executions of :class:`NBTaskDocker`.
+
+Creating a container, starting python and importing papermill takes longer
+than many short notebooks. Warm containers run `lab exec warm` (see
+:func:`warm_loop`): it imports everything once and then waits in its stdin
+the environment of each execution, as a json line, writing WARM_DONE_MARK
+and the status of the execution to stdout when it finishes. After
+max_reuse executions it exits and the pool starts a new one.
+
+The jobs of an agent run in different processes, so docker is the only
+state shared: containers are found by their labels, and taken with a lock
+file held during the execution, released by the os if the process dies.
+Executions only record the image they want warm (:meth:`WarmPool.want`),
+the agent refills those pools and reaps the dead and old containers of
+every image in background (:meth:`WarmPool.refill`), so executions don't
+wait for it. The image collector drains the pool of an image before
+removing it.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import IO, Any, Dict, List, Optional, Set, Tuple
+
+from docker.models.containers import Container
+from docker.utils.socket import frames_iter
+
+import docker
+from labfunctions import defaults
+from labfunctions.commands import DockerCommand
+from labfunctions.types.docker import DockerRunResult
+from labfunctions.utils import mkdir_p
+
+logger = logging.getLogger(__name__)
+
+WARM_CMD = "lab exec warm"
+WARM_DONE_MARK = "__lf_warm_done__"
+LABEL_IMAGE = "lf.warm.image"
+LABEL_CREATED = "lf.warm.created"
+
+
+def _lock(path: str, block=False) -> Optional[IO]:
+    fd = open(path, "w")
+    flags = fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB
+    try:
+        fcntl.flock(fd, flags)
+    except BlockingIOError:
+        fd.close()
+        return None
+    return fd
+
+
+def _unlock(fd: IO):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    fd.close()
+
+
+class WarmPool:
+    """
+    :param size: idle containers kept by runtime
+    :param max_reuse: executions by container
+    :param max_age: seconds, idle containers older than it are replaced
+    """
+
+    def __init__(
+        self,
+        docker_cmd: DockerCommand,
+        *,
+        size: int = 1,
+        max_reuse: int = defaults.AGENT_WARM_MAX_REUSE,
+        max_age: int = defaults.AGENT_WARM_MAX_AGE,
+        lock_dir: str = defaults.AGENT_WARM_DIR,
+    ):
+        self.cmd = docker_cmd
+        self.size = size
+        self.max_reuse = max_reuse
+        self.max_age = max_age
+        self.lock_dir = lock_dir
+        mkdir_p(lock_dir)
+
+    def _lock_path(self, name: str) -> str:
+        return f"{self.lock_dir}/{name}.lock"
+
+    def _wanted_path(self, image: str) -> Path:
+        name = hashlib.sha1(image.encode()).hexdigest()
+        return Path(self.lock_dir, "images", f"{name}.json")
+
+    def want(self, image: str, require_gpu=False):
+        """Record the use of image, its pool is refilled by the agent"""
+        fp = self._wanted_path(image)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.write_text(json.dumps({"image": image, "gpu": require_gpu}))
+
+    def wanted(self) -> List[Tuple[str, bool]]:
+        """Images used in the last max_age seconds and if they need a gpu,
+        the older ones are forgotten"""
+        images = []
+        for fp in Path(self.lock_dir, "images").glob("*.json"):
+            try:
+                if time.time() - fp.stat().st_mtime > self.max_age:
+                    fp.unlink()
+                    continue
+                data = json.loads(fp.read_text())
+            except (FileNotFoundError, ValueError):
+                continue
+            images.append((data["image"], data["gpu"]))
+        return images
+
+    def containers(self, image: Optional[str] = None, all=False) -> List[Container]:
+        """Warm containers of image, or of every image"""
+        label = f"{LABEL_IMAGE}={image}" if image else LABEL_IMAGE
+        return self.cmd.docker.containers.list(all=all, filters={"label": label})
+
+    def _expired(self, c: Container) -> bool:
+        created = int(c.labels.get(LABEL_CREATED, 0))
+        return time.time() - created > self.max_age
+
+    def acquire(self, image: str) -> Optional[Tuple[Container, IO]]:
+        """An idle container of image and its lock"""
+        for c in self.containers(image):
+            if self._expired(c):
+                continue
+            fd = _lock(self._lock_path(c.id))
+            if fd:
+                return c, fd
+        return None
+
+    def start(self, image: str, require_gpu=False) -> Container:
+        runtime = "nvidia" if require_gpu else None
+        return self.cmd.docker.containers.run(
+            image,
+            f"{WARM_CMD} --max-runs {self.max_reuse}",
+            runtime=runtime,
+            detach=True,
+            stdin_open=True,
+            network_mode="bridge",
+            labels={LABEL_IMAGE: image, LABEL_CREATED: str(int(time.time()))},
+        )
+
+    def _prune(self, image: Optional[str] = None, drain=False) -> Tuple[int, int]:
+        """Remove the dead containers, and the idle ones that expired or
+        all of them if drain. It returns how many were removed and how many
+        idle containers are left"""
+        removed = idle = 0
+        for c in self.containers(image, all=True):
+            if c.status != "running":
+                self._remove(c)
+                removed += 1
+                continue
+            fd = _lock(self._lock_path(c.id))
+            if not fd:
+                continue
+            if drain or self._expired(c):
+                self._remove(c)
+                removed += 1
+            else:
+                idle += 1
+            _unlock(fd)
+        return removed, idle
+
+    def fill(self, image: str, require_gpu=False) -> int:
+        """Remove dead and old idle containers, and start new ones until
+        there are size idle containers. It returns how many were started"""
+        name = hashlib.sha1(image.encode()).hexdigest()
+        pool_lock = _lock(self._lock_path(name), block=True)
+        try:
+            _, idle = self._prune(image)
+            started = 0
+            for _ in range(self.size - idle):
+                self.start(image, require_gpu=require_gpu)
+                started += 1
+            return started
+        except docker.errors.APIError as e:
+            logger.error("Warm pool of %s failed: %s", image, e)
+            return 0
+        finally:
+            _unlock(pool_lock)
+
+    def reap(self) -> int:
+        """Remove dead and old idle containers of every image, executions
+        only fill the pool of their own image. It returns how many were
+        removed"""
+        try:
+            removed, _ = self._prune()
+        except docker.errors.APIError as e:
+            logger.error("Warm pool reap failed: %s", e)
+            return 0
+        return removed
+
+    def refill(self) -> int:
+        """Reap the containers of every image and fill the pools of the
+        images wanted. It returns how many containers were started"""
+        self.reap()
+        return sum(self.fill(image, require_gpu=gpu) for image, gpu in self.wanted())
+
+    def refill_forever(self, every: int = defaults.AGENT_WARM_REFILL_EVERY):
+        while True:
+            try:
+                self.refill()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Warm pool refill failed: %s", e)
+            time.sleep(every)
+
+    def start_refill(
+        self, every: int = defaults.AGENT_WARM_REFILL_EVERY
+    ) -> threading.Thread:
+        """It refills the pools in a daemon thread"""
+        th = threading.Thread(
+            target=self.refill_forever, args=(every,), name="warm-pool", daemon=True
+        )
+        th.start()
+        return th
+
+    def drain(self, image: str) -> int:
+        """Remove the idle containers of image and forget it, so the image
+        can be removed. It returns how many were removed"""
+        self._wanted_path(image).unlink(missing_ok=True)
+        name = hashlib.sha1(image.encode()).hexdigest()
+        pool_lock = _lock(self._lock_path(name), block=True)
+        try:
+            removed, _ = self._prune(image, drain=True)
+            return removed
+        except docker.errors.APIError as e:
+            logger.error("Warm pool drain of %s failed: %s", image, e)
+            return 0
+        finally:
+            _unlock(pool_lock)
+
+    def _remove(self, c: Container):
+        try:
+            c.remove(force=True)
+        except docker.errors.NotFound:
+            pass
+        except docker.errors.APIError as e:
+            # like a removal already in progress
+            logger.warning("Warm container %s not removed: %s", c.id, e)
+        Path(self._lock_path(c.id)).unlink(missing_ok=True)
+
+    def execute(
+        self, c: Container, env: Dict[str, Any], timeout: int
+    ) -> Optional[DockerRunResult]:
+        """Send env to the warm loop of c, and wait the end of the execution.
+        None if c can't take it, like a container that just exited"""
+        try:
+            sock = self.cmd.docker.api.attach_socket(
+                c.id, params={"stdin": 1, "stdout": 1, "stderr": 1, "stream": 1}
+            )
+            raw = getattr(sock, "_sock", sock)
+            raw.sendall(f"{json.dumps(env)}\n".encode())
+        except (docker.errors.APIError, OSError) as e:
+            logger.warning("Warm container %s not available: %s", c.id, e)
+            self._remove(c)
+            return None
+        expired = threading.Event()
+
+        def _kill():
+            # removing it closes the stream
+            expired.set()
+            self._remove(c)
+
+        timer = threading.Timer(timeout, _kill)
+        timer.start()
+        logs = ""
+        started = False
+        status = -2  # the container died
+        try:
+            for _, chunk in frames_iter(sock, tty=False):
+                started = True
+                logs += chunk.decode("utf-8", errors="replace")
+                ix = logs.find(WARM_DONE_MARK)
+                if ix != -1 and logs.endswith("\n"):
+                    status = int(logs[ix + len(WARM_DONE_MARK) :].split()[0])
+                    logs = logs[:ix]
+                    break
+        except OSError as e:
+            logs += str(e)
+        finally:
+            timer.cancel()
+            sock.close()
+        if expired.is_set():
+            return DockerRunResult(msg=logs, status=-1)
+        if not started:
+            # it died before reading env
+            self._remove(c)
+            return None
+        return DockerRunResult(msg=logs, status=status)
+
+    def run(
+        self, image: str, env: Dict[str, Any], timeout: int
+    ) -> Optional[DockerRunResult]:
+        """None if there isn't an idle container for image"""
+        taken = self.acquire(image)
+        if not taken:
+            return None
+        c, fd = taken
+        try:
+            return self.execute(c, env, timeout)
+        finally:
+            _unlock(fd)
+
+
+def _tree(root: str) -> Set[str]:
+    paths = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            paths.add(os.path.join(dirpath, name))
+    return paths
+
+
+def _clean_tree(root: str, keep: Set[str]):
+    """Remove the files and folders of root not in keep"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if path not in keep:
+                dirnames.remove(name)
+                if os.path.islink(path):
+                    os.unlink(path)
+                else:
+                    shutil.rmtree(path, ignore_errors=True)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if path not in keep:
+                Path(path).unlink(missing_ok=True)
+
+
+def warm_loop(max_runs: int, stdin=sys.stdin, stdout=sys.stdout) -> int:
+    """The process inside warm containers. Each execution starts with the
+    environment the container had, in its folder, without the files and
+    folders created by previous executions (files changed are not
+    restored). It returns how many executions were done. Jupyter kernels
+    are kept warm too if the image enables it (see
+    :class:`labfunctions.executors.kernel_pool.KernelPool`), started with
+    the environment of the container."""
+    # pylint: disable=import-outside-toplevel
+    import papermill  # noqa: F401
+
+    from labfunctions.executors.kernel_pool import KernelPool
+    from labfunctions.executors.local_exec import local_exec_env
+
+    kernels = KernelPool.from_env()
+    if kernels:
+        kernels.fill()
+    base_env = dict(os.environ)
+    base_dir = os.getcwd()
+    base_tree = _tree(base_dir)
+    runs = 0
+    while runs < max_runs:
+        line = stdin.readline()
+        if not line:
+            break
+        os.chdir(base_dir)
+        _clean_tree(base_dir, base_tree)
+        os.environ.clear()
+        os.environ.update(base_env)
+        os.environ.update(json.loads(line))
+        status = 0
+        try:
+            rsp = local_exec_env(kernels=kernels)
+            if rsp.error:
+                status = 1
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc(file=stdout)
+            status = 1
+        stdout.write(f"\n{WARM_DONE_MARK} {status}\n")
+        stdout.flush()
+        runs += 1
+        if kernels:
+            # after the result, so the agent doesn't wait for it, and
+            # without the environment of this execution
+            os.environ.clear()
+            os.environ.update(base_env)
+            kernels.fill()
+    if kernels:
+        kernels.shutdown()
+    return runs
@@ -1,5 +1,5 @@
 from .kvspec import AsyncKVSpec, GenericKVSpec
-from .memory_store import MemoryStore
+from .memory_store import LRUMemoryCache, MemoryStore, get_memory_cache
 
 # __all__ = [
 #    "MemoryStore",
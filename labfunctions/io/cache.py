@@ -1,31 +1,104 @@
 # import tempfile
+import asyncio
+import hashlib
+import inspect
 import json
 import logging
-import time
-from dataclasses import asdict, dataclass
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import sys
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import asdict, dataclass, replace
 from datetime import datetime
 from functools import wraps
-from typing import Any, Dict, Optional
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
 import cloudpickle
 import httpx
+import redis
+import redis.asyncio
 
+from labfunctions import defaults
 from labfunctions.conf.client_settings import settings
+from labfunctions.io.memory_store import get_memory_cache
 
 # from labfunctions.workflows.core import build_context
 from labfunctions.types import SimpleExecCtx
+from labfunctions.utils import run_async, secure_filename
 
 logger = logging.getLogger(__name__)
 
-VALID_STRATEGIES = ["local", "fileserver"]
+VALID_STRATEGIES = ["local", "fileserver", "memory"]
+VALID_SERIALIZERS = ["pickle", "pickle5", "parquet"]
+
+_DATA_FILE = "data.pickle"
+_META_FILE = "meta.json"
+_FRAME_FILE = "data.parquet"
+# fileserver blobs: [MAGIC][4 bytes meta len][meta json][pickle]
+_BLOB_MAGIC = b"LFC1"
+_BLOB_HEADER = struct.Struct(">4sI")
+
+_http_client: Optional[httpx.Client] = None
+_http_lock = threading.Lock()
+
+_LOCK_PREFIX = "lf.cache.lock."
+_redis_clients: Dict[str, redis.Redis] = {}
 
 
 @dataclass
 class CacheConfig:
+    """
+    :param name: name of the cached function, by default the function name
+    :param ctx: execution context, only wfid is used to build the keys.
+    :param valid_for_min: minutes after which a cached value is expired
+    :param strategy: local, fileserver or memory
+    :param cache_dir: root folder for the local strategy
+    :param max_bytes: total size allowed for the local strategy, when it's
+    exceeded the least recently used entries are evicted.
+    :param max_entries: same as max_bytes but counting entries.
+    :param memory: if True, a memory tier is used in front of the strategy.
+    :param memory_max_bytes: size limit of the memory tier.
+    :param serializer: "pickle", "pickle5" or "parquet". pickle5 and parquet are
+    only used by the local strategy. pickle5 writes the out-of-band buffers
+    (like numpy arrays) as separated files which are memory-mapped on reading.
+    parquet stores pandas DataFrames in a columnar format, other values are
+    pickled.
+    :param columns: with parquet, only these columns are read.
+    :param filters: with parquet, row filters in the pyarrow format, like
+    [("col", ">", 10)], row groups which don't match are skipped.
+    :param row_group_size: with parquet, max rows by row group.
+    :param single_flight: concurrent calls with the same key wait for the first
+    one instead of computing the value again.
+    :param lock_dsn: redis url, if provided single flight works across processes.
+    :param lock_timeout: seconds after which the redis lock expires, it's also the
+    max time that a caller waits for it.
+    """
+
     name: str
     ctx: SimpleExecCtx
     valid_for_min: int = 60
     strategy: str = "local"
+    cache_dir: str = defaults.CACHE_LOCAL_DIR
+    max_bytes: Optional[int] = defaults.CACHE_MAX_BYTES
+    max_entries: Optional[int] = None
+    memory: bool = False
+    memory_max_bytes: int = defaults.CACHE_MEMORY_MAX_BYTES
+    serializer: str = "pickle"
+    columns: Optional[List[str]] = None
+    filters: Optional[List[Any]] = None
+    row_group_size: Optional[int] = None
+    single_flight: bool = True
+    lock_dsn: Optional[str] = None
+    lock_timeout: int = defaults.CACHE_LOCK_TIMEOUT
+
+    @property
+    def projection(self) -> bool:
+        return bool(self.columns or self.filters)
 
 
 def build_ctx_global(globals_dict) -> SimpleExecCtx:
@@ -49,94 +122,606 @@ def build_ctx(wfid, execid, now=None) -> SimpleExecCtx:
     )
 
 
-def _write_pickle(name, data, ctx: SimpleExecCtx):
-    fpath = f"/tmp/{ctx.wfid}.{ctx.execid}.{name}.pickle"
-    metapath = f"/tmp/{ctx.wfid}.{ctx.execid}.{name}.json"
-    with open(fpath, "wb") as f:
-        f.write(cloudpickle.dumps(data))
-        logger.debug("CACHE: Wrote to %s", fpath)
-    with open(metapath, "w", encoding="utf-8") as f:
-        json.dump(asdict(ctx), f)
+def _feed_hash(h, obj):
+    """Feeds `h` with a representation of obj which doesn't depend on
+    the process (dict ordering, set ordering, hash randomization)."""
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        h.update(f"{type(obj).__name__}:{obj!r};".encode("utf-8"))
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__name__}[{len(obj)}];".encode("utf-8"))
+        for el in obj:
+            _feed_hash(h, el)
+    elif isinstance(obj, dict):
+        h.update(f"dict[{len(obj)}];".encode("utf-8"))
+        for k in sorted(obj, key=repr):
+            _feed_hash(h, k)
+            _feed_hash(h, obj[k])
+    elif isinstance(obj, (set, frozenset)):
+        h.update(f"{type(obj).__name__}[{len(obj)}];".encode("utf-8"))
+        for digest in sorted(hash_value(el) for el in obj):
+            h.update(digest.encode("utf-8"))
+    elif hasattr(obj, "tobytes") and hasattr(obj, "dtype"):
+        # numpy arrays and scalars
+        h.update(
+            f"{type(obj).__name__}:{obj.dtype}:{getattr(obj, 'shape', '')};".encode(
+                "utf-8"
+            )
+        )
+        h.update(obj.tobytes())
+    elif isinstance(obj, datetime):
+        h.update(f"datetime:{obj.isoformat()};".encode("utf-8"))
+    else:
+        h.update(cloudpickle.dumps(obj))
+
+
+def hash_value(obj) -> str:
+    h = hashlib.sha256()
+    _feed_hash(h, obj)
+    return h.hexdigest()
 
 
-def _restore_pickle(name, ctx: SimpleExecCtx):
-    fpath = f"/tmp/{ctx.wfid}.{ctx.execid}.{name}.pickle"
-    metapath = f"/tmp/{ctx.wfid}.{ctx.execid}.{name}.json"
+def hash_args(args, kwargs) -> str:
+    """A stable hash of the arguments of a function call"""
+    return hash_value((tuple(args), dict(kwargs)))
+
+
+def bind_args(sig: Optional[inspect.Signature], args, kwargs) -> Tuple[tuple, dict]:
+    """The arguments of a call by name, with the defaults applied, so
+    f(2, 3), f(2, y=3) and f(2) with y=3 as default have the same hash.
+    Calls that don't match the signature are kept as they are"""
+    if sig is None:
+        return tuple(args), dict(kwargs)
     try:
-        with open(fpath, "rb") as f:
-            data = cloudpickle.load(f)
-            logger.debug("CACHE: Reading from %s", fpath)
-        with open(metapath, "r") as f:
-            data = f.read()
-            meta = json.loads(data)
+        bound = sig.bind(*args, **kwargs)
+    except TypeError:
+        return tuple(args), dict(kwargs)
+    bound.apply_defaults()
+    return (), dict(bound.arguments)
 
-        return data, meta
-    except EOFError:
-        return None
-    except FileNotFoundError:
-        return None
 
+def func_fingerprint(func) -> str:
+    """Hash of the source code of a function, if the code of the function
+    changes, then the cached values are not valid anymore."""
+    try:
+        src = inspect.getsource(func).encode("utf-8")
+    except (OSError, TypeError):
+        code = getattr(func, "__code__", None)
+        if code:
+            src = code.co_code + repr(code.co_consts).encode("utf-8")
+        else:
+            src = func.__qualname__.encode("utf-8")
+    return hashlib.sha256(src).hexdigest()
+
+
+def build_cache_key(wfid: str, name: str, func_hash: str, args_hash: str) -> str:
+    """
+    In the form of
+    [wfid].[name].[func_hash].[args_hash]
+
+    The execid is not part of the key, so a value could be reused between
+    different executions of the same workflow.
+    """
+    _name = secure_filename(name)
+    return f"{wfid}.{_name}.{func_hash[:16]}.{args_hash[:32]}"
+
+
+def _entry_dir(key: str, conf: CacheConfig) -> Path:
+    return Path(conf.cache_dir) / key
+
+
+def _build_meta(key: str, conf: CacheConfig, size: int = 0) -> Dict[str, Any]:
+    meta = asdict(conf.ctx)
+    meta["key"] = key
+    meta["name"] = conf.name
+    meta["size"] = size
+    meta["created_at"] = datetime.utcnow().isoformat()
+    return meta
+
+
+def _dir_size(fp: Path) -> int:
+    return sum(f.stat().st_size for f in fp.iterdir() if f.is_file())
+
+
+def evict_local(cache_dir: str, max_bytes=None, max_entries=None):
+    """
+    Removes the least recently used entries of the local cache until
+    the limits are satisfied. The recency of an entry is given by the
+    modification time of its metadata file, which is updated on each hit.
+    """
+    if not max_bytes and not max_entries:
+        return
+    root = Path(cache_dir)
+    if not root.is_dir():
+        return
+    entries = []
+    for entry in root.iterdir():
+        meta = entry / _META_FILE
+        try:
+            entries.append((meta.stat().st_mtime, _dir_size(entry), entry))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    entries.sort(key=lambda e: e[0])
+    total = sum(e[1] for e in entries)
+    count = len(entries)
+    for _, size, entry in entries:
+        if (not max_bytes or total <= max_bytes) and (
+            not max_entries or count <= max_entries
+        ):
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        logger.debug("CACHE: evicted %s", entry)
+        total -= size
+        count -= 1
+
+
+def _buffer_path(entry: Path, ix: int, gen: Optional[str] = None) -> Path:
+    """Entries written by older versions don't have generation"""
+    if gen:
+        return entry / f"buffer-{gen}-{ix}.bin"
+    return entry / f"buffer-{ix}.bin"
+
+
+def _pickle5_path(entry: Path, gen: Optional[str] = None) -> Path:
+    if gen:
+        return entry / f"data-{gen}.pickle"
+    return entry / _DATA_FILE
+
+
+def _atomic_write(fpath: Path, data):
+    """Other processes could have the file memory-mapped, truncating it
+    in place would crash them (SIGBUS), so it's replaced instead."""
+    tmp = fpath.with_name(f"{fpath.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, fpath)
+
+
+def _write_pickle5(entry: Path, data) -> Tuple[int, int, str]:
+    """
+    Pickle protocol 5 with out-of-band buffers, each buffer is written
+    as is in its own file, without copying it into the pickle stream.
+    Files are named by a new generation, recorded in the meta written
+    after them, so readers never mix files of different writes.
+    It returns the total size written, the number of buffers and the
+    generation.
+    """
+    buffers: List[pickle.PickleBuffer] = []
+    blob = cloudpickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    gen = os.urandom(8).hex()
+    _atomic_write(_pickle5_path(entry, gen), blob)
+    size = len(blob)
+    for ix, buf in enumerate(buffers):
+        raw = buf.raw()
+        _atomic_write(_buffer_path(entry, ix, gen), raw)
+        size += raw.nbytes
+    return size, len(buffers), gen
+
+
+def _remove_stale(entry: Path, gen: Optional[str]):
+    """Remove the pickle5 files of other generations. Readers that already
+    have them open or mapped keep their copy"""
+    for fp in entry.iterdir():
+        if not fp.name.endswith((".bin", ".pickle")) or fp.name == _DATA_FILE:
+            continue
+        if gen and f"-{gen}" in fp.name:
+            continue
+        fp.unlink(missing_ok=True)
+
+
+def _mmap_buffer(fpath: Path):
+    with open(fpath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        # copy on write: pages are shared with other readers, but
+        # changes made to the restored objects are private.
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+
+def _restore_pickle5(entry: Path, meta: Dict[str, Any]):
+    gen = meta.get("generation")
+    buffers = [
+        _mmap_buffer(_buffer_path(entry, ix, gen)) for ix in range(meta["buffers"])
+    ]
+    with open(_pickle5_path(entry, gen), "rb") as f:
+        return pickle.loads(f.read(), buffers=buffers)
+
+
+def _import_parquet():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("pyarrow is required by the parquet serializer") from e
+    return pa, pq
 
-def _write_fileserver(name, data, ctx: SimpleExecCtx):
-    urlpath = f"{settings.EXT_KV_LOCAL_ROOT}/cache/{ctx.wfid}.{ctx.execid}.{name}"
-    metapath = f"{settings.EXT_KV_LOCAL_ROOT}/cache/{ctx.wfid}.{ctx.execid}.{name}.json"
-    blob = cloudpickle.dumps(data)
-    rsp = httpx.put(urlpath, content=blob)
-    rsp2 = httpx.put(metapath, json=asdict(ctx))
-    if rsp.status_code > 202 and rsp2.status_code > 202:
-        logger.warning("CACHE: writing to fileserver failed %s", urlpath)
+
+def _is_dataframe(data) -> bool:
+    _type = type(data)
+    return _type.__name__ == "DataFrame" and _type.__module__.startswith("pandas")
+
+
+def _write_parquet(entry: Path, data, conf: CacheConfig) -> int:
+    pa, pq = _import_parquet()
+    fpath = entry / _FRAME_FILE
+    tmp = fpath.with_name(f"{fpath.name}.{os.getpid()}.tmp")
+    pq.write_table(
+        pa.Table.from_pandas(data), str(tmp), row_group_size=conf.row_group_size
+    )
+    os.replace(tmp, fpath)
+    return fpath.stat().st_size
+
+
+def _restore_parquet(entry: Path, conf: CacheConfig):
+    _, pq = _import_parquet()
+    table = pq.read_table(
+        str(entry / _FRAME_FILE), columns=conf.columns, filters=conf.filters
+    )
+    return table.to_pandas()
+
+
+def _write_pickle(key, data, conf: CacheConfig) -> Dict[str, Any]:
+    entry = _entry_dir(key, conf)
+    entry.mkdir(parents=True, exist_ok=True)
+    fpath = entry / _DATA_FILE
+    serializer = conf.serializer
+    buffers = 0
+    gen = None
+    if serializer == "parquet" and _is_dataframe(data):
+        fpath = entry / _FRAME_FILE
+        size = _write_parquet(entry, data, conf)
+    elif serializer == "pickle5":
+        size, buffers, gen = _write_pickle5(entry, data)
+        fpath = _pickle5_path(entry, gen)
     else:
-        logger.debug("CACHE: wrote to fileserver %s", urlpath)
+        serializer = "pickle"
+        blob = cloudpickle.dumps(data)
+        _atomic_write(fpath, blob)
+        size = len(blob)
+    logger.debug("CACHE: Wrote to %s", fpath)
+    meta = _build_meta(key, conf, size=size)
+    meta["serializer"] = serializer
+    meta["buffers"] = buffers
+    if gen:
+        meta["generation"] = gen
+    # meta is written last, an entry without meta is not valid
+    _atomic_write(entry / _META_FILE, json.dumps(meta).encode("utf-8"))
+    _remove_stale(entry, gen)
+    evict_local(conf.cache_dir, conf.max_bytes, conf.max_entries)
+    return meta
+
+
+def _restore_pickle(key, conf: CacheConfig) -> Tuple[Any, Optional[Dict[str, Any]]]:
+    entry = _entry_dir(key, conf)
+    fpath = entry / _DATA_FILE
+    metapath = entry / _META_FILE
+    try:
+        with open(metapath, "r", encoding="utf-8") as f:
+            meta = json.loads(f.read())
+        if meta.get("serializer") == "pickle5":
+            fpath = _pickle5_path(entry, meta.get("generation"))
+            data = _restore_pickle5(entry, meta)
+        elif meta.get("serializer") == "parquet":
+            fpath = entry / _FRAME_FILE
+            data = _restore_parquet(entry, conf)
+        else:
+            with open(fpath, "rb") as f:
+                data = cloudpickle.load(f)
+        logger.debug("CACHE: Reading from %s", fpath)
+        meta.setdefault("size", fpath.stat().st_size)
+        # mark as recently used for the LRU policy
+        os.utime(metapath)
+        return data, meta
+    except (EOFError, FileNotFoundError, json.JSONDecodeError):
+        return None, None
+
+
+def get_http_client() -> httpx.Client:
+    """A client shared by the process, so connections are kept alive
+    between calls"""
+    global _http_client
+    if _http_client is None:
+        with _http_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(
+                    timeout=defaults.CLIENT_TIMEOUT,
+                    limits=httpx.Limits(max_keepalive_connections=10),
+                )
+    return _http_client
+
+
+def _fileserver_url(key) -> str:
+    root = settings.EXT_KV_FILE_URL or settings.EXT_KV_LOCAL_ROOT
+    return f"{root}/cache/{key}"
 
 
-def _restore_fileserver(name, ctx: SimpleExecCtx):
-    urlpath = f"{settings.EXT_KV_LOCAL_ROOT}/cache/{ctx.wfid}.{ctx.execid}.{name}"
-    metapath = f"{settings.EXT_KV_LOCAL_ROOT}/cache/{ctx.wfid}.{ctx.execid}.{name}.json"
+def pack_blob(meta: Dict[str, Any], payload: bytes) -> bytes:
+    """Metadata and payload framed together in one blob"""
+    jmeta = json.dumps(meta).encode("utf-8")
+    return b"".join([_BLOB_HEADER.pack(_BLOB_MAGIC, len(jmeta)), jmeta, payload])
+
+
+def unpack_blob(blob: bytes) -> Tuple[Dict[str, Any], memoryview]:
+    magic, meta_len = _BLOB_HEADER.unpack_from(blob)
+    if magic != _BLOB_MAGIC:
+        raise ValueError("Invalid cache blob")
+    start = _BLOB_HEADER.size
+    meta = json.loads(blob[start : start + meta_len])
+    return meta, memoryview(blob)[start + meta_len :]
+
+
+def _write_fileserver(key, data, conf: CacheConfig) -> Optional[Dict[str, Any]]:
+    """It returns None if the value wasn't written"""
+    urlpath = _fileserver_url(key)
+    payload = cloudpickle.dumps(data)
+    meta = _build_meta(key, conf, size=len(payload))
+    try:
+        rsp = get_http_client().put(urlpath, content=pack_blob(meta, payload))
+    except httpx.HTTPError as e:
+        logger.warning("CACHE: writing to fileserver failed %s: %s", urlpath, e)
+        return None
+    if rsp.status_code not in (200, 201, 204):
+        logger.warning(
+            "CACHE: writing to fileserver failed %s with status %s",
+            urlpath,
+            rsp.status_code,
+        )
+        return None
+    logger.debug("CACHE: wrote to fileserver %s", urlpath)
+    return meta
+
+
+def _restore_fileserver(key, conf: CacheConfig):
+    urlpath = _fileserver_url(key)
     data = None
     meta = None
 
     try:
-        rsp = httpx.get(urlpath)
-        rsp2 = httpx.get(metapath)
-        if rsp.status_code == 200 and rsp2.status_code == 200:
-            data = cloudpickle.loads(rsp.content)
-            meta = rsp2.json()
+        rsp = get_http_client().get(urlpath)
+        if rsp.status_code == 200:
+            meta, payload = unpack_blob(rsp.content)
+            data = cloudpickle.loads(payload)
+            meta.setdefault("size", len(payload))
             logger.debug("CACHE: Reading from fileserver %s", urlpath)
     except Exception as e:
         logger.warning(e)
+        meta = None
     return data, meta
 
 
 def is_valid_date(cache_dt: str, valid_for_min: int) -> bool:
     dt = datetime.fromisoformat(cache_dt)
     now = datetime.utcnow()
-    elapsed = round((now - dt).seconds / 60)
+    elapsed = (now - dt).total_seconds() / 60
     if elapsed > valid_for_min:
         return False
     return True
 
 
-def cache_manager_write(data, conf: CacheConfig):
+def is_valid_meta(meta: Dict[str, Any], valid_for_min: int) -> bool:
+    """Entries written by older versions only have execution_dt"""
+    cache_dt = meta.get("created_at") or meta.get("execution_dt")
+    if not cache_dt:
+        return False
+    return is_valid_date(cache_dt, valid_for_min)
+
+
+def _memory_tier(conf: CacheConfig):
+    if conf.memory or conf.strategy == "memory":
+        return get_memory_cache(max_bytes=conf.memory_max_bytes)
+    return None
+
+
+def _memory_key(key: str, conf: CacheConfig) -> str:
+    """The same key in another strategy or location is another value.
+    Projected frames are stored apart from the full value"""
+    location = ""
+    if conf.strategy == "local":
+        location = str(conf.cache_dir)
+    elif conf.strategy == "fileserver":
+        location = _fileserver_url("")
+    mkey = f"{conf.strategy}:{location}:{key}"
+    if conf.projection:
+        return f"{mkey}.{hash_value((conf.columns, conf.filters))[:16]}"
+    return mkey
+
+
+def _memory_size(data) -> int:
+    """Approximated size of data for the memory tier. Arrays and frames
+    aren't serialized, other values are pickled with their buffers out of
+    band, so the buffers are counted but not copied."""
+    if _is_dataframe(data):
+        return int(data.memory_usage(deep=True).sum())
+    nbytes = getattr(data, "nbytes", None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    buffers: List[pickle.PickleBuffer] = []
+    blob = cloudpickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    return len(blob) + sum(b.raw().nbytes for b in buffers)
+
+
+def cache_manager_write(key: str, data, conf: CacheConfig):
+    """Write-through: the value is written to the strategy and then to the
+    memory tier if enabled, only if the strategy wrote it"""
+    meta = None
     if conf.strategy == "local" and conf.ctx.wfid:
-        _write_pickle(conf.name, data, conf.ctx)
+        meta = _write_pickle(key, data, conf)
     elif conf.strategy == "fileserver" and conf.ctx.wfid:
-        _write_fileserver(conf.name, data, conf.ctx)
+        meta = _write_fileserver(key, data, conf)
+    elif conf.strategy == "memory" and conf.ctx.wfid:
+        meta = _build_meta(key, conf, size=_memory_size(data))
     else:
         logger.warning("CACHE: Invalid caching strategy %s", conf.strategy)
 
+    memory = _memory_tier(conf)
+    if memory is not None and meta and not conf.projection:
+        memory.put(_memory_key(key, conf), data, meta, size=meta["size"])
+
+
+def cache_manager_read(key: str, conf: CacheConfig):
+    """Read-through: if the memory tier is enabled it's looked up first,
+    values found in the strategy are promoted to the memory tier."""
+    memory = _memory_tier(conf)
+    mkey = _memory_key(key, conf)
+    if memory is not None:
+        hit = memory.get(mkey)
+        if hit and is_valid_meta(hit[1], conf.valid_for_min):
+            return hit
+        if hit:
+            memory.delete(mkey)
 
-def cache_manager_read(conf: CacheConfig):
     data = None
     meta = None
     if conf.strategy == "local" and conf.ctx.wfid:
-        data, meta = _restore_pickle(conf.name, conf.ctx)
+        data, meta = _restore_pickle(key, conf)
     elif conf.strategy == "fileserver" and conf.ctx.wfid:
-        data, meta = _restore_fileserver(conf.name, conf.ctx)
+        data, meta = _restore_fileserver(key, conf)
+    elif conf.strategy == "memory":
+        pass
     else:
         logger.warning("CACHE: Invalid caching strategy %s", conf.strategy)
+
+    if memory is not None and meta:
+        memory.put(mkey, data, meta, size=meta.get("size", 0))
     return data, meta
 
 
+def _lookup(key: str, conf: CacheConfig) -> Tuple[bool, Any]:
+    data, meta = cache_manager_read(key, conf)
+    if meta and is_valid_meta(meta, conf.valid_for_min):
+        return True, data
+    return False, None
+
+
+def _store(key: str, data, conf: CacheConfig):
+    """Write a computed value and return it with the same projection
+    that a hit would have"""
+    cache_manager_write(key, data, conf)
+    if conf.projection and _is_dataframe(data):
+        projected, meta = cache_manager_read(key, conf)
+        if meta:
+            return projected
+    return data
+
+
+class SingleFlight:
+    """
+    Locks by key for the current process. Locks are created on demand and
+    removed when nobody is waiting for them. The same instance shouldn't be
+    used for threads and tasks.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, list] = {}
+        self._guard = threading.Lock()
+
+    def __len__(self):
+        return len(self._locks)
+
+    def _acquire_ref(self, key: str, factory):
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = [factory(), 0]
+                self._locks[key] = entry
+            entry[1] += 1
+            return entry[0]
+
+    def _release_ref(self, key: str):
+        with self._guard:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    @contextmanager
+    def lock(self, key: str):
+        _lock = self._acquire_ref(key, threading.Lock)
+        try:
+            with _lock:
+                yield
+        finally:
+            self._release_ref(key)
+
+    @asynccontextmanager
+    async def alock(self, key: str):
+        _lock = self._acquire_ref(key, asyncio.Lock)
+        try:
+            async with _lock:
+                yield
+        finally:
+            self._release_ref(key)
+
+
+_flights = SingleFlight()
+_async_flights = SingleFlight()
+
+
+def _get_redis(dsn: str) -> redis.Redis:
+    client = _redis_clients.get(dsn)
+    if client is None:
+        client = _redis_clients.setdefault(dsn, redis.Redis.from_url(dsn))
+    return client
+
+
+@contextmanager
+def redis_lock(key: str, conf: CacheConfig):
+    """Lock a key between processes. If the lock can't be acquired
+    the caller continues without it, at worst the value is computed twice."""
+    if not conf.lock_dsn:
+        yield
+        return
+    _lock = _get_redis(conf.lock_dsn).lock(
+        f"{_LOCK_PREFIX}{key}",
+        timeout=conf.lock_timeout,
+        blocking_timeout=conf.lock_timeout,
+    )
+    acquired = False
+    try:
+        acquired = _lock.acquire()
+    except redis.RedisError as e:
+        logger.warning("CACHE: redis lock failed for %s: %s", key, e)
+    try:
+        yield
+    finally:
+        if acquired:
+            try:
+                _lock.release()
+            except redis.RedisError:
+                # the lock expired while computing
+                logger.warning("CACHE: redis lock for %s was lost", key)
+
+
+@asynccontextmanager
+async def async_redis_lock(key: str, conf: CacheConfig):
+    """Async version of :func:`redis_lock`"""
+    if not conf.lock_dsn:
+        yield
+        return
+    # async clients are bound to the event loop, so it isn't shared
+    client = redis.asyncio.Redis.from_url(conf.lock_dsn)
+    _lock = client.lock(
+        f"{_LOCK_PREFIX}{key}",
+        timeout=conf.lock_timeout,
+        blocking_timeout=conf.lock_timeout,
+    )
+    acquired = False
+    try:
+        acquired = await _lock.acquire()
+    except redis.RedisError as e:
+        logger.warning("CACHE: redis lock failed for %s: %s", key, e)
+    try:
+        yield
+    finally:
+        if acquired:
+            try:
+                await _lock.release()
+            except redis.RedisError:
+                logger.warning("CACHE: redis lock for %s was lost", key)
+        await client.close()
+
+
 def frozen_result(
     name=None,
     wfid=None,
@@ -144,10 +729,69 @@ def frozen_result(
     valid_for_min=60,
     strategy="local",
     from_global: Optional[Dict[str, Any]] = None,
+    cache_dir: str = defaults.CACHE_LOCAL_DIR,
+    max_bytes: Optional[int] = defaults.CACHE_MAX_BYTES,
+    max_entries: Optional[int] = None,
+    memory: bool = False,
+    memory_max_bytes: int = defaults.CACHE_MEMORY_MAX_BYTES,
+    serializer: str = "pickle",
+    columns: Optional[List[str]] = None,
+    filters: Optional[List[Any]] = None,
+    row_group_size: Optional[int] = None,
+    single_flight: bool = True,
+    lock_dsn: Optional[str] = None,
+    lock_timeout: int = defaults.CACHE_LOCK_TIMEOUT,
 ):
+    """
+    Memoize the result of a function between executions of the same workflow.
+
+    The cache key is built from the wfid, the name of the function, a hash of
+    the source code of the function and a hash of the arguments of the call,
+    so the same value is reused between different executions of a workflow,
+    while changes in the code or in the arguments invalidate it.
+
+    :param name: by default the name of the function
+    :param wfid: workflow id, required if from_global is not provided
+    :param execid: execution id, only stored as metadata
+    :param valid_for_min: expiration of the cached values in minutes
+    :param strategy: "local", "fileserver" or "memory"
+    :param from_global: globals() of a notebook to get WFID, EXECUTIONID and NOW
+    :param cache_dir: folder used by the local strategy
+    :param max_bytes: size limit of the local strategy (LRU eviction)
+    :param max_entries: entries limit of the local strategy (LRU eviction)
+    :param memory: put a memory tier in front of the strategy, repeated calls
+    in the same process will return the same object, so it shouldn't be mutated.
+    :param memory_max_bytes: size limit of the memory tier (LRU eviction)
+    :param serializer: "pickle", "pickle5" or "parquet". With pickle5 and the local
+    strategy large buffers like numpy arrays are stored in their own files and
+    memory-mapped when restored, avoiding copies. With parquet, DataFrames are
+    stored in a columnar format.
+    :param columns: with parquet, only these columns are returned.
+    :param filters: with parquet, only rows matching these filters are returned,
+    it uses the pyarrow format: [("col", "=", "value")]
+    :param row_group_size: with parquet, max rows by row group.
+    :param single_flight: when a key is not cached, only one caller computes it,
+    the other threads (or tasks) wait for it and read the cached value.
+    :param lock_dsn: a redis url like redis://localhost:6379/0, if it's given the
+    single flight lock is shared between processes.
+    :param lock_timeout: seconds before the redis lock expires.
+
+    Coroutine functions are supported, in that case the decorated function is
+    also a coroutine function and cache reads and writes run in the default
+    executor.
+
+    The decorated function has two extra attributes:
+    `cache_key(*args, **kwargs)` returns the key of a call, and
+    `read_frame(*args, columns=None, filters=None, **kwargs)` returns a projection
+    of the value cached for a call with parquet, or None if it's not cached.
+    """
 
     if not wfid and not from_global:
         raise TypeError("wfid or global should be provided")
+    if serializer not in VALID_SERIALIZERS:
+        raise TypeError(f"Invalid serializer {serializer}")
+    if serializer == "pickle5" and sys.version_info < (3, 8):
+        raise TypeError("pickle5 serializer requires python 3.8 or greater")
 
     if from_global:
         ctx = build_ctx_global(from_global)
@@ -155,24 +799,88 @@ def frozen_result(
         ctx = build_ctx(wfid, execid)
 
     cache_conf = CacheConfig(
-        name=name, ctx=ctx, valid_for_min=valid_for_min, strategy=strategy
+        name=name,
+        ctx=ctx,
+        valid_for_min=valid_for_min,
+        strategy=strategy,
+        cache_dir=cache_dir,
+        max_bytes=max_bytes,
+        max_entries=max_entries,
+        memory=memory,
+        memory_max_bytes=memory_max_bytes,
+        serializer=serializer,
+        columns=columns,
+        filters=filters,
+        row_group_size=row_group_size,
+        single_flight=single_flight,
+        lock_dsn=lock_dsn,
+        lock_timeout=lock_timeout,
     )
 
     def decorate(func):
+        func_hash = func_fingerprint(func)
+        if not cache_conf.name:
+            cache_conf.name = func.__name__
+        try:
+            sig: Optional[inspect.Signature] = inspect.signature(func)
+        except (TypeError, ValueError):
+            # builtins without signature
+            sig = None
+
+        def cache_key(*args, **kwargs) -> str:
+            return build_cache_key(
+                cache_conf.ctx.wfid,
+                cache_conf.name,
+                func_hash,
+                hash_args(*bind_args(sig, args, kwargs)),
+            )
+
+        def read_frame(*args, columns=None, filters=None, **kwargs):
+            conf = replace(cache_conf, columns=columns, filters=filters)
+            result, meta = cache_manager_read(cache_key(*args, **kwargs), conf)
+            if meta and is_valid_meta(meta, conf.valid_for_min):
+                return result
+            return None
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if not cache_conf.name:
-                cache_conf.name = func.__name__
-
-            result, meta = cache_manager_read(cache_conf)
-            valid = False
-            if meta:
-                valid = is_valid_date(meta["execution_dt"], valid_for_min)
-            if not result or not valid:
-                result = func(*args, **kwargs)
-                cache_manager_write(result, cache_conf)
+            key = cache_key(*args, **kwargs)
+            hit, result = _lookup(key, cache_conf)
+            if hit:
+                return result
+            if not cache_conf.single_flight:
+                return _store(key, func(*args, **kwargs), cache_conf)
+
+            with _flights.lock(key), redis_lock(key, cache_conf):
+                # another caller could have computed it while waiting
+                hit, result = _lookup(key, cache_conf)
+                if not hit:
+                    result = _store(key, func(*args, **kwargs), cache_conf)
+            return result
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            key = cache_key(*args, **kwargs)
+            hit, result = await run_async(_lookup, key, cache_conf)
+            if hit:
+                return result
+            if not cache_conf.single_flight:
+                result = await func(*args, **kwargs)
+                return await run_async(_store, key, result, cache_conf)
+
+            async with _async_flights.alock(key):
+                async with async_redis_lock(key, cache_conf):
+                    hit, result = await run_async(_lookup, key, cache_conf)
+                    if not hit:
+                        result = await func(*args, **kwargs)
+                        result = await run_async(_store, key, result, cache_conf)
             return result
 
+        if inspect.iscoroutinefunction(func):
+            wrapper = async_wrapper
+
+        wrapper.cache_key = cache_key
+        wrapper.read_frame = read_frame
         return wrapper
 
     return decorate
@@ -0,0 +1,476 @@
+"""
+Content addressed layer over the KV stores.
+
+Values are stored once by their hash, and the keys only keep a reference
+to it. Using the same store, the layout is:
+
+    <prefix>/blobs/ab/abcd...      content of the value
+    <prefix>/refs/<key>            hash of the value of key
+    <prefix>/counts/abcd.../<kid>  one marker by key referencing the hash
+
+Markers are used instead of a counter because stores don't have an atomic
+increment; writing or deleting a marker never conflicts with other writers.
+When the last marker of a hash is deleted, the blob is deleted too.
+
+Writers create their marker before looking for the blob, and check again
+that the blob exists after writing the ref, sending it again if a
+concurrent delete removed it; deletes look for markers again right before
+removing the blob.
+
+Keys written directly in the underlying store, before enabling this layer,
+are still readable.
+"""
+import hashlib
+import tempfile
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import aiofiles.tempfile
+
+from labfunctions import defaults
+from labfunctions.utils import get_class, run_async
+
+from .kvspec import AsyncKVSpec, GenericKVSpec, KeyInfo, KeyReadError
+
+_HASH = "sha256"
+
+
+def hash_bytes(bdata: bytes) -> str:
+    return hashlib.new(_HASH, bdata).hexdigest()
+
+
+def hash_file(fpath: str) -> str:
+    h = hashlib.new(_HASH)
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(defaults.KV_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _key_id(key: str) -> str:
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class _Layout:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+
+    def blob(self, digest: str) -> str:
+        return f"{self.prefix}/blobs/{digest[:2]}/{digest}"
+
+    def ref(self, key: str) -> str:
+        return f"{self.prefix}/refs/{key}"
+
+    def counts(self, digest: str) -> str:
+        return f"{self.prefix}/counts/{digest}/"
+
+    def marker(self, digest: str, key: str) -> str:
+        return f"{self.counts(digest)}{_key_id(key)}"
+
+    def key_from_ref(self, ref: str) -> str:
+        return ref[len(self.ref("")) :]
+
+
+def _split_opts(client_opts: Dict[str, Any]) -> Tuple[str, str, Dict[str, Any]]:
+    opts = dict(client_opts)
+    store_class = opts.pop("store_class")
+    prefix = opts.pop("cas_prefix", defaults.KV_CAS_PREFIX)
+    return store_class, prefix, opts
+
+
+def _decode(ref: Union[bytes, str, None]) -> Optional[str]:
+    if ref is None:
+        return None
+    if isinstance(ref, bytes):
+        ref = ref.decode()
+    return ref.strip() or None
+
+
+class KVCas(GenericKVSpec):
+    """
+    Content addressed store over another :class:`GenericKVSpec`.
+
+    It can be created like any other store, the backend is given by the
+    "store_class" option and the other options are passed to it:
+
+        KVCas("bucket", {"store_class": "labfunctions.io.kv_local.KVLocal"})
+
+    or wrapping a store already created with :meth:`KVCas.wrap`.
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        store_class, prefix, opts = _split_opts(client_opts)
+        Class = get_class(store_class)
+        self._init(Class(bucket, opts), prefix)
+
+    def _init(self, store: GenericKVSpec, prefix: str):
+        self.store = store
+        self._bucket = store._bucket
+        self._opts = store._opts
+        self._layout = _Layout(prefix)
+
+    @classmethod
+    def wrap(cls, store: GenericKVSpec, prefix: str = defaults.KV_CAS_PREFIX):
+        obj = cls.__new__(cls)
+        obj._init(store, prefix)
+        return obj
+
+    def _get_ref(self, key: str) -> Optional[str]:
+        try:
+            return _decode(self.store.get(self._layout.ref(key)))
+        except KeyReadError:
+            return None
+
+    def _link(
+        self, key: str, digest: str, old: Optional[str], send: Callable[[], Any]
+    ) -> bool:
+        """Reference digest from key, send() writes the blob if it's missing,
+        returning False if it fails"""
+        marker = self._layout.marker(digest, key)
+        self.store.put(marker, b"")
+        try:
+            sent = self.has_blob(digest) or send() is not False
+        except Exception:
+            self.store.delete(marker)
+            raise
+        if not sent:
+            self.store.delete(marker)
+            return False
+        self.store.put(self._layout.ref(key), digest.encode())
+        # removed by the unlink of another key between the check and the ref
+        if not self.has_blob(digest) and send() is False:
+            return False
+        if old and old != digest:
+            self._unlink(key, old)
+        return True
+
+    def _unlink(self, key: str, digest: str):
+        self.store.delete(self._layout.marker(digest, key))
+        # markers are listed after deleting ours, right before the blob
+        if not self.store.list(self._layout.counts(digest)):
+            self.store.delete(self._layout.blob(digest))
+
+    def _target(self, key: str) -> str:
+        digest = self._get_ref(key)
+        if digest:
+            return self._layout.blob(digest)
+        return key
+
+    def refcount(self, digest: str) -> int:
+        return len(self.store.list(self._layout.counts(digest)))
+
+    def has_blob(self, digest: str) -> bool:
+        return self.store.exists(self._layout.blob(digest))
+
+    def put(self, key: str, bdata: bytes):
+        digest = hash_bytes(bdata)
+        old = self._get_ref(key)
+        if old == digest:
+            return True
+        return self._link(
+            key, digest, old, lambda: self.store.put(self._layout.blob(digest), bdata)
+        )
+
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
+        """The stream is spooled to a temp file to know its hash before
+        sending it"""
+        h = hashlib.new(_HASH)
+        with tempfile.TemporaryFile() as f:
+            for chunk in generator:
+                h.update(chunk)
+                f.write(chunk)
+            digest = h.hexdigest()
+            old = self._get_ref(key)
+            if old == digest:
+                return True
+
+            def send():
+                f.seek(0)
+                return self.store.put_stream(
+                    self._layout.blob(digest),
+                    iter(lambda: f.read(defaults.KV_CHUNK_SIZE), b""),
+                )
+
+            return self._link(key, digest, old, send)
+
+    def put_digest(self, key: str, digest: str) -> bool:
+        """Reference an existing blob from key without sending it.
+        It returns False if the blob doesn't exist."""
+        if not self.has_blob(digest):
+            return False
+        old = self._get_ref(key)
+        if old == digest:
+            return True
+        return self._link(key, digest, old, lambda: False)
+
+    def put_file(self, key: str, fpath: str) -> bool:
+        """Like put_stream but the file is read twice instead of copied,
+        and the blob is sent with the put_file of the store"""
+        digest = hash_file(fpath)
+        old = self._get_ref(key)
+        if old == digest:
+            return True
+        return self._link(
+            key,
+            digest,
+            old,
+            lambda: self.store.put_file(self._layout.blob(digest), fpath),
+        )
+
+    def get(self, key: str) -> Union[bytes, None]:
+        return self.store.get(self._target(key))
+
+    def get_file(self, key: str, fpath: str):
+        self.store.get_file(self._target(key), fpath)
+
+    def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        return self.store.get_range(self._target(key), start, end)
+
+    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+        for chunk in self.store.get_stream(self._target(key)):
+            yield chunk
+
+    def local_path(self, key: str) -> Union[str, None]:
+        return self.store.local_path(self._target(key))
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        info = self.store.stat(self._target(key))
+        return info._replace(key=key) if info else None
+
+    def etag(self, key: str) -> Union[str, None]:
+        """The hash of the value"""
+        digest = self._get_ref(key)
+        if digest:
+            return digest
+        return self.store.etag(key)
+
+    def exists(self, key: str) -> bool:
+        return self.store.exists(self._layout.ref(key)) or self.store.exists(key)
+
+    def delete(self, key: str):
+        """The value written before enabling this layer is deleted too"""
+        digest = self._get_ref(key)
+        if digest:
+            self.store.delete(self._layout.ref(key))
+            self._unlink(key, digest)
+        self.store.delete(key)
+
+    def list(self, prefix: str = "") -> List[str]:
+        refs = self.store.list(self._layout.ref(prefix))
+        keys = {self._layout.key_from_ref(r) for r in refs}
+        raw = self.store.list(prefix)
+        keys.update(k for k in raw if not k.startswith(f"{self._layout.prefix}/"))
+        return sorted(keys)
+
+    def scan(self, prefix: str = "") -> Iterator[KeyInfo]:
+        """The mtime is the one of the ref and the size the one of the blob.
+        Blobs could be shared between keys, each key counts the whole size."""
+        for info in self.store.scan(self._layout.ref(prefix)):
+            key = self._layout.key_from_ref(info.key)
+            digest = self._get_ref(key)
+            blob = self.store.stat(self._layout.blob(digest)) if digest else None
+            yield KeyInfo(key, blob.size if blob else None, info.mtime)
+        for info in self.store.scan(prefix):
+            if not info.key.startswith(f"{self._layout.prefix}/"):
+                yield info
+
+
+class AsyncKVCas(AsyncKVSpec):
+    """Async version of :class:`KVCas`"""
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        store_class, prefix, opts = _split_opts(client_opts)
+        Class = get_class(store_class)
+        self._init(Class(bucket, opts), prefix)
+
+    def _init(self, store: AsyncKVSpec, prefix: str):
+        self.store = store
+        self._bucket = store._bucket
+        self._opts = store._opts
+        self._layout = _Layout(prefix)
+
+    @classmethod
+    def wrap(cls, store: AsyncKVSpec, prefix: str = defaults.KV_CAS_PREFIX):
+        obj = cls.__new__(cls)
+        obj._init(store, prefix)
+        return obj
+
+    async def _get_ref(self, key: str) -> Optional[str]:
+        try:
+            return _decode(await self.store.get(self._layout.ref(key)))
+        except KeyReadError:
+            return None
+
+    async def _link(
+        self,
+        key: str,
+        digest: str,
+        old: Optional[str],
+        send: Callable[[], Awaitable[Any]],
+    ) -> bool:
+        """See :meth:`KVCas._link`"""
+        marker = self._layout.marker(digest, key)
+        await self.store.put(marker, b"")
+        try:
+            sent = await self.has_blob(digest) or await send() is not False
+        except Exception:
+            await self.store.delete(marker)
+            raise
+        if not sent:
+            await self.store.delete(marker)
+            return False
+        await self.store.put(self._layout.ref(key), digest.encode())
+        if not await self.has_blob(digest) and await send() is False:
+            return False
+        if old and old != digest:
+            await self._unlink(key, old)
+        return True
+
+    async def _unlink(self, key: str, digest: str):
+        await self.store.delete(self._layout.marker(digest, key))
+        if not await self.store.list(self._layout.counts(digest)):
+            await self.store.delete(self._layout.blob(digest))
+
+    async def _target(self, key: str) -> str:
+        digest = await self._get_ref(key)
+        if digest:
+            return self._layout.blob(digest)
+        return key
+
+    async def refcount(self, digest: str) -> int:
+        return len(await self.store.list(self._layout.counts(digest)))
+
+    async def has_blob(self, digest: str) -> bool:
+        return await self.store.exists(self._layout.blob(digest))
+
+    async def put(self, key: str, bdata: bytes):
+        digest = hash_bytes(bdata)
+        old = await self._get_ref(key)
+        if old == digest:
+            return True
+
+        async def send():
+            return await self.store.put(self._layout.blob(digest), bdata)
+
+        return await self._link(key, digest, old, send)
+
+    async def put_stream(
+        self, key: str, generator: Generator[bytes, None, None]
+    ) -> bool:
+        h = hashlib.new(_HASH)
+        async with aiofiles.tempfile.TemporaryFile() as f:
+            if hasattr(generator, "__aiter__"):
+                async for chunk in generator:
+                    h.update(chunk)
+                    await f.write(chunk)
+            else:
+                for chunk in generator:
+                    h.update(chunk)
+                    await f.write(chunk)
+            digest = h.hexdigest()
+            old = await self._get_ref(key)
+            if old == digest:
+                return True
+
+            async def send():
+                await f.seek(0)
+                return await self.store.put_stream(
+                    self._layout.blob(digest), _read_file(f)
+                )
+
+            return await self._link(key, digest, old, send)
+
+    async def put_digest(self, key: str, digest: str) -> bool:
+        """See :meth:`KVCas.put_digest`"""
+        if not await self.has_blob(digest):
+            return False
+        old = await self._get_ref(key)
+        if old == digest:
+            return True
+
+        async def send():
+            return False
+
+        return await self._link(key, digest, old, send)
+
+    async def put_file(self, key: str, fpath: str) -> bool:
+        """See :meth:`KVCas.put_file`"""
+        digest = await run_async(hash_file, fpath)
+        old = await self._get_ref(key)
+        if old == digest:
+            return True
+
+        async def send():
+            return await self.store.put_file(self._layout.blob(digest), fpath)
+
+        return await self._link(key, digest, old, send)
+
+    async def get(self, key: str) -> Union[bytes, str, None]:
+        return await self.store.get(await self._target(key))
+
+    async def get_file(self, key: str, fpath: str):
+        await self.store.get_file(await self._target(key), fpath)
+
+    async def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        return await self.store.get_range(await self._target(key), start, end)
+
+    async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
+        async for chunk in self.store.get_stream(await self._target(key)):
+            yield chunk
+
+    def local_path(self, key: str) -> Union[str, None]:
+        """The path of the blob of key. Refs are only read if they are
+        local files too, this method is sync."""
+        ref = self.store.local_path(self._layout.ref(key))
+        if not ref:
+            return self.store.local_path(key)
+        try:
+            with open(ref, "rb") as f:
+                digest = _decode(f.read())
+        except FileNotFoundError:
+            return None
+        if not digest:
+            return None
+        return self.store.local_path(self._layout.blob(digest))
+
+    async def exists(self, key: str) -> bool:
+        if await self.store.exists(self._layout.ref(key)):
+            return True
+        return await self.store.exists(key)
+
+    async def delete(self, key: str):
+        digest = await self._get_ref(key)
+        if digest:
+            await self.store.delete(self._layout.ref(key))
+            await self._unlink(key, digest)
+        await self.store.delete(key)
+
+    async def list(self, prefix: str = "") -> List[str]:
+        refs = await self.store.list(self._layout.ref(prefix))
+        keys = {self._layout.key_from_ref(r) for r in refs}
+        raw = await self.store.list(prefix)
+        keys.update(k for k in raw if not k.startswith(f"{self._layout.prefix}/"))
+        return sorted(keys)
+
+
+async def _read_file(f) -> AsyncGenerator[bytes, None]:
+    while True:
+        chunk = await f.read(defaults.KV_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
@@ -0,0 +1,268 @@
+"""
+Read-through cache in the local disk for any :class:`GenericKVSpec`.
+
+It's used by the agents to avoid downloading the same bundles again and
+again. Before using an entry, the etag of the key is asked to the store
+(a HEAD request for the fileserver, a stat for local files, the hash of the
+content for :class:`labfunctions.io.kv_cas.KVCas`), if it changed the value
+is downloaded again. Stores without etag support are not cached.
+
+Entries are evicted in LRU order when the total size is over max_bytes.
+The size is counted as entries are added, the folder is only walked when
+the count goes over max_bytes or when it's older than KV_CACHE_SCAN_EVERY
+seconds, because other processes could share the folder.
+
+Only the builds of the agents use it (see
+:func:`labfunctions.runtimes.builder.builder_exec`): executions run from
+the image of their runtime and don't read the projects store.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from labfunctions import defaults
+from labfunctions.utils import get_class, mkdir_p
+
+from .kv_local import seek_range
+from .kvspec import GenericKVSpec, KeyInfo
+
+logger = logging.getLogger(__name__)
+
+_TMP_SUFFIX = ".tmp"
+
+
+def evict_lru(cache_dir: str, max_bytes: int) -> int:
+    """Remove the least recently used entries until the total size
+    is below max_bytes. It returns the total size left."""
+    entries = []
+    total = 0
+    for meta in Path(cache_dir).glob("*/*.json"):
+        data = meta.with_suffix(".data")
+        try:
+            size = data.stat().st_size
+            entries.append((meta.stat().st_mtime, size, meta, data))
+        except FileNotFoundError:
+            continue
+        total += size
+
+    freed = 0
+    for _, size, meta, data in sorted(entries, key=lambda e: e[0]):
+        if total - freed <= max_bytes:
+            break
+        for fp in (meta, data):
+            try:
+                fp.unlink()
+            except FileNotFoundError:
+                pass
+        freed += size
+    return total - freed
+
+
+class KVDiskCache(GenericKVSpec):
+    """
+    Like :class:`labfunctions.io.kv_cas.KVCas` it could be created by
+    class path, with the "store_class" option, or with :meth:`wrap`.
+
+    Options: cache_dir and cache_max_bytes, others are passed to the store.
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        opts = dict(client_opts)
+        Class = get_class(opts.pop("store_class"))
+        cache_dir = opts.pop("cache_dir", defaults.KV_CACHE_DIR)
+        max_bytes = opts.pop("cache_max_bytes", defaults.KV_CACHE_MAX_BYTES)
+        self._init(Class(bucket, opts), cache_dir, max_bytes)
+
+    def _init(self, store: GenericKVSpec, cache_dir: str, max_bytes: int):
+        self.store = store
+        self._bucket = store._bucket
+        self._opts = store._opts
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # size of cache_dir when it was walked plus the entries added since
+        self._total: Optional[int] = None
+        self._scanned_at = 0.0
+        mkdir_p(cache_dir)
+
+    @classmethod
+    def wrap(
+        cls,
+        store: GenericKVSpec,
+        cache_dir: str = defaults.KV_CACHE_DIR,
+        max_bytes: int = defaults.KV_CACHE_MAX_BYTES,
+    ) -> "KVDiskCache":
+        obj = cls.__new__(cls)
+        obj._init(store, cache_dir, max_bytes)
+        return obj
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        h = hashlib.sha1(f"{self._bucket}/{key}".encode()).hexdigest()
+        base = Path(self.cache_dir) / h[:2] / h
+        return base.with_suffix(".data"), base.with_suffix(".json")
+
+    def _lookup(self, key: str) -> Tuple[Optional[str], Optional[Path]]:
+        """It returns the current etag of the key and the cached file
+        if it's still valid"""
+        etag = self.store.etag(key)
+        if etag is None:
+            return None, None
+        data, meta = self._paths(key)
+        try:
+            with open(meta, "r") as f:
+                cached = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return etag, None
+        if cached.get("etag") != etag or not data.is_file():
+            return etag, None
+        os.utime(meta)
+        return etag, data
+
+    def _store_entry(self, key: str, etag: str, chunks) -> Generator[bytes, None, None]:
+        """Write chunks to the cache while they are yielded, the entry is
+        only added if all the chunks were consumed. Values bigger than
+        max_bytes are streamed without being written"""
+        data, meta = self._paths(key)
+        mkdir_p(data.parent)
+        tmp = data.with_suffix(f".{uuid.uuid4().hex[:8]}{_TMP_SUFFIX}")
+        f: Optional[IO[bytes]] = open(tmp, "wb")
+        completed = False
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if f and size > self.max_bytes:
+                    f.close()
+                    f = None
+                    tmp.unlink()
+                if f:
+                    f.write(chunk)
+                yield chunk
+            if f:
+                f.close()
+                f = None
+                os.replace(tmp, data)
+                with open(meta, "w") as fmeta:
+                    fmeta.write(json.dumps({"key": key, "etag": etag}))
+                completed = True
+        finally:
+            if f:
+                f.close()
+            if not completed and tmp.exists():
+                tmp.unlink()
+        if completed:
+            self._account(size)
+
+    def _account(self, size: int):
+        now = time.time()
+        if self._total is not None and (
+            now - self._scanned_at < defaults.KV_CACHE_SCAN_EVERY
+        ):
+            self._total += size
+            if self._total <= self.max_bytes:
+                return
+        self._total = evict_lru(self.cache_dir, self.max_bytes)
+        self._scanned_at = now
+
+    def _too_big(self, key: str) -> bool:
+        info = self.store.stat(key)
+        return bool(info and info.size is not None and info.size > self.max_bytes)
+
+    def invalidate(self, key: str):
+        for fp in self._paths(key):
+            try:
+                fp.unlink()
+            except FileNotFoundError:
+                pass
+
+    def put(self, key: str, bdata: bytes):
+        self.invalidate(key)
+        return self.store.put(key, bdata)
+
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
+        self.invalidate(key)
+        return self.store.put_stream(key, generator)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        etag, fp = self._lookup(key)
+        if fp:
+            return fp.read_bytes()
+        value = self.store.get(key)
+        if etag and value is not None:
+            for _ in self._store_entry(key, etag, [value]):
+                pass
+        return value
+
+    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+        etag, fp = self._lookup(key)
+        if fp:
+            with open(fp, "rb") as f:
+                while True:
+                    chunk = f.read(defaults.KV_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            return
+        chunks = self.store.get_stream(key)
+        if etag:
+            chunks = self._store_entry(key, etag, chunks)
+        for chunk in chunks:
+            yield chunk
+
+    def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        """Ranges are read from the cache but they don't fill it"""
+        _, fp = self._lookup(key)
+        if fp is None:
+            return self.store.get_range(key, start, end)
+        with open(fp, "rb") as f:
+            offset, length = seek_range(os.fstat(f.fileno()).st_size, start, end)
+            f.seek(offset)
+            return f.read(length)
+
+    def local_path(self, key: str) -> Union[str, None]:
+        """The cached file, it's downloaded if needed. Values bigger than
+        max_bytes are not downloaded, only the path of the store is
+        returned, if it has one"""
+        etag, fp = self._lookup(key)
+        if fp is None and etag and not self._too_big(key):
+            for _ in self._store_entry(key, etag, self.store.get_stream(key)):
+                pass
+            fp, _ = self._paths(key)
+        if fp and fp.is_file():
+            return str(fp)
+        return self.store.local_path(key)
+
+    def etag(self, key: str) -> Union[str, None]:
+        return self.store.etag(key)
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        return self.store.stat(key)
+
+    def exists(self, key: str) -> bool:
+        return self.store.exists(key)
+
+    def delete(self, key: str):
+        self.invalidate(key)
+        self.store.delete(key)
+
+    def list(self, prefix: str = "") -> List[str]:
+        return self.store.list(prefix)
+
+    def scan(self, prefix: str = "") -> Iterator[KeyInfo]:
+        return self.store.scan(prefix)
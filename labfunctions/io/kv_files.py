@@ -1,86 +1,288 @@
-from typing import Any, AsyncGenerator, Dict, Generator, Union
+from email.utils import parsedate_to_datetime
+from typing import (
+    Any,
+    AsyncGenerator,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import httpx
 
-from .kvspec import AsyncKVSpec, GenericKVSpec
+from .kv_multipart import download_parts, multipart_opts
+from .kvspec import (
+    AsyncKVSpec,
+    GenericKVSpec,
+    KeyInfo,
+    KeyReadError,
+    KeyWriteError,
+    range_slice,
+)
+
+# nginx answers 201 for new files and 204 when a file is replaced
+_PUT_OK = (200, 201, 204)
+
+
+def _index_url(url: str, folder: str) -> str:
+    return f"{url}/{folder}/" if folder else f"{url}/"
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _entry_info(key: str, entry: Dict[str, Any]) -> KeyInfo:
+    """nginx gives the mtime in the format of http dates"""
+    return KeyInfo(key, entry.get("size"), _http_date(entry.get("mtime")))
+
+
+def _head_info(key: str, r: httpx.Response) -> Union[KeyInfo, None]:
+    if r.status_code != 200:
+        return None
+    size = r.headers.get("content-length")
+    return KeyInfo(
+        key,
+        int(size) if size is not None else None,
+        _http_date(r.headers.get("last-modified")),
+    )
+
+
+def _parse_index(
+    folder: str, entries: List[Dict[str, Any]], prefix: str
+) -> Tuple[List[KeyInfo], List[str]]:
+    """From a nginx autoindex (json format) response it returns
+    the keys and the folders to walk that match the prefix"""
+    keys, folders = [], []
+    for entry in entries:
+        key = f"{folder}/{entry['name']}" if folder else entry["name"]
+        if entry.get("type") == "directory":
+            if key.startswith(prefix):
+                folders.append(key)
+        elif key.startswith(prefix):
+            keys.append(_entry_info(key, entry))
+    return keys, folders
+
+
+def _start_folder(prefix: str) -> str:
+    return prefix.rsplit("/", 1)[0] if "/" in prefix else ""
+
+
+def range_header(start: int, end: Optional[int] = None) -> Dict[str, str]:
+    if start < 0:
+        return {"Range": f"bytes={start}"}
+    if end is None:
+        return {"Range": f"bytes={start}-"}
+    return {"Range": f"bytes={start}-{end}"}
+
+
+def _range_content(
+    r: httpx.Response, start: int, end: Optional[int]
+) -> Union[bytes, None]:
+    if r.status_code == 206:
+        return r.content
+    if r.status_code == 200:
+        # the server ignored the range
+        return range_slice(r.content, start, end)
+    if r.status_code == 416:
+        return b""
+    return None
+
+
+def client_kwargs(opts: Dict[str, Any], concurrency: int) -> Dict[str, Any]:
+    """Options shared by the sync and async clients.
+    http2 requires the h2 package (pip install httpx[http2])"""
+    return dict(
+        timeout=opts.get("timeout", 60),
+        http2=opts.get("http2", False),
+        limits=httpx.Limits(
+            max_connections=opts.get("max_connections", 100),
+            max_keepalive_connections=concurrency,
+        ),
+    )
 
 
 class KVFiles(GenericKVSpec):
+    """
+    KV store backed by a fileserver like nginx with the dav module.
+
+    A client is kept by instance, so connections are reused between calls.
+    Options: url, timeout, concurrency, max_connections and http2.
+    For :meth:`get_file`: part_size, multipart_threshold and part_retries.
+    """
+
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
+        self._client = httpx.Client(**client_kwargs(client_opts, self.concurrency))
 
     @property
     def url(self):
         return f"{self._opts['url']}/{self._bucket}"
 
+    def close(self):
+        self._client.close()
+
     def put(self, key: str, bdata: bytes):
-        ts = self._opts.get("timeout", 60)
-        with httpx.Client(timeout=ts) as client:
-            r = client.put(f"{self.url}/{key}", content=bdata)
-        if r.status_code == 201:
-            return True
-        return False
+        r = self._client.put(f"{self.url}/{key}", content=bdata)
+        return r.status_code in _PUT_OK
 
     def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
-        ts = self._opts.get("timeout", 60)
-        with httpx.Client(timeout=ts) as client:
-            r = client.put(f"{self.url}/{key}", content=generator())
-        if r.status_code == 201:
-            return True
-        return False
+        r = self._client.put(f"{self.url}/{key}", content=generator)
+        return r.status_code in _PUT_OK
 
     def get(self, key: str) -> Union[bytes, None]:
-        with httpx.Client() as client:
-            r = client.get(f"{self.url}/{key}")
+        r = self._client.get(f"{self.url}/{key}")
         if r.status_code == 200:
             return r.content
         return None
 
+    def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        r = self._client.get(f"{self.url}/{key}", headers=range_header(start, end))
+        return _range_content(r, start, end)
+
     def get_stream(self, key: str) -> Generator[bytes, None, None]:
+        with self._client.stream("GET", f"{self.url}/{key}") as r:
+            for raw in r.iter_raw():
+                yield raw
+
+    def etag(self, key: str) -> Union[str, None]:
+        r = self._client.head(f"{self.url}/{key}")
+        if r.status_code != 200:
+            return None
+        return r.headers.get("etag")
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        return _head_info(key, self._client.head(f"{self.url}/{key}"))
+
+    def get_file(self, key: str, fpath: str):
+        """Big values are downloaded by parts with ranged GETs in parallel,
+        see labfunctions.io.kv_multipart"""
+        part_size, threshold, retries = multipart_opts(self._opts)
+        r = self._client.head(f"{self.url}/{key}")
+        info = _head_info(key, r)
+        if info is None:
+            raise KeyReadError(self._bucket, key, f"status {r.status_code}")
+        if info.size is None or info.size <= threshold:
+            return super().get_file(key, fpath)
+        download_parts(
+            self,
+            key,
+            fpath,
+            info,
+            part_size=part_size,
+            retries=retries,
+            etag=r.headers.get("etag"),
+        )
+
+    def exists(self, key: str) -> bool:
+        r = self._client.head(f"{self.url}/{key}")
+        return r.status_code == 200
+
+    def delete(self, key: str):
+        r = self._client.delete(f"{self.url}/{key}")
+        if r.status_code not in (200, 204, 404):
+            raise KeyWriteError(self._bucket, key, f"status {r.status_code}")
+
+    def list(self, prefix: str = "") -> List[str]:
+        """It relies on the autoindex module of nginx in json format"""
+        return sorted(info.key for info in self.scan(prefix))
 
-        with httpx.Client() as client:
-            with client.stream("GET", f"{self.url}/{key}") as r:
-                for raw in r.iter_raw():
-                    yield raw
+    def scan(self, prefix: str = "") -> Iterator[KeyInfo]:
+        """Keys are yielded folder by folder while the index is walked"""
+        pending = [_start_folder(prefix)]
+        while pending:
+            folder = pending.pop()
+            r = self._client.get(_index_url(self.url, folder))
+            if r.status_code != 200:
+                continue
+            infos, folders = _parse_index(folder, r.json(), prefix)
+            for info in infos:
+                yield info
+            pending.extend(folders)
 
 
 class AsyncKVFiles(AsyncKVSpec):
+    """Async version of :class:`KVFiles`. The client is created on the first
+    call, the instance shouldn't be shared between event loops."""
+
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
+        self._client: Optional[httpx.AsyncClient] = None
 
     @property
     def url(self):
         return f"{self._opts['url']}/{self._bucket}"
 
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                **client_kwargs(self._opts, self.concurrency)
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
     async def put(self, key: str, bdata: bytes):
-        async with httpx.AsyncClient() as client:
-            r = await client.put(f"{self.url}/{key}", content=bdata)
-            if r.status_code == 201:
-                return True
-        return False
+        r = await self.client.put(f"{self.url}/{key}", content=bdata)
+        return r.status_code in _PUT_OK
 
     async def put_stream(
         self, key: str, generator: Generator[bytes, None, None]
     ) -> bool:
-        ts = self._opts.get("timeout", 60)
-        async with httpx.AsyncClient(timeout=ts) as client:
-            r = await client.put(f"{self.url}/{key}", content=generator)
-            if r.status_code == 201:
-                return True
-        return False
+        r = await self.client.put(f"{self.url}/{key}", content=generator)
+        return r.status_code in _PUT_OK
 
     async def get(self, key: str) -> Union[bytes, None]:
-        ts = self._opts.get("timeout", 60)
-        async with httpx.AsyncClient(timeout=ts) as client:
-            r = await client.get(f"{self.url}/{key}")
+        r = await self.client.get(f"{self.url}/{key}")
+        if r.status_code == 200:
             return r.content
+        return None
+
+    async def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        r = await self.client.get(f"{self.url}/{key}", headers=range_header(start, end))
+        return _range_content(r, start, end)
 
     async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
-        u = f"{self.url}/{key}"
-        ts = self._opts.get("timeout", 60)
-        async with httpx.AsyncClient(timeout=ts) as client:
-            async with client.stream("GET", u) as r:
-                async for chunk in r.aiter_bytes():
-                    yield chunk
+        async with self.client.stream("GET", f"{self.url}/{key}") as r:
+            async for chunk in r.aiter_bytes():
+                yield chunk
+
+    async def exists(self, key: str) -> bool:
+        r = await self.client.head(f"{self.url}/{key}")
+        return r.status_code == 200
+
+    async def delete(self, key: str):
+        r = await self.client.delete(f"{self.url}/{key}")
+        if r.status_code not in (200, 204, 404):
+            raise KeyWriteError(self._bucket, key, f"status {r.status_code}")
+
+    async def list(self, prefix: str = "") -> List[str]:
+        keys: List[str] = []
+        pending = [_start_folder(prefix)]
+        while pending:
+            folder = pending.pop()
+            r = await self.client.get(_index_url(self.url, folder))
+            if r.status_code != 200:
+                continue
+            infos, folders = _parse_index(folder, r.json(), prefix)
+            keys.extend(info.key for info in infos)
+            pending.extend(folders)
+        return sorted(keys)
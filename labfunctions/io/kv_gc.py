@@ -0,0 +1,169 @@
+"""
+Retention of the files of the projects store.
+
+Old bundles (under :func:`labfunctions.runtimes.context.build_upload_uri`)
+and notebook outputs (under outputs/ok|errors/<day>) are never deleted by
+the server. :class:`KVCollector` applies a list of
+:class:`labfunctions.types.storage.RetentionRule` to the keys of a project:
+
+    RetentionRule(prefix="uploads", keep_last=5)
+    RetentionRule(prefix="outputs", keep_days=30)
+    RetentionRule(projectid="important*", prefix="outputs", keep_days=365)
+
+When many rules match a key, the one with the longest prefix wins, then
+the one naming the project instead of a pattern.
+
+Keys are walked with :meth:`GenericKVSpec.scan`, one project at a time,
+and expired keys are deleted in batches of batch_size while walking. Only
+the keys of rules with keep_last are kept in memory until the end of the
+walk, to be sorted.
+"""
+import bisect
+import logging
+import re
+import time
+from datetime import datetime, timezone
+from fnmatch import fnmatch
+from typing import Dict, List, Optional, Tuple
+
+from labfunctions import defaults
+from labfunctions.types.storage import KVUsage, RetentionRule
+
+from .kvspec import GenericKVSpec, KeyInfo
+
+logger = logging.getLogger(__name__)
+
+# outputs are stored by day, see labfunctions.notebooks.context
+_DAY_RE = re.compile(r"(?:^|/)(\d{8})(?:/|$)")
+
+
+def match_rule(
+    rules: List[RetentionRule], projectid: str, path: str
+) -> Optional[RetentionRule]:
+    """The rule for a path relative to the project folder"""
+    best: Optional[Tuple[Tuple[int, bool], RetentionRule]] = None
+    for rule in rules:
+        prefix = rule.prefix.strip("/")
+        if not fnmatch(projectid, rule.projectid):
+            continue
+        if prefix and path != prefix and not path.startswith(f"{prefix}/"):
+            continue
+        rank = (len(prefix), rule.projectid == projectid)
+        if best is None or rank > best[0]:
+            best = (rank, rule)
+    return best[1] if best else None
+
+
+def key_age(info: KeyInfo, now: float) -> Optional[float]:
+    """Age in days, from the mtime or from a day folder in the key"""
+    if info.mtime is not None:
+        return (now - info.mtime) / 86400
+    m = _DAY_RE.search(info.key)
+    if m:
+        try:
+            day = datetime.strptime(m.group(1), "%Y%m%d")
+        except ValueError:
+            return None
+        return (now - day.replace(tzinfo=timezone.utc).timestamp()) / 86400
+    return None
+
+
+def version_group(path: str) -> str:
+    """'uploads/main.v1.zip' and 'uploads/main.v2.zip' are versions
+    of 'uploads/main'"""
+    folder, _, name = path.rpartition("/")
+    return f"{folder}/{name.split('.', 1)[0]}"
+
+
+def next_projects(
+    projects: List[str], cursor: Optional[str], max_projects: Optional[int]
+) -> List[str]:
+    """Projects of this run, after the cursor (the last project of the
+    previous run). It starts again from the first one at the end."""
+    projects = sorted(set(projects))
+    if not max_projects:
+        return projects
+    start = bisect.bisect_right(projects, cursor) if cursor else 0
+    if start >= len(projects):
+        start = 0
+    return projects[start : start + max_projects]
+
+
+class KVCollector:
+    """
+    :param kv: the projects store, sync version.
+    :param rules: keys without rule are only counted.
+    :param batch_size: keys by :meth:`GenericKVSpec.delete_many` call.
+    :param dry_run: nothing is deleted, but the keys that would be deleted
+    are counted as deleted in the usage.
+    """
+
+    def __init__(
+        self,
+        kv: GenericKVSpec,
+        rules: List[RetentionRule],
+        *,
+        batch_size: int = defaults.KV_GC_BATCH_SIZE,
+        dry_run: bool = False,
+        now: Optional[float] = None,
+    ):
+        self.kv = kv
+        self.rules = rules
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.now = now or time.time()
+        self._pending: List[str] = []
+
+    def _flush(self):
+        if self._pending and not self.dry_run:
+            self.kv.delete_many(self._pending)
+        self._pending = []
+
+    def _delete(self, usage: KVUsage, info: KeyInfo):
+        self._pending.append(info.key)
+        usage.deleted_objects += 1
+        usage.deleted_bytes += info.size or 0
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    @staticmethod
+    def _count(usage: KVUsage, info: KeyInfo):
+        usage.objects += 1
+        usage.bytes += info.size or 0
+
+    def collect(self, projectid: str) -> KVUsage:
+        """Apply the rules to a project, it returns the usage
+        after the collection."""
+        usage = KVUsage(projectid=projectid)
+        versions: Dict[str, Tuple[RetentionRule, List[KeyInfo]]] = {}
+        root = f"{projectid}/"
+        for info in self.kv.scan(root):
+            path = info.key[len(root) :]
+            rule = match_rule(self.rules, projectid, path)
+            if rule and rule.keep_days is not None:
+                age = key_age(info, self.now)
+                if age is not None and age > rule.keep_days:
+                    self._delete(usage, info)
+                    continue
+            if rule and rule.keep_last is not None:
+                versions.setdefault(version_group(path), (rule, []))[1].append(info)
+                continue
+            self._count(usage, info)
+
+        for rule, infos in versions.values():
+            infos.sort(key=lambda i: (i.mtime or 0, i.key), reverse=True)
+            for info in infos[: rule.keep_last]:
+                self._count(usage, info)
+            for info in infos[rule.keep_last :]:
+                self._delete(usage, info)
+        self._flush()
+
+        usage.updated_at = datetime.utcnow().isoformat()
+        if usage.deleted_objects:
+            logger.info(
+                "kv gc %s: %s keys deleted, %s bytes",
+                projectid,
+                usage.deleted_objects,
+                usage.deleted_bytes,
+            )
+        return usage
@@ -1,24 +1,78 @@
+import asyncio
+import base64
+import hashlib
 import io
 import os
 from datetime import datetime, timedelta
-from typing import Any, AsyncGenerator, Dict, Generator, Union
+from typing import (
+    Any,
+    AsyncGenerator,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
 
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import AnonymousCredentials
 from google.cloud.storage import Client
 from smart_open import open
 
-from labfunctions.utils import run_async
+from labfunctions import defaults
+from labfunctions.utils import iterate_from_thread, iterate_in_thread, run_async
 
-from .kvspec import AsyncKVSpec, GenericKVSpec
+from .kv_multipart import (
+    download_parts,
+    multipart_opts,
+    read_part,
+    retrying,
+    split_parts,
+)
+from .kvspec import AsyncKVSpec, GenericKVSpec, KeyInfo, KeyReadError
+
+# max requests allowed by a batch of the storage api
+_BATCH_SIZE = 100
+# max sources of a compose request
+_COMPOSE_SIZE = 32
+# parts of composite uploads are stored under <key>.lfparts/
+_PARTS_SUFFIX = ".lfparts"
+
+
+def _blob_info(blob) -> KeyInfo:
+    mtime = blob.updated.timestamp() if blob.updated else None
+    return KeyInfo(blob.name, blob.size, mtime)
+
+
+def create_client(opts: Dict[str, Any]) -> Client:
+    if os.environ.get("STORAGE_EMULATOR_HOST"):
+        # a fake server like fsouza/fake-gcs-server, used for testing
+        return Client(
+            project=opts.get("project", "test"), credentials=AnonymousCredentials()
+        )
+    service_account_path = os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
+    return Client.from_service_account_json(service_account_path)
 
 
 class KVGS(GenericKVSpec):
-    """https://googleapis.dev/python/storage/latest/client.html"""
+    """
+    https://googleapis.dev/python/storage/latest/client.html
+
+    If STORAGE_EMULATOR_HOST is set, the client connects without credentials
+    to that host. Options: chunk_size (used by get_stream) and concurrency.
+    For :meth:`put_file` and :meth:`get_file`: part_size, multipart_threshold
+    and part_retries, see labfunctions.io.kv_multipart
+
+    Values are stored as given, see :class:`labfunctions.io.kv_local.KVLocal`
+    about keys ending in .gz or .bz2.
+    """
 
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
-        service_account_path = os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
-        self.client = Client.from_service_account_json(service_account_path)
+        self.chunk_size = client_opts.get("chunk_size", defaults.KV_CHUNK_SIZE)
+        self.client = create_client(client_opts)
         self.bucket = self.client.get_bucket(bucket)
         self.params = {"client": self.client}
 
@@ -32,14 +86,11 @@ class KVGS(GenericKVSpec):
         blob.upload_from_string(bdata, content_type="application/octet-stream")
 
     def _writer(self, key: str, generator: Generator[bytes, None, None]):
-        with open(f"{self.uri}/{key}", "wb", transport_params=self.params) as f:
-            data = True
-            while data:
-                try:
-                    _data = generator.__next__()
-                    f.write(_data)
-                except StopIteration:
-                    data = False
+        # smart_open would compress keys ending with .gz, values are stored as is
+        uri = f"{self.uri}/{key}"
+        with open(uri, "wb", transport_params=self.params, compression="disable") as f:
+            for chunk in generator:
+                f.write(chunk)
 
     def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
         rsp = True
@@ -58,18 +109,176 @@ class KVGS(GenericKVSpec):
             pass
         return obj
 
+    def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            return None
+        if start < 0:
+            start = max(blob.size + start, 0)
+            end = None
+        if start >= blob.size:
+            return b""
+        return blob.download_as_bytes(start=start, end=end)
+
     def get_stream(self, key: str) -> Generator[bytes, None, None]:
         uri = f"{self.uri}/{key}"
-        for chunk in open(uri, "rb", transport_params=self.params):
-            yield chunk
+        with open(uri, "rb", transport_params=self.params, compression="disable") as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def etag(self, key: str) -> Union[str, None]:
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            return None
+        return blob.etag
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            return None
+        return _blob_info(blob)
+
+    def get_file(self, key: str, fpath: str):
+        """Big values are downloaded by parts with ranged reads in parallel"""
+        part_size, threshold, retries = multipart_opts(self._opts)
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            raise KeyReadError(self._bucket, key, "not found")
+        if blob.size <= threshold:
+            blob.download_to_filename(fpath)
+            return
+        download_parts(
+            self,
+            key,
+            fpath,
+            _blob_info(blob),
+            part_size=part_size,
+            retries=retries,
+            etag=blob.etag,
+        )
+
+    def _parts_prefix(self, key: str, fpath: str) -> str:
+        """The same for the same file, so a failed upload could be resumed"""
+        st = os.stat(fpath)
+        tag = f"{key}:{st.st_size}:{st.st_mtime_ns}"
+        return f"{key}{_PARTS_SUFFIX}/{hashlib.sha1(tag.encode()).hexdigest()}/"
+
+    def _compose(self, names: List[str], key: str, prefix: str):
+        """A compose request accepts up to 32 sources, more parts are
+        composed in levels"""
+        level = 0
+        while len(names) > _COMPOSE_SIZE:
+            groups = [
+                names[ix : ix + _COMPOSE_SIZE]
+                for ix in range(0, len(names), _COMPOSE_SIZE)
+            ]
+
+            def _join(item):
+                ix, group = item
+                name = f"{prefix}c{level}-{ix:06d}"
+                self.bucket.blob(name).compose([self.bucket.blob(n) for n in group])
+                return name
+
+            names = self._map(_join, enumerate(groups))
+            level += 1
+        dst = self.bucket.blob(key)
+        dst.content_type = "application/octet-stream"
+        dst.compose([self.bucket.blob(n) for n in names])
+
+    def put_file(self, key: str, fpath: str) -> bool:
+        """
+        Big files are uploaded as composite objects: parts are uploaded in
+        parallel, with a md5 checksum verified by the server, then joined
+        with compose requests and deleted.
+        Parts already uploaded with the same md5 are not sent again if the
+        upload is retried.
+        """
+        part_size, threshold, retries = multipart_opts(self._opts)
+        size = os.path.getsize(fpath)
+        try:
+            if size <= threshold:
+                self.bucket.blob(key).upload_from_filename(
+                    fpath, content_type="application/octet-stream"
+                )
+                return True
+
+            prefix = self._parts_prefix(key, fpath)
+            uploaded = {
+                b.name: b.md5_hash
+                for b in self.client.list_blobs(self._bucket, prefix=prefix)
+            }
+            parts = split_parts(size, part_size)
+
+            def _upload(ix: int) -> str:
+                start, end = parts[ix]
+                data = read_part(fpath, start, end)
+                name = f"{prefix}{ix:06d}"
+                md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+                if uploaded.get(name) == md5:
+                    return name
+                for attempt in retrying(retries):
+                    with attempt:
+                        self.bucket.blob(name).upload_from_string(
+                            data,
+                            content_type="application/octet-stream",
+                            checksum="md5",
+                        )
+                return name
+
+            names = self._map(_upload, range(len(parts)))
+            self._compose(names, key, prefix)
+            self.delete_many(self.list(prefix))
+        except Exception:
+            return False
+        return True
+
+    def exists(self, key: str) -> bool:
+        return self.bucket.blob(key).exists()
+
+    def delete(self, key: str):
+        try:
+            self.bucket.delete_blob(key)
+        except NotFound:
+            pass
+
+    def list(self, prefix: str = "") -> List[str]:
+        blobs = self.client.list_blobs(self._bucket, prefix=prefix or None)
+        return sorted(b.name for b in blobs)
+
+    def scan(self, prefix: str = "") -> Iterator[KeyInfo]:
+        for b in self.client.list_blobs(self._bucket, prefix=prefix or None):
+            yield _blob_info(b)
+
+    def delete_many(self, keys: List[str]):
+        """Deletes are sent in batches, one request by batch"""
+        for ix in range(0, len(keys), _BATCH_SIZE):
+            try:
+                with self.client.batch():
+                    for key in keys[ix : ix + _BATCH_SIZE]:
+                        self.bucket.delete_blob(key)
+            except NotFound:
+                # the rest of the batch was already applied
+                pass
 
 
 class AsyncKVGS(AsyncKVSpec):
-    """A hacky solution because thereisn't trustworthy async lib"""
+    """
+    A hacky solution because thereisn't trustworthy async lib.
+
+    Calls to :class:`KVGS` run in threads. Streams are pumped between the
+    thread and the event loop one chunk at a time (uploads) or through a
+    queue of "queue_size" chunks (downloads), so memory stays constant.
+    """
 
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
+        self.queue_size = client_opts.get("queue_size", defaults.KV_STREAM_QUEUE_SIZE)
         self.client = KVGS(bucket, client_opts)
 
     async def put(self, key: str, bdata: bytes):
@@ -78,6 +287,9 @@ class AsyncKVGS(AsyncKVSpec):
     async def put_stream(
         self, key: str, generator: Generator[bytes, None, None]
     ) -> bool:
+        if hasattr(generator, "__aiter__"):
+            loop = asyncio.get_running_loop()
+            generator = iterate_from_thread(generator, loop)
         rsp = await run_async(self.client.put_stream, key, generator)
         return rsp
 
@@ -85,5 +297,31 @@ class AsyncKVGS(AsyncKVSpec):
         rsp = await run_async(self.client.get, key)
         return rsp
 
+    async def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        return await run_async(self.client.get_range, key, start, end)
+
     async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
-        yield await run_async(self.client.get_stream, key)
+        async for chunk in iterate_in_thread(
+            self.client.get_stream, key, maxsize=self.queue_size
+        ):
+            yield chunk
+
+    async def put_file(self, key: str, fpath: str) -> bool:
+        return await run_async(self.client.put_file, key, fpath)
+
+    async def get_file(self, key: str, fpath: str):
+        await run_async(self.client.get_file, key, fpath)
+
+    async def exists(self, key: str) -> bool:
+        return await run_async(self.client.exists, key)
+
+    async def delete(self, key: str):
+        await run_async(self.client.delete, key)
+
+    async def list(self, prefix: str = "") -> List[str]:
+        return await run_async(self.client.list, prefix)
+
+    async def delete_many(self, keys: List[str]):
+        await run_async(self.client.delete_many, keys)
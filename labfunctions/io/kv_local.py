@@ -1,46 +1,183 @@
 import asyncio
+import hashlib
 import os
 import tempfile
+import uuid
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Generator, Union
+from typing import (
+    Any,
+    AsyncGenerator,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import aiofiles
+import aiofiles.os
 from smart_open import open as sopen
 
-from labfunctions.utils import mkdir_p
+from labfunctions import defaults
+from labfunctions.utils import mkdir_p, run_async
 
-from .kvspec import AsyncKVSpec, GenericKVSpec, KeyReadError, KeyWriteError
+from .kvspec import AsyncKVSpec, GenericKVSpec, KeyInfo, KeyReadError, KeyWriteError
+
+# suffix of the files being written in atomic mode
+_TMP_SUFFIX = ".lftmp"
+
+
+def list_keys(base: str, prefix: str = "") -> List[str]:
+    """Keys under base starting with prefix, only the folder
+    of the prefix is walked."""
+    start = os.path.join(base, os.path.dirname(prefix))
+    keys = []
+    for root, _, files in os.walk(start):
+        rel = os.path.relpath(root, base)
+        for fname in files:
+            if fname.endswith(_TMP_SUFFIX):
+                continue
+            key = fname if rel == "." else f"{rel}/{fname}"
+            if key.startswith(prefix):
+                keys.append(key)
+    return sorted(keys)
+
+
+class LocalLayout:
+    """
+    Paths of the keys of a local store.
+
+    :param shards: levels of directories, named after the hash of the key,
+    used to spread the keys. With 2, "a/b" is stored in "<bucket>/3f/9c/a/b".
+    Then, list has to walk the whole bucket.
+
+    Directories created are remembered, so they are made only once.
+    """
+
+    def __init__(self, root: str, bucket: str, shards: int = 0):
+        self.base = f"{root}/{bucket}"
+        self.shards = shards
+        self._dirs = set()
+        mkdir_p(self.base)
+
+    def uri(self, key: str) -> str:
+        if not self.shards:
+            return f"{self.base}/{key}"
+        h = hashlib.sha1(key.encode()).hexdigest()
+        shard = "/".join(h[i * 2 : i * 2 + 2] for i in range(self.shards))
+        return f"{self.base}/{shard}/{key}"
+
+    def ensure_parent(self, uri: str):
+        parent = os.path.dirname(uri)
+        if parent not in self._dirs:
+            mkdir_p(parent)
+            self._dirs.add(parent)
+
+    def forget_parent(self, uri: str):
+        """If a directory was deleted outside of the store"""
+        self._dirs.discard(os.path.dirname(uri))
+
+    def list(self, prefix: str = "") -> List[str]:
+        if not self.shards:
+            return list_keys(self.base, prefix)
+        keys = (k.split("/", self.shards)[-1] for k in list_keys(self.base))
+        return sorted(k for k in keys if k.startswith(prefix))
+
+
+def _tmp_path(uri: str) -> str:
+    return f"{uri}.{uuid.uuid4().hex[:8]}{_TMP_SUFFIX}"
+
+
+def seek_range(size: int, start: int, end: Optional[int]) -> Tuple[int, int]:
+    """Offset and bytes to read, see GenericKVSpec.get_range"""
+    if start < 0:
+        offset = max(size + start, 0)
+        return offset, size - offset
+    last = size - 1 if end is None else min(end, size - 1)
+    return start, max(last - start + 1, 0)
+
+
+def _local_path(base: str, uri: str) -> Union[str, None]:
+    """It returns the path if the file exists and it is inside base"""
+    fp = os.path.realpath(uri)
+    if not fp.startswith(os.path.realpath(base) + os.sep):
+        return None
+    if not os.path.isfile(fp):
+        return None
+    return fp
 
 
 class KVLocal(GenericKVSpec):
-    """https://googleapis.dev/python/storage/latest/client.html"""
+    """
+    Store values as files under root/bucket.
+
+    Options:
+        - root, chunk_size (used by get_stream) and concurrency.
+        - atomic: write to a temp file and rename it, so readers never see
+          a partial value. False by default.
+        - fsync: flush values to disk before returning. False by default.
+        - shards: levels of directories named by the hash of the key,
+          see :class:`LocalLayout`. 0 by default.
+
+    Values are stored as given, keys ending in .gz or .bz2 are not
+    compressed. Values compressed by older versions are converted with
+    :func:`labfunctions.io.kvspec.decompress_legacy`.
+    """
 
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
         self._root = client_opts.get("root", "/tmp/labstore")
-        mkdir_p(f"{self._root}/{self._bucket}")
+        self.chunk_size = client_opts.get("chunk_size", defaults.KV_CHUNK_SIZE)
+        self._atomic = client_opts.get("atomic", False)
+        self._fsync = client_opts.get("fsync", False)
+        self._layout = LocalLayout(
+            self._root, self._bucket, client_opts.get("shards", 0)
+        )
 
     def uri(self, key):
-        return f"{self._root}/{self._bucket}/{key}"
+        return self._layout.uri(key)
+
+    def local_path(self, key: str) -> Union[str, None]:
+        return _local_path(self._layout.base, self.uri(key))
+
+    def _open(self, uri: str):
+        self._layout.ensure_parent(uri)
+        try:
+            return open(uri, "wb")
+        except FileNotFoundError:
+            self._layout.forget_parent(uri)
+            self._layout.ensure_parent(uri)
+            return open(uri, "wb")
+
+    def _write(self, uri: str, chunks: Iterable[bytes]):
+        dst = _tmp_path(uri) if self._atomic else uri
+        try:
+            with self._open(dst) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                if self._fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if self._atomic:
+                os.replace(dst, uri)
+        except BaseException:
+            if self._atomic and os.path.exists(dst):
+                os.remove(dst)
+            raise
 
     def put(self, key: str, bdata: bytes):
-        # obj = io.BytesIO(bdata)
-        uri = self.uri(key)
-        mkdir_p(Path(uri).parent)
         try:
-            with sopen(uri, "wb") as f:
-                f.write(bdata)
+            self._write(self.uri(key), [bdata])
         except Exception as e:
             raise KeyWriteError(self._bucket, key, str(e))
 
     def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
-        uri = self.uri(key)
-        mkdir_p(Path(uri).parent)
         try:
-            with sopen(uri, "wb") as f:
-                for chunk in generator:
-                    f.write(chunk)
+            self._write(self.uri(key), generator)
         except Exception as e:
             raise KeyWriteError(self._bucket, key, str(e))
 
@@ -49,55 +186,138 @@ class KVLocal(GenericKVSpec):
     def get(self, key: str) -> Union[bytes, None]:
         uri = self.uri(key)
         try:
-            with sopen(uri, "rb") as f:
+            with sopen(uri, "rb", compression="disable") as f:
                 obj = f.read()
                 return obj
         except Exception as e:
             raise KeyReadError(self._bucket, key, str(e))
 
+    def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        uri = self.uri(key)
+        try:
+            with open(uri, "rb") as f:
+                offset, length = seek_range(os.fstat(f.fileno()).st_size, start, end)
+                f.seek(offset)
+                return f.read(length)
+        except Exception as e:
+            raise KeyReadError(self._bucket, key, str(e))
+
     def from_file_gen(self, fpath) -> Generator[bytes, None, None]:
-        for chunk in sopen(fpath, "rb"):
-            yield chunk
+        with sopen(fpath, "rb", compression="disable") as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
 
     def get_stream(self, key: str) -> Generator[bytes, None, None]:
         uri = self.uri(key)
         try:
-            for chunk in sopen(uri, "rb"):
+            for chunk in self.from_file_gen(uri):
                 yield chunk
         except Exception as e:
             raise KeyReadError(self._bucket, key, str(e))
 
+    def etag(self, key: str) -> Union[str, None]:
+        try:
+            st = os.stat(self.uri(key))
+        except FileNotFoundError:
+            return None
+        return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        try:
+            st = os.stat(self.uri(key))
+        except FileNotFoundError:
+            return None
+        return KeyInfo(key, st.st_size, st.st_mtime)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.uri(key))
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.uri(key))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            raise KeyWriteError(self._bucket, key, str(e))
+
+    def list(self, prefix: str = "") -> List[str]:
+        return self._layout.list(prefix)
+
+    def scan(self, prefix: str = "") -> Iterator[KeyInfo]:
+        for key in self._layout.list(prefix):
+            info = self.stat(key)
+            if info:
+                yield info
+
 
 class AsyncKVLocal(AsyncKVSpec):
-    """For local usage and testing"""
+    """For local usage and testing, see :class:`KVLocal` for the options"""
 
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
         self._root = client_opts.get("root", "/tmp/labstore")
-        mkdir_p(f"{self._root}/{self._bucket}")
+        self.chunk_size = client_opts.get("chunk_size", defaults.KV_CHUNK_SIZE)
+        self._atomic = client_opts.get("atomic", False)
+        self._fsync = client_opts.get("fsync", False)
+        self._layout = LocalLayout(
+            self._root, self._bucket, client_opts.get("shards", 0)
+        )
 
     def uri(self, key):
-        return f"{self._root}/{self._bucket}/{key}"
+        return self._layout.uri(key)
+
+    def local_path(self, key: str) -> Union[str, None]:
+        return _local_path(self._layout.base, self.uri(key))
+
+    async def _open(self, uri: str):
+        self._layout.ensure_parent(uri)
+        try:
+            return await aiofiles.open(uri, mode="wb")
+        except FileNotFoundError:
+            self._layout.forget_parent(uri)
+            self._layout.ensure_parent(uri)
+            return await aiofiles.open(uri, mode="wb")
+
+    async def _write(self, uri: str, chunks):
+        dst = _tmp_path(uri) if self._atomic else uri
+        try:
+            f = await self._open(dst)
+            try:
+                if hasattr(chunks, "__aiter__"):
+                    async for chunk in chunks:
+                        await f.write(chunk)
+                else:
+                    for chunk in chunks:
+                        await f.write(chunk)
+                if self._fsync:
+                    await f.flush()
+                    await run_async(os.fsync, f.fileno())
+            finally:
+                await f.close()
+            if self._atomic:
+                await aiofiles.os.replace(dst, uri)
+        except BaseException:
+            if self._atomic and os.path.exists(dst):
+                os.remove(dst)
+            raise
 
     async def put(self, key: str, bdata: bytes):
-        uri = self.uri(key)
-        mkdir_p(Path(uri).parent)
         try:
-            async with aiofiles.open(uri, mode="wb") as f:
-                await f.write(bdata)
+            await self._write(self.uri(key), [bdata])
         except Exception as e:
             raise KeyWriteError(self._bucket, key, str(e))
 
     async def put_stream(
         self, key: str, generator: Generator[bytes, None, None]
     ) -> bool:
-        uri = self.uri(key)
-        mkdir_p((Path(uri).parent).resolve())
         try:
-            async with aiofiles.open(uri, mode="wb") as f:
-                async for data in generator:
-                    await f.write(data)
+            await self._write(self.uri(key), generator)
         except Exception as e:
             raise KeyWriteError(self._bucket, key, str(e))
 
@@ -112,16 +332,43 @@ class AsyncKVLocal(AsyncKVSpec):
         except Exception as e:
             raise KeyReadError(self._bucket, key, str(e))
 
+    async def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        uri = self.uri(key)
+        try:
+            stat = await aiofiles.os.stat(uri)
+            offset, length = seek_range(stat.st_size, start, end)
+            async with aiofiles.open(uri, mode="rb") as f:
+                await f.seek(offset)
+                return await f.read(length)
+        except Exception as e:
+            raise KeyReadError(self._bucket, key, str(e))
+
     async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
         """PEP 0525 for Asynchronous generators"""
         uri = self.uri(key)
         try:
             async with aiofiles.open(uri, mode="rb") as f:
                 while True:
-                    data = await f.read(1024)
+                    data = await f.read(self.chunk_size)
                     if not data:
                         break
                     yield data
 
         except Exception as e:
             raise KeyReadError(self._bucket, key, str(e))
+
+    async def exists(self, key: str) -> bool:
+        return await aiofiles.os.path.isfile(self.uri(key))
+
+    async def delete(self, key: str):
+        try:
+            await aiofiles.os.remove(self.uri(key))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            raise KeyWriteError(self._bucket, key, str(e))
+
+    async def list(self, prefix: str = "") -> List[str]:
+        return await run_async(self._layout.list, prefix)
@@ -0,0 +1,148 @@
+"""
+Transfers of big values by parts, in parallel.
+
+A value bigger than the "multipart_threshold" option of a store is split
+in parts of "part_size" bytes. Each part is sent (or read with a ranged
+request) by a different thread, up to the concurrency of the store, and
+retried on failures.
+
+Downloads are written to a temporary file next to the destination, and
+the sha256 of each part finished is kept in a state file
+(<dst>.lfparts). If a download fails, the next call for the same key and
+destination only fetches the parts missing, as long as the value didn't
+change (same etag and size). Parts found in the state file are hashed
+again before trusting them.
+
+Uploads by parts depend on the backend, see :meth:`KVGS.put_file` for the
+composite uploads of Google Storage.
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from tenacity import Retrying, stop_after_attempt, wait_random
+
+from labfunctions import defaults
+
+from .kvspec import GenericKVSpec, KeyInfo, KeyReadError
+
+_STATE_SUFFIX = ".lfparts"
+_DATA_SUFFIX = ".lfpart"
+
+
+def split_parts(size: int, part_size: int) -> List[Tuple[int, int]]:
+    """Ranges of bytes of each part, end is inclusive like in HTTP"""
+    return [
+        (start, min(start + part_size, size) - 1) for start in range(0, size, part_size)
+    ]
+
+
+def hash_part(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_part(fpath: str, start: int, end: int) -> bytes:
+    with open(fpath, "rb") as f:
+        f.seek(start)
+        return f.read(end - start + 1)
+
+
+def retrying(retries: int) -> Retrying:
+    return Retrying(
+        stop=stop_after_attempt(retries), wait=wait_random(min=0, max=1), reraise=True
+    )
+
+
+def multipart_opts(opts: Dict[str, Any]) -> Tuple[int, int, int]:
+    """part_size, multipart_threshold and part_retries from the store options"""
+    return (
+        opts.get("part_size", defaults.KV_PART_SIZE),
+        opts.get("multipart_threshold", defaults.KV_MULTIPART_THRESHOLD),
+        opts.get("part_retries", defaults.KV_PART_RETRIES),
+    )
+
+
+class PartsState:
+    """Parts done of a download, saved as json"""
+
+    def __init__(self, path: str, tag: Dict[str, Any]):
+        self.path = path
+        self.tag = tag
+        self.done: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                data = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return
+        if data.get("tag") == tag:
+            self.done = {int(ix): digest for ix, digest in data["done"].items()}
+
+    def add(self, ix: int, digest: str):
+        with self._lock:
+            self.done[ix] = digest
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                f.write(json.dumps({"tag": self.tag, "done": self.done}))
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def download_parts(
+    kv: GenericKVSpec,
+    key: str,
+    fpath: str,
+    info: KeyInfo,
+    *,
+    part_size: int = defaults.KV_PART_SIZE,
+    retries: int = defaults.KV_PART_RETRIES,
+    etag: Optional[str] = None,
+) -> int:
+    """
+    Download key into fpath with ranged reads in parallel, using
+    :meth:`GenericKVSpec.get_range`. It returns the number of parts fetched.
+
+    :param info: the size of the value is required.
+    :param etag: used to know if a previous partial download is still valid.
+    """
+    size = info.size or 0
+    parts = split_parts(size, part_size)
+    tmp = f"{fpath}{_DATA_SUFFIX}"
+    state = PartsState(
+        f"{fpath}{_STATE_SUFFIX}",
+        {"key": key, "etag": etag, "size": size, "part_size": part_size},
+    )
+    if not state.done or not os.path.isfile(tmp):
+        state.done = {}
+        with open(tmp, "wb") as f:
+            f.truncate(size)
+
+    pending = []
+    for ix, (start, end) in enumerate(parts):
+        digest = state.done.get(ix)
+        if digest is None or hash_part(read_part(tmp, start, end)) != digest:
+            pending.append(ix)
+
+    def _fetch(ix: int):
+        start, end = parts[ix]
+        for attempt in retrying(retries):
+            with attempt:
+                data = kv.get_range(key, start, end)
+                if data is None or len(data) != end - start + 1:
+                    raise KeyReadError(kv._bucket, key, f"part {ix} incomplete")
+        with open(tmp, "r+b") as f:
+            f.seek(start)
+            f.write(data)
+        state.add(ix, hash_part(data))
+
+    kv._map(_fetch, pending)
+    os.replace(tmp, fpath)
+    state.remove()
+    return len(pending)
@@ -1,6 +1,26 @@
+import asyncio
+import bz2
+import gzip
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Dict, Generator, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Union,
+)
 
+import aiofiles
+
+from labfunctions import defaults
 from labfunctions.utils import get_class
 
 
@@ -16,6 +36,23 @@ class KeyWriteError(Exception):
         super().__init__(msg)
 
 
+class KeyInfo(NamedTuple):
+    """A key returned by :meth:`GenericKVSpec.scan`, size in bytes and mtime
+    as a unix timestamp; they are None when the store doesn't know them."""
+
+    key: str
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+
+
+def range_slice(data: bytes, start: int, end: Optional[int] = None) -> bytes:
+    """Slice data like a HTTP Range: end is inclusive and a negative
+    start returns the last bytes"""
+    if start < 0:
+        return data[start:]
+    return data[start : None if end is None else end + 1]
+
+
 class GenericKVSpec(ABC):
     """
     This is a generic KV store mostly use for project data related
@@ -25,12 +62,29 @@ class GenericKVSpec(ABC):
     For examples about how to use some of them see tests/test_io_kv.py
 
     This interface is offered in a sync and async version
+
+    Batch operations (put_many, get_many, exists_many, delete_many) run
+    the single key operations in parallel, the concurrency is taken from
+    the "concurrency" option of the client_opts. Backends could override
+    them if they have a native batch api.
     """
 
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
 
+    @property
+    def concurrency(self) -> int:
+        return self._opts.get("concurrency", defaults.KV_CONCURRENCY)
+
+    def _map(self, func: Callable, items: Iterable) -> List[Any]:
+        items = list(items)
+        if len(items) <= 1:
+            return [func(i) for i in items]
+        workers = min(self.concurrency, len(items))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(func, items))
+
     @abstractmethod
     def put(self, key: str, bdata: bytes):
         pass
@@ -47,6 +101,92 @@ class GenericKVSpec(ABC):
     def get_stream(self, key: str) -> Generator[bytes, None, None]:
         pass
 
+    def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        """
+        Read a slice of a value. Like in HTTP, end is inclusive; if it's None
+        the value is read until the end, and a negative start returns the
+        last -start bytes.
+
+        By default the full value is read, backends should override it.
+        """
+        data = self.get(key)
+        if data is None:
+            return None
+        return range_slice(data, start, end)
+
+    def local_path(self, key: str) -> Union[str, None]:
+        """If the value is a file in the local filesystem, its path.
+        Web handlers use it to send files directly, without the store."""
+        return None
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        """Size and mtime of a key without reading it, None if the key
+        doesn't exist or if it's not supported."""
+        return None
+
+    def etag(self, key: str) -> Union[str, None]:
+        """A tag which changes when the value of key changes, without reading
+        the value. None if the key doesn't exist or if it's not supported."""
+        return None
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Delete a key, missing keys are ignored"""
+        pass
+
+    @abstractmethod
+    def list(self, prefix: str = "") -> List[str]:
+        """List the keys starting with prefix"""
+        pass
+
+    def scan(self, prefix: str = "") -> Iterator[KeyInfo]:
+        """Like :meth:`list` but with the size and modification time
+        of each key. Backends get them in the same request when possible,
+        by default they are unknown."""
+        for key in self.list(prefix):
+            yield KeyInfo(key)
+
+    def put_file(self, key: str, fpath: str) -> bool:
+        """Upload a local file. Backends could send big files by parts,
+        see labfunctions.io.kv_multipart"""
+        with open(fpath, "rb") as f:
+            return self.put_stream(
+                key, iter(lambda: f.read(defaults.KV_CHUNK_SIZE), b"")
+            )
+
+    def get_file(self, key: str, fpath: str):
+        """Download a value into a local file. Backends could
+        download big values by parts, see labfunctions.io.kv_multipart"""
+        with open(fpath, "wb") as f:
+            for chunk in self.get_stream(key):
+                f.write(chunk)
+
+    def put_many(self, items: Dict[str, bytes]):
+        self._map(lambda kv: self.put(kv[0], kv[1]), items.items())
+
+    def get_many(self, keys: List[str]) -> Dict[str, Union[bytes, None]]:
+        """Missing keys are returned as None"""
+
+        def _get(key) -> Optional[bytes]:
+            try:
+                return self.get(key)
+            except KeyReadError:
+                return None
+
+        return dict(zip(keys, self._map(_get, keys)))
+
+    def exists_many(self, keys: List[str]) -> Dict[str, bool]:
+        return dict(zip(keys, self._map(self.exists, keys)))
+
+    def delete_many(self, keys: List[str]):
+        self._map(self.delete, keys)
+
     @staticmethod
     def create(store_class, bucket, opts: Dict[str, Any] = {}) -> "GenericKVSpec":
         Class = get_class(store_class)
@@ -69,6 +209,21 @@ class AsyncKVSpec(ABC):
         self._opts = client_opts
         self._bucket = bucket
 
+    @property
+    def concurrency(self) -> int:
+        return self._opts.get("concurrency", defaults.KV_CONCURRENCY)
+
+    async def _gather(
+        self, func: Callable[[Any], Awaitable[Any]], items: Iterable
+    ) -> List[Any]:
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _run(item):
+            async with sem:
+                return await func(item)
+
+        return await asyncio.gather(*[_run(i) for i in items])
+
     @abstractmethod
     async def put(self, key: str, bdata: bytes):
         pass
@@ -87,7 +242,108 @@ class AsyncKVSpec(ABC):
     async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
         pass
 
+    async def get_range(
+        self, key: str, start: int, end: Optional[int] = None
+    ) -> Union[bytes, None]:
+        """See :meth:`GenericKVSpec.get_range`"""
+        data = await self.get(key)
+        if data is None:
+            return None
+        return range_slice(data, start, end)
+
+    def local_path(self, key: str) -> Union[str, None]:
+        """See :meth:`GenericKVSpec.local_path`"""
+        return None
+
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def delete(self, key: str):
+        """Delete a key, missing keys are ignored"""
+        pass
+
+    @abstractmethod
+    async def list(self, prefix: str = "") -> List[str]:
+        """List the keys starting with prefix"""
+        pass
+
+    async def put_file(self, key: str, fpath: str) -> bool:
+        """See :meth:`GenericKVSpec.put_file`"""
+
+        async def _read():
+            async with aiofiles.open(fpath, "rb") as f:
+                while True:
+                    chunk = await f.read(defaults.KV_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        return await self.put_stream(key, _read())
+
+    async def get_file(self, key: str, fpath: str):
+        """See :meth:`GenericKVSpec.get_file`"""
+        async with aiofiles.open(fpath, "wb") as f:
+            async for chunk in self.get_stream(key):
+                await f.write(chunk)
+
+    async def put_many(self, items: Dict[str, bytes]):
+        await self._gather(lambda kv: self.put(kv[0], kv[1]), items.items())
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Union[bytes, None]]:
+        """Missing keys are returned as None"""
+
+        async def _get(key) -> Optional[bytes]:
+            try:
+                return await self.get(key)
+            except KeyReadError:
+                return None
+
+        return dict(zip(keys, await self._gather(_get, keys)))
+
+    async def exists_many(self, keys: List[str]) -> Dict[str, bool]:
+        return dict(zip(keys, await self._gather(self.exists, keys)))
+
+    async def delete_many(self, keys: List[str]):
+        await self._gather(self.delete, keys)
+
     @staticmethod
     def create(store_class, bucket, opts: Dict[str, Any] = {}) -> "GenericKVSpec":
         Class = get_class(store_class)
         return Class(bucket, opts)
+
+
+# extensions compressed by smart_open, with the magic of their format
+_LEGACY_COMPRESSION = {
+    ".gz": (b"\x1f\x8b", gzip.decompress),
+    ".bz2": (b"BZh", bz2.decompress),
+}
+
+
+def decompress_legacy(
+    kv: GenericKVSpec, prefix: str = "", before: Optional[float] = None
+) -> List[str]:
+    """
+    Older versions of KVLocal and KVGS wrote values through smart_open,
+    which compressed keys ending in .gz or .bz2 on write and decompressed
+    them on read. Now values are stored as given, so those values would be
+    read compressed. This decompresses them once, in place.
+
+    It should run once after upgrading, with `lab manager kv-decompress`:
+    values written since then are stored as given. before (unix time)
+    limits it to keys modified before the upgrade. It returns the keys
+    rewritten.
+    """
+    rewritten = []
+    for info in kv.scan(prefix):
+        ext = next((e for e in _LEGACY_COMPRESSION if info.key.endswith(e)), None)
+        if not ext or (before and info.mtime and info.mtime >= before):
+            continue
+        magic, decompress = _LEGACY_COMPRESSION[ext]
+        data = kv.get(info.key)
+        if not data or not data.startswith(magic):
+            continue
+        kv.put(info.key, decompress(data))
+        rewritten.append(info.key)
+    return rewritten
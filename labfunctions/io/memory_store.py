@@ -1,3 +1,8 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from labfunctions import defaults
 from labfunctions.utils import Singleton
 
 
@@ -7,3 +12,78 @@ class MemoryStore(dict, metaclass=Singleton):
     """
 
     pass
+
+
+class LRUMemoryCache:
+    """
+    A LRU cache with byte-size accounting. Because python objects don't
+    have a reliable size, the size of each entry should be given by the caller,
+    usually it's the size of the serialized object.
+
+    Use :func:`get_memory_cache` to get a instance shared by the process.
+    """
+
+    def __init__(self, max_bytes: int = defaults.CACHE_MEMORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, Tuple[Any, Any, int]]" = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key: str) -> Optional[Tuple[Any, Any]]:
+        """It returns a tuple of (value, meta) or None"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            self._data.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, key: str, value: Any, meta: Any = None, size: int = 0) -> bool:
+        """It returns False if the value is bigger than the cache itself"""
+        if size > self.max_bytes:
+            self.delete(key)
+            return False
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old:
+                self._total -= old[2]
+            self._data[key] = (value, meta, size)
+            self._total += size
+            while self._total > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._total -= evicted[2]
+        return True
+
+    def delete(self, key: str):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old:
+                self._total -= old[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._total = 0
+
+
+def get_memory_cache(
+    namespace: str = "cache", max_bytes: int = defaults.CACHE_MEMORY_MAX_BYTES
+) -> LRUMemoryCache:
+    """Get or create a LRUMemoryCache living in the MemoryStore, caches
+    with different max_bytes are different pools"""
+    ms = MemoryStore()
+    name = f"lru.{namespace}.{max_bytes}"
+    lru = ms.get(name)
+    if lru is None:
+        lru = ms.setdefault(name, LRUMemoryCache(max_bytes))
+    return lru
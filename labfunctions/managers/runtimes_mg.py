@@ -3,6 +3,7 @@ from typing import List, Optional, Union
 from sqlalchemy import delete as sqldelete
 from sqlalchemy import insert as sqlinsert
 from sqlalchemy import select
+from sqlalchemy import update as sqlupdate
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import selectinload
 
@@ -28,6 +29,7 @@ def model2runtime(m: RuntimeModel) -> RuntimeData:
         registry=m.registry,
         created_at=m.created_at.isoformat(),
         version=m.version,
+        build_key=m.build_key,
     )
     return rd
 
@@ -50,16 +52,28 @@ async def get_list(session, projectid, limit=10) -> List[RuntimeData]:
     return [model2runtime(r[0]) for r in rows]
 
 
+def runtime_rid(rq: RuntimeReq) -> str:
+    return f"{rq.project_id}/{rq.runtime_name}/{rq.version}"
+
+
 async def create(session, rq: RuntimeReq) -> bool:
-    rd = RuntimeData(
-        runtimeid=f"{rq.project_id}/{rq.runtime_name}/{rq.version}", **rq.dict()
-    )
+    """It returns False if the version was already registered. Versions
+    like current and stash, or tags pushed again, are rebuilt with the same
+    runtimeid, so the build_key of the registered one is updated."""
+    rd = RuntimeData(runtimeid=runtime_rid(rq), **rq.dict())
     stmt = _insert(rd)
     inserted = True
     try:
-        await session.execute(stmt)
+        async with session.begin_nested():
+            await session.execute(stmt)
     except IntegrityError as e:
         inserted = False
+        stmt = (
+            sqlupdate(RuntimeModel)
+            .where(RuntimeModel.runtimeid == rd.runtimeid)
+            .values(build_key=rd.build_key)
+        )
+        await session.execute(stmt)
     return inserted
 
 
@@ -110,6 +124,25 @@ def get_by_rid_sync(session, runtimeid: str) -> Union[RuntimeData, None]:
     return None
 
 
+async def get_by_build_key(
+    session, projectid: str, build_key: str
+) -> Union[RuntimeData, None]:
+    """The last runtime built with that build key,
+    see labfunctions.runtimes.context.build_key"""
+    stmt = (
+        select_runtime()
+        .where(RuntimeModel.project_id == projectid)
+        .where(RuntimeModel.build_key == build_key)
+        .order_by(RuntimeModel.created_at.desc())
+        .limit(1)
+    )
+    rsp = await session.execute(stmt)
+    model = rsp.scalar_one_or_none()
+    if model:
+        return model2runtime(model)
+    return None
+
+
 async def delete_by_rid(session, runtimeid: int):
     stmt = sqldelete(RuntimeModel).where(RuntimeModel.runtimeid == runtimeid)
     await session.execute(stmt)
@@ -247,6 +247,7 @@ class RuntimeModel(Base, ProjectRelationMixin):
     spec = Column(JSON(), nullable=False)
     version = Column(String(), nullable=False)
     registry = Column(String(), nullable=True)
+    build_key = Column(String(), nullable=True, index=True)
 
     created_at = Column(
         DateTime(), server_default=functions.now(), nullable=False, index=True
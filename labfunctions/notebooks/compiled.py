@@ -0,0 +1,168 @@
+"""
+Notebooks compiled to python scripts, executed without a kernel.
+
+The code cells of a notebook are written, in order, to a script with the
+digest of the notebook in its first line. After the cell tagged
+"parameters" (or at the start if there isn't one) the script has
+PARAMS_MARK, replaced in each execution by the same assignments papermill
+would inject (see :func:`render_script`).
+
+Runtimes compile their notebooks when they are built (see
+:func:`compile_notebooks`), and :func:`load_compiled` compiles again the
+ones changed or missing, keeping the result in NB_COMPILED_DIR.
+
+Cells with IPython syntax (magics, shell commands) can't run with plain
+python, :class:`NotCompilable` is raised for them.
+"""
+import hashlib
+import logging
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import nbformat
+
+from labfunctions import defaults
+
+from .utils import read_notebook
+
+logger = logging.getLogger(__name__)
+
+COMPILED_HEADER = "# labfunctions compiled notebook sha256:"
+PARAMS_MARK = "# __lf_parameters__"
+CELL_MARK = "# %% cell "
+# display() is a builtin of IPython
+_PRELUDE = """try:
+    from IPython.display import display
+except ImportError:
+    display = print
+"""
+_MAGIC = re.compile(r"^\s*[%!]", re.M)
+
+
+class NotCompilable(ValueError):
+    pass
+
+
+def notebook_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def compile_notebook(path: str) -> str:
+    """The script of the notebook in path"""
+    nb = read_notebook(path)
+    lines = [f"{COMPILED_HEADER}{notebook_digest(path)}", _PRELUDE]
+    params = False
+    for ix, cell in enumerate(nb.cells):
+        tags = cell.metadata.get("tags", [])
+        if cell.cell_type != "code" or "injected-parameters" in tags:
+            continue
+        if _MAGIC.search(cell.source):
+            raise NotCompilable(f"cell {ix} of {path} uses IPython syntax")
+        lines.append(f"{CELL_MARK}{ix}")
+        lines.append(cell.source)
+        if "parameters" in tags and not params:
+            lines.append(PARAMS_MARK)
+            params = True
+    if not params:
+        lines.insert(2, PARAMS_MARK)
+    return "\n".join(lines) + "\n"
+
+
+def compiled_path(nb_path: str, cache_dir: str = defaults.NB_COMPILED_DIR) -> Path:
+    return Path(cache_dir) / f"{nb_path}.py"
+
+
+def load_compiled(nb_path: str, cache_dir: str = defaults.NB_COMPILED_DIR) -> str:
+    """The script of nb_path, compiled again if the notebook changed"""
+    fp = compiled_path(nb_path, cache_dir)
+    header = f"{COMPILED_HEADER}{notebook_digest(nb_path)}\n"
+    try:
+        with open(fp, "r") as f:
+            script = f.read()
+        if script.startswith(header):
+            return script
+    except FileNotFoundError:
+        pass
+    script = compile_notebook(nb_path)
+    try:
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.write_text(script)
+    except OSError as e:
+        logger.warning("Compiled %s not cached: %s", nb_path, e)
+    return script
+
+
+def compile_notebooks(root: str, cache_dir: str = defaults.NB_COMPILED_DIR) -> int:
+    """Compile the notebooks of the project in root, it returns how many"""
+    total = 0
+    for nb in sorted(Path(root, defaults.NOTEBOOKS_DIR).rglob("*.ipynb")):
+        if ".ipynb_checkpoints" in nb.parts:
+            continue
+        rel = str(nb.relative_to(root))
+        try:
+            script = compile_notebook(str(nb))
+        except (NotCompilable, nbformat.reader.NotJSONError) as e:
+            logger.info("%s not compiled: %s", rel, e)
+            continue
+        fp = compiled_path(rel, str(Path(root, cache_dir)))
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.write_text(script)
+        total += 1
+    return total
+
+
+def render_script(script: str, params: Dict[str, Any]) -> str:
+    """Inject params as papermill does"""
+    # pylint: disable=import-outside-toplevel
+    from papermill.translators import translate_parameters
+
+    code = translate_parameters("python3", "python", params, "Parameters")
+    return script.replace(PARAMS_MARK, code.rstrip("\n"), 1)
+
+
+def failed_cell(script: str, script_path: str, stderr: str) -> Optional[int]:
+    """Index of the cell where the traceback in stderr was raised"""
+    lines = re.findall(rf'File "{re.escape(script_path)}", line (\d+)', stderr)
+    if not lines:
+        return None
+    lineno = int(lines[-1])
+    cell = None
+    for ix, line in enumerate(script.splitlines(), 1):
+        if ix > lineno:
+            break
+        if line.startswith(CELL_MARK):
+            cell = int(line[len(CELL_MARK) :])
+    return cell
+
+
+def reconstruct(
+    nb_path: str,
+    output_path: str,
+    params: Dict[str, Any],
+    logs: str,
+    cell: Optional[int] = None,
+):
+    """
+    Write the output notebook of a compiled execution: the notebook with
+    the parameters injected and the logs as output of the cell that failed,
+    or of the last cell.
+    """
+    # pylint: disable=import-outside-toplevel
+    from papermill.iorw import load_notebook_node
+    from papermill.parameterize import parameterize_notebook
+
+    nb = load_notebook_node(nb_path)
+    code: List[int] = []
+    for ix, c in enumerate(nb.cells):
+        c.metadata["lf_cell"] = ix
+        if c.cell_type == "code":
+            code.append(ix)
+    nb = parameterize_notebook(nb, params, kernel_name="python3", language="python")
+    target = cell if cell is not None else (code[-1] if code else None)
+    for c in nb.cells:
+        if c.metadata.pop("lf_cell", None) == target and logs:
+            c.outputs = [nbformat.v4.new_output("stream", name="stdout", text=logs)]
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    nbformat.write(nb, output_path)
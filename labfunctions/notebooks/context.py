@@ -6,6 +6,7 @@ from typing import List, Optional
 from labfunctions import defaults, errors
 from labfunctions.executors.execid import ExecID
 from labfunctions.hashes import generate_random
+from labfunctions.runtimes.context import runtime_image
 from labfunctions.types import ExecutionNBTask, ExecutionResult, NBTask, ServerSettings
 from labfunctions.types.runtimes import RuntimeData
 from labfunctions.utils import get_version, today_string
@@ -37,9 +38,7 @@ def prepare_runtime(runtime: Optional[RuntimeData] = None, gpu_support=False) ->
         if gpu_support:
             _runtime = f"{defaults.DOCKERFILE_IMAGE}:{version}-client-gpu"
     else:
-        _runtime = f"{runtime.docker_name}:{runtime.version}"
-        if runtime.registry:
-            _runtime = f"{runtime.registry}/{runtime}"
+        _runtime = runtime_image(runtime)
     return _runtime
 
 
@@ -96,6 +95,8 @@ def create_notebook_ctx(
         created_at=_now,
         notifications_ok=task.notifications_ok,
         notifications_fail=task.notifications_fail,
+        compiled=task.compiled,
+        compiled_output=task.compiled_output,
     )
 
 
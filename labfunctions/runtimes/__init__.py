@@ -1,8 +1,11 @@
-from .bundler import bundle_project
+from .bundler import bundle_manifest, bundle_project
 from .context import (
+    build_key,
     build_upload_uri,
+    bundle_digest_uri,
     create_build_ctx,
     local_runtime_data,
     make_docker_name,
+    runtime_image,
 )
 from .utils import generate_dockerfile, get_spec_from_file
@@ -0,0 +1,261 @@
+"""
+Archives of the bundles.
+
+:func:`zip_files` compresses the files in a pool of threads (zlib releases
+the GIL) and writes the results to the zip file in order, from the
+calling thread, as soon as they are ready. Only a window of files is kept
+in memory; files bigger than max_inmemory are compressed by zipfile itself.
+
+Zip files need their central directory, at the end of the file, to be
+read. Tar bundles (:func:`tar_files`) are compressed as a single stream
+instead, so :func:`extract_tar` can extract them from the chunks of
+:meth:`GenericKVSpec.get_stream` while they arrive, without writing the
+archive to disk.
+"""
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import IO, Callable, Deque, Iterable, Iterator, Optional, Tuple
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZipFile, ZipInfo
+
+from labfunctions import defaults
+
+Deflated = Tuple[int, int, bytes]
+
+
+def deflate_file(path: str, level: int = defaults.BUNDLE_COMPRESS_LEVEL) -> Deflated:
+    """Raw deflate of a file, as stored in zip files.
+    It returns the crc32, the size and the compressed data"""
+    co = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc, size, out = 0, 0, []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(defaults.KV_CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            out.append(co.compress(chunk))
+    out.append(co.flush())
+    return crc, size, b"".join(out)
+
+
+class DeflatedZipFile(ZipFile):
+    """
+    ZipFile accepting members already compressed by :func:`deflate_file`,
+    so they can be compressed in other threads. zipfile doesn't have a
+    public api for it, the steps are the ones of ZipFile.write; they are
+    kept in this class and covered by the tests of the archives.
+    """
+
+    def write_deflated(self, zinfo: ZipInfo, deflated: Deflated):
+        """Members must be smaller than ZIP64_LIMIT (see max_inmemory)"""
+        # pylint: disable=protected-access
+        crc, size, data = deflated
+        if size >= ZIP64_LIMIT or len(data) >= ZIP64_LIMIT:
+            raise ValueError(f"{zinfo.filename} is too big to be written deflated")
+        zinfo.compress_type = ZIP_DEFLATED
+        zinfo.file_size = size
+        zinfo.compress_size = len(data)
+        zinfo.CRC = crc
+        with self._lock:
+            if self._writing:
+                raise ValueError("Can't write while an open writing handle exists")
+            self._writecheck(zinfo)
+            self._didModify = True
+            if self._seekable:
+                self.fp.seek(self.start_dir)
+            zinfo.header_offset = self.fp.tell()
+            self.fp.write(zinfo.FileHeader(False))
+            self.fp.write(data)
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+            self.start_dir = self.fp.tell()
+
+
+def ordered_map(
+    executor: ThreadPoolExecutor, func: Callable, items: Iterable, window: int
+) -> Iterator:
+    """Like executor.map but with at most window items running or waiting
+    to be consumed, so items could be a lazy iterable"""
+    pending: Deque = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def zip_files(
+    output_file: str,
+    paths: Iterable[str],
+    *,
+    prefix: Optional[str] = None,
+    level: int = defaults.BUNDLE_COMPRESS_LEVEL,
+    workers: Optional[int] = None,
+    max_inmemory: int = defaults.BUNDLE_MAX_INMEMORY,
+) -> int:
+    """
+    Zip paths (relative to the current folder) into output_file.
+    It returns the number of files written.
+
+    :param prefix: folder inside the zip where files are written
+    :param workers: threads used to compress, by default the number of cpus
+    """
+    workers = workers or os.cpu_count() or 1
+
+    def _compress(path: str) -> Tuple[str, Optional[Deflated]]:
+        if os.path.getsize(path) > max_inmemory:
+            return path, None
+        return path, deflate_file(path, level)
+
+    total = 0
+    with DeflatedZipFile(output_file, "w", ZIP_DEFLATED, compresslevel=level) as z:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = ordered_map(executor, _compress, paths, workers * 2)
+            for path, deflated in results:
+                arcname = f"{prefix}{path}" if prefix else path
+                if deflated is None:
+                    z.write(path, arcname)
+                else:
+                    z.write_deflated(ZipInfo.from_file(path, arcname), deflated)
+                total += 1
+    return total
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstandard is required by tar.zst bundles") from e
+    return zstandard
+
+
+@contextmanager
+def compressor(fileobj: IO[bytes], fmt: str) -> Iterator[IO[bytes]]:
+    """A writable stream compressing into fileobj"""
+    if fmt == "tar.zst":
+        zstd = _import_zstd()
+        # threads=-1: one compression thread per cpu
+        cctx = zstd.ZstdCompressor(level=defaults.BUNDLE_ZSTD_LEVEL, threads=-1)
+        with cctx.stream_writer(fileobj) as out:
+            yield out
+    elif fmt == "tar.gz":
+        with gzip.GzipFile(
+            fileobj=fileobj,
+            mode="wb",
+            compresslevel=defaults.BUNDLE_COMPRESS_LEVEL,
+            mtime=0,
+        ) as out:
+            yield out
+    else:
+        raise ValueError(f"{fmt} is not a tar format")
+
+
+def decompressor(fileobj: IO[bytes], fmt: str) -> IO[bytes]:
+    """A readable stream decompressing fileobj"""
+    if fmt == "tar.zst":
+        zstd = _import_zstd()
+        return zstd.ZstdDecompressor().stream_reader(fileobj)
+    if fmt == "tar.gz":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    raise ValueError(f"{fmt} is not a tar format")
+
+
+def tar_files(
+    output_file: str,
+    paths: Iterable[str],
+    *,
+    fmt: str = "tar.zst",
+    prefix: Optional[str] = None,
+) -> int:
+    """
+    Tar and compress paths (relative to the current folder) into
+    output_file. It returns the number of files written.
+    """
+    total = 0
+    with open(output_file, "wb") as f, compressor(f, fmt) as out:
+        with tarfile.open(fileobj=out, mode="w|") as tar:
+            for path in paths:
+                arcname = f"{prefix}{path}" if prefix else path
+                tar.add(path, arcname, recursive=False)
+                total += 1
+    return total
+
+
+def compress_file(src: str, dst: str, fmt: str):
+    """Compress a tar file, like the ones made by git archive"""
+    with open(src, "rb") as fi, open(dst, "wb") as fo:
+        with compressor(fo, fmt) as out:
+            shutil.copyfileobj(fi, out, defaults.KV_CHUNK_SIZE)
+
+
+class IterStream(io.RawIOBase):
+    """A readable file from an iterator of bytes, like the one
+    returned by :meth:`GenericKVSpec.get_stream`"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b"")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while self._pos >= len(self._buf):
+            try:
+                self._buf = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            self._pos = 0
+        size = min(len(b), len(self._buf) - self._pos)
+        b[:size] = self._buf[self._pos : self._pos + size]
+        self._pos += size
+        return size
+
+
+# the checks of tarfile, in the python versions that have them
+_FILTER = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+
+def _inside(root: str, path: str) -> bool:
+    return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+
+def _safe_members(tar: tarfile.TarFile, dst: str) -> Iterator[tarfile.TarInfo]:
+    """Members and links pointing outside of dst, and devices, are refused"""
+    root = os.path.realpath(dst)
+    for member in tar:
+        path = os.path.join(root, member.name)
+        if not _inside(root, path):
+            raise tarfile.ExtractError(f"{member.name} is outside of {dst}")
+        if member.issym():
+            target = os.path.join(os.path.dirname(path), member.linkname)
+        elif member.islnk():
+            target = os.path.join(root, member.linkname)
+        else:
+            target = path
+        if not _inside(root, target):
+            raise tarfile.ExtractError(f"{member.name} links outside of {dst}")
+        if member.isdev():
+            raise tarfile.ExtractError(f"{member.name} is a device")
+        yield member
+
+
+def extract_tar(fileobj: IO[bytes], dst: str, fmt: str) -> int:
+    """
+    Extract a tar bundle from fileobj, reading it only once, from the start.
+    Members outside of dst are refused. It returns the number of members.
+    """
+    total = 0
+    with decompressor(fileobj, fmt) as stream:
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in _safe_members(tar, dst):
+                tar.extract(member, dst, set_attrs=not member.isdir(), **_FILTER)
+                total += 1
+    return total
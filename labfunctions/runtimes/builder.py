@@ -2,9 +2,9 @@ import json
 import logging
 import os
 import tempfile
-from io import BytesIO
+from io import BufferedReader, BytesIO
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 from zipfile import ZipFile
 
 import httpx
@@ -13,11 +13,18 @@ import docker
 from labfunctions import client, defaults
 from labfunctions.commands import DockerCommand
 from labfunctions.conf import load_client, load_server
+from labfunctions.io.kv_disk_cache import KVDiskCache
 from labfunctions.io.kvspec import GenericKVSpec
+from labfunctions.notebooks.compiled import compile_notebooks
 
 # from labfunctions.types.docker import DockerBuildLog, DockerBuildLowLog, DockerPushLog
 from labfunctions.types.docker import DockerBuildLog
-from labfunctions.types.runtimes import BuildCtx, RuntimeReq
+from labfunctions.types.runtimes import BuildCtx, RuntimeData, RuntimeReq
+
+from .archive import IterStream, extract_tar
+from .utils import app_dockerfile, deps_key, split_dockerfile
+
+logger = logging.getLogger(__name__)
 
 
 def unzip_runtime(project_zip_file, dst_dir):
@@ -25,6 +32,13 @@ def unzip_runtime(project_zip_file, dst_dir):
         zo.extractall(dst_dir)
 
 
+def _docker_tag(ctx: BuildCtx) -> Tuple[str, bool]:
+    """Full name of the image and if it should be pushed"""
+    if ctx.registry:
+        return f"{ctx.registry}/{ctx.docker_name}", True
+    return ctx.docker_name, False
+
+
 class BuildTask:
     def __init__(
         self,
@@ -40,31 +54,125 @@ class BuildTask:
         return self.client.projectid
 
     def get_runtime_file(self, full_zip_file_path, download_key_zip):
-        with open(full_zip_file_path, "wb") as f:
-            for chunk in self.kv.get_stream(download_key_zip):
-                f.write(chunk)
+        self.kv.get_file(download_key_zip, full_zip_file_path)
+
+    def extract_runtime(self, ctx: BuildCtx, dst_dir):
+        """
+        Tar bundles are extracted while they are downloaded.
+        Zip bundles must be downloaded first.
+        """
+        # stores with local files (or a disk cache) don't need a copy
+        local_file = self.kv.local_path(ctx.download_zip)
+        if ctx.bundle_format == "zip":
+            zip_file = local_file
+            if not zip_file:
+                zip_file = f"{dst_dir}/{ctx.zip_name}"
+                self.get_runtime_file(zip_file, ctx.download_zip)
+            unzip_runtime(zip_file, dst_dir)
+        elif local_file:
+            with open(local_file, "rb") as f:
+                extract_tar(f, dst_dir, ctx.bundle_format)
+        else:
+            stream = BufferedReader(IterStream(self.kv.get_stream(ctx.download_zip)))
+            extract_tar(stream, dst_dir, ctx.bundle_format)
+
+    def reusable(self, ctx: BuildCtx) -> Optional[RuntimeData]:
+        """A runtime built with the same build key, it could be registered
+        while this build was waiting in the queue"""
+        if not ctx.build_key:
+            return None
+        try:
+            return self.client.runtime_by_build_key(ctx.build_key)
+        except httpx.HTTPError as e:
+            logger.warning("runtimes of %s not available: %s", ctx.projectid, e)
+            return None
+
+    def retag(self, ctx: BuildCtx, rd: RuntimeData) -> DockerBuildLog:
+        src = f"{rd.docker_name}:{rd.version}"
+        if rd.registry:
+            src = f"{rd.registry}/{src}"
+        docker_tag, push = _docker_tag(ctx)
+        cmd = DockerCommand()
+        return cmd.retag(src, docker_tag, ctx.version, push=push)
+
+    def build_split(
+        self, cmd: DockerCommand, ctx: BuildCtx, tmp_dir: str
+    ) -> Optional[DockerBuildLog]:
+        """
+        Build the image in two steps if the Dockerfile has a deps stage
+        (see :func:`split_dockerfile`): the deps image, tagged with the hash
+        of the requirements and the deps stages, is built only if it
+        doesn't exist yet; then the code is copied on top of it.
+        It returns None if the Dockerfile can't be split.
+        """
+        src = Path(f"{tmp_dir}/src")
+        try:
+            parts = split_dockerfile((src / ctx.dockerfile).read_text())
+        except FileNotFoundError:
+            parts = None
+        if not parts:
+            return None
+        deps_stages, app_stage = parts
+        try:
+            requirements = (src / ctx.spec.container.requirements).read_bytes()
+        except FileNotFoundError:
+            requirements = b""
+
+        docker_tag, push = _docker_tag(ctx)
+        deps_tag = f"{docker_tag}{defaults.DOCKER_DEPS_SUFFIX}"
+        deps_version = deps_key(deps_stages, requirements)[
+            : defaults.DOCKER_DEPS_KEY_LEN
+        ]
+        deps_image = f"{deps_tag}:{deps_version}"
+        if cmd.image_exists(deps_image, pull=push):
+            logger.info("Reusing dependencies from %s", deps_image)
+        else:
+            # written outside of src, docker-py adds them to the context
+            Path(f"{tmp_dir}/Dockerfile.deps").write_text(deps_stages)
+            logs = cmd.build(
+                str(src),
+                f"{tmp_dir}/Dockerfile.deps",
+                tag=deps_tag,
+                version=deps_version,
+                push=push,
+                target="deps",
+            )
+            if logs.error:
+                return logs
+
+        Path(f"{tmp_dir}/Dockerfile.app").write_text(
+            app_dockerfile(app_stage, deps_image)
+        )
+        return cmd.build(
+            str(src),
+            f"{tmp_dir}/Dockerfile.app",
+            tag=docker_tag,
+            version=ctx.version,
+            push=push,
+        )
 
     def run(self, ctx: BuildCtx) -> DockerBuildLog:
+        reuse = self.reusable(ctx)
+        if reuse:
+            return self.retag(ctx, reuse)
         with tempfile.TemporaryDirectory() as tmp_dir:
-            zip_file = f"{tmp_dir}/{ctx.zip_name}"
-            self.get_runtime_file(zip_file, ctx.download_zip)
-            unzip_runtime(zip_file, tmp_dir)
-            docker_tag = ctx.docker_name
-            push = False
-            if ctx.registry:
-                docker_tag = f"{ctx.registry}/{docker_tag}"
-                push = True
+            self.extract_runtime(ctx, tmp_dir)
+            # for the executions of compiled notebooks
+            compile_notebooks(f"{tmp_dir}/src")
             # nb_client.events_publish(
             #    ctx.execid, f"Starting build for {docker_tag}", event="log"
             # )
             cmd = DockerCommand()
-            logs = cmd.build(
-                f"{tmp_dir}/src",
-                f"{ctx.dockerfile}",
-                tag=docker_tag,
-                version=ctx.version,
-                push=push,
-            )
+            logs = self.build_split(cmd, ctx, tmp_dir)
+            if not logs:
+                docker_tag, push = _docker_tag(ctx)
+                logs = cmd.build(
+                    f"{tmp_dir}/src",
+                    f"{ctx.dockerfile}",
+                    tag=docker_tag,
+                    version=ctx.version,
+                    push=push,
+                )
 
         return logs
 
@@ -76,6 +184,7 @@ class BuildTask:
             project_id=ctx.projectid,
             version=ctx.version,
             registry=ctx.registry,
+            build_key=ctx.build_key,
         )
 
         self.client.runtime_create(req)
@@ -85,7 +194,14 @@ def builder_exec(ctx: BuildCtx) -> DockerBuildLog:
     """
     It will get the bundle file, build the container and register it
     """
-    kv = GenericKVSpec.create(ctx.project_store_class, ctx.project_store_bucket)
+    settings = load_server()
+    kv = GenericKVSpec.create(
+        ctx.project_store_class, ctx.project_store_bucket, ctx.project_store_opts
+    )
+    if settings.AGENT_KV_CACHE_DIR:
+        kv = KVDiskCache.wrap(
+            kv, settings.AGENT_KV_CACHE_DIR, settings.AGENT_KV_CACHE_MAX_BYTES
+        )
     nbclient = client.from_env(projectid=ctx.projectid)
     task = BuildTask(
         nbclient,
@@ -1,15 +1,19 @@
+import hashlib
+import hmac
+import json
 import logging
 import os
 from pathlib import Path
-from typing import Any, Dict, Optional, Union
-from zipfile import ZipFile
+from typing import Any, Dict, Iterator, Optional, Union
 
 from labfunctions import defaults, secrets
 from labfunctions.conf.jtemplates import get_package_dir, render_to_file
 from labfunctions.errors import CommandExecutionException
-from labfunctions.types.runtimes import ProjectBundleFile, RuntimeSpec
+from labfunctions.types.runtimes import BundleManifest, ProjectBundleFile, RuntimeSpec
 from labfunctions.utils import execute_cmd
 
+from .archive import compress_file, tar_files, zip_files
+from .ignore import IgnoreRules
 from .utils import git_last_tag, git_short_head_id
 
 logger = logging.getLogger(__name__)
@@ -31,8 +35,33 @@ def write_secrets(working_area, private_key, nbvars_dict) -> Path:
     return outfile
 
 
+def git_archive(
+    ref: str,
+    output_file: str,
+    secrets_file,
+    prefix_folder=defaults.ZIP_GIT_PREFIX,
+    fmt=defaults.BUNDLE_FORMAT,
+):
+    """git archive only knows how to gzip tar files, it writes
+    a plain tar for other formats which is compressed later"""
+    archive_file = output_file if fmt == "zip" else f"{output_file}.tar"
+    cmd = (
+        f"git archive --prefix={prefix_folder} "
+        f"--add-file {secrets_file} "
+        f"-o {archive_file} {ref} "
+    )
+    execute_cmd(cmd)
+    if fmt != "zip":
+        compress_file(archive_file, output_file, fmt)
+        os.remove(archive_file)
+
+
 def zip_git_stash(
-    root, working_area, runtime_name, prefix_folder=defaults.ZIP_GIT_PREFIX
+    root,
+    working_area,
+    runtime_name,
+    prefix_folder=defaults.ZIP_GIT_PREFIX,
+    fmt=defaults.BUNDLE_FORMAT,
 ) -> Union[ProjectBundleFile, None]:
     """Zip the actual folder state
     using git stash, this should be used only when testing or developing
@@ -41,19 +70,13 @@ def zip_git_stash(
 
     secrets_file = get_secrets_filepath(working_area)
 
-    filename = f"{runtime_name}.stash.zip"
+    filename = f"{runtime_name}.stash.{fmt}"
 
     output_file = f"{str(working_area)}/{defaults.CLIENT_TMP_FOLDER}/{filename}"
     stash_id = execute_cmd("git stash create")
     if not stash_id:
         return None
-    cmd = (
-        f"git archive --prefix={prefix_folder} "
-        f"--add-file {secrets_file} "
-        f"-o {output_file} {stash_id} "
-    )
-
-    execute_cmd(cmd)
+    git_archive(stash_id, output_file, secrets_file, prefix_folder, fmt)
 
     return ProjectBundleFile(
         filepath=output_file,
@@ -62,19 +85,12 @@ def zip_git_stash(
         stash=True,
         version="stash",
         runtime_name=runtime_name,
+        format_type=fmt,
     )
 
 
-def zip_git_head(
-    root, working_area, runtime_name, prefix_folder=defaults.ZIP_GIT_PREFIX
-) -> ProjectBundleFile:
-    """Zip the head of the repository.
-    Not commited files wouldn't included in this zip file
-    """
-    # project = str(root).rsplit("/", maxsplit=1)[-1]
-
-    secrets_file = get_secrets_filepath(working_area)
-
+def git_head_tag() -> str:
+    """The last tag of the repository or the id of the last commit"""
     tagname = None
     try:
         tagname = git_last_tag()
@@ -84,29 +100,54 @@ def zip_git_head(
         )
     if not tagname:
         tagname = git_short_head_id()
+    return tagname
+
+
+def zip_git_head(
+    root,
+    working_area,
+    runtime_name,
+    prefix_folder=defaults.ZIP_GIT_PREFIX,
+    fmt=defaults.BUNDLE_FORMAT,
+) -> ProjectBundleFile:
+    """Zip the head of the repository.
+    Not commited files wouldn't included in this zip file
+    """
+    # project = str(root).rsplit("/", maxsplit=1)[-1]
+
+    secrets_file = get_secrets_filepath(working_area)
 
-    filename = f"{runtime_name}.{tagname}.zip"
+    tagname = git_head_tag()
+
+    filename = f"{runtime_name}.{tagname}.{fmt}"
 
     output_file = f"{str(working_area)}/{defaults.CLIENT_TMP_FOLDER}/{filename}"
-    execute_cmd(
-        f"git archive --prefix={prefix_folder} "
-        f"--add-file {secrets_file} "
-        f"-o {output_file} HEAD "
-    )
+    git_archive("HEAD", output_file, secrets_file, prefix_folder, fmt)
     return ProjectBundleFile(
         runtime_name=runtime_name,
         filepath=output_file,
         filename=filename,
         version=tagname.lower(),
         commit=tagname,
+        format_type=fmt,
     )
 
 
+def current_paths() -> Iterator[str]:
+    """Files of the current folder included in a bundle,
+    see labfunctions.runtimes.ignore"""
+    return IgnoreRules.from_root(".").walk(".")
+
+
 def zip_current(
-    root, working_area, runtime_name, prefix_folder=defaults.ZIP_GIT_PREFIX
+    root,
+    working_area,
+    runtime_name,
+    prefix_folder=defaults.ZIP_GIT_PREFIX,
+    fmt=defaults.BUNDLE_FORMAT,
 ) -> ProjectBundleFile:
 
-    filename = f"{runtime_name}.current.zip"
+    filename = f"{runtime_name}.current.{fmt}"
 
     output_file = f"{str(working_area)}/{defaults.CLIENT_TMP_FOLDER}/{filename}"
 
@@ -114,18 +155,10 @@ def zip_current(
     dst = root / ".secrets"
     dst.write_bytes(secrets_file.read_bytes())
 
-    with ZipFile(output_file, "w") as z:
-        for i in Path(".").glob("**/*"):
-            if (
-                not str(i).startswith(".venv")
-                and not str(i).startswith(".git")
-                and not str(i).startswith(".tox")
-                and not str(i).startswith(defaults.CLIENT_TMP_FOLDER)
-            ):
-                if prefix_folder:
-                    z.write(i, (prefix_folder / i))
-                else:
-                    z.write(i)
+    if fmt == "zip":
+        zip_files(output_file, current_paths(), prefix=prefix_folder)
+    else:
+        tar_files(output_file, current_paths(), fmt=fmt, prefix=prefix_folder)
 
     dst.unlink(missing_ok=True)
     return ProjectBundleFile(
@@ -134,20 +167,136 @@ def zip_current(
         filename=filename,
         version="current",
         current=True,
+        format_type=fmt,
+    )
+
+
+def git_files(ref: str) -> Dict[str, str]:
+    """Files of a git tree with the id of their blobs, git already
+    knows their hashes so the files are not read"""
+    files = {}
+    for line in execute_cmd(f"git ls-tree -r {ref}").splitlines():
+        meta, path = line.split("\t", 1)
+        _, kind, blob_id = meta.split()
+        if kind == "blob":
+            files[path] = blob_id
+    return files
+
+
+def current_files() -> Dict[str, str]:
+    """Files of the current folder with their sha256"""
+    files = {}
+    for i in current_paths():
+        if i != defaults.SECRETS_FILENAME:
+            h = hashlib.sha256()
+            with open(i, "rb") as f:
+                for chunk in iter(lambda: f.read(defaults.KV_CHUNK_SIZE), b""):
+                    h.update(chunk)
+            files[i] = h.hexdigest()
+    return files
+
+
+def secrets_tag(privkey: Optional[str], nbvars: Dict[str, Any]) -> Optional[str]:
+    """The encrypted secrets change in each bundle, a hmac of the plain
+    values, keyed by the private key, is used for the digest instead"""
+    if not privkey:
+        return None
+    plain = {
+        k: v.decode() if isinstance(v, bytes) else str(v) for k, v in nbvars.items()
+    }
+    data = json.dumps(plain, sort_keys=True).encode()
+    return hmac.new(privkey.encode(), data, hashlib.sha256).hexdigest()
+
+
+def manifest_digest(
+    files: Dict[str, str], spec: RuntimeSpec, secrets: Optional[str] = None
+) -> str:
+    h = hashlib.sha256()
+    h.update(spec.json(sort_keys=True).encode())
+    h.update(f"\0{secrets or ''}\0".encode())
+    for path in sorted(files):
+        h.update(f"{path}\0{files[path]}\n".encode())
+    return h.hexdigest()
+
+
+def bundle_manifest(
+    spec: RuntimeSpec,
+    privkey=None,
+    stash=False,
+    current=False,
+) -> Union[BundleManifest, None]:
+    """
+    The files that a bundle would have, without building it.
+    Its digest is used to know if a bundle changed, so it could be
+    reused locally (see :func:`bundle_project`) or in the server.
+    It returns None if there isn't changes to stash.
+    """
+    root = Path(os.getcwd())
+    if stash and not current:
+        stash_id = execute_cmd("git stash create")
+        if not stash_id:
+            return None
+        files, version = git_files(stash_id), "stash"
+    elif current and not stash:
+        files, version = current_files(), "current"
+    elif not current and not stash:
+        files, version = git_files("HEAD"), git_head_tag().lower()
+    else:
+        raise AttributeError("Bad option: current and stash are different options")
+
+    nbvars = secrets.load(str(root)) if privkey else None
+    tag = secrets_tag(privkey, nbvars or {})
+    return BundleManifest(
+        runtime_name=spec.name,
+        version=version,
+        files=files,
+        digest=manifest_digest(files, spec, tag),
     )
 
 
+def _manifest_path(wa: Path, runtime_name: str) -> Path:
+    return wa / defaults.CLIENT_TMP_FOLDER / f"{runtime_name}.manifest.json"
+
+
+def _cached_bundle(
+    wa: Path, manifest: BundleManifest, fmt: str
+) -> Union[ProjectBundleFile, None]:
+    """The last bundle built if its digest didn't change"""
+    fp = _manifest_path(wa, manifest.runtime_name)
+    try:
+        cached = ProjectBundleFile(**json.loads(fp.read_text()))
+    except (FileNotFoundError, ValueError):
+        return None
+    if (
+        cached.digest != manifest.digest
+        or cached.format_type != fmt
+        or not Path(cached.filepath).is_file()
+    ):
+        return None
+    cached.version = manifest.version
+    return cached
+
+
 def bundle_project(
     working_area: Union[str, Path],
     spec: RuntimeSpec,
     privkey=None,
     stash=False,
     current=False,
+    manifest: Optional[BundleManifest] = None,
+    fmt: str = defaults.BUNDLE_FORMAT,
 ) -> ProjectBundleFile:
     """
     It's in charge of bundle all the files needed to build a runtime.
     This bundle could be uploaded to the server or used to build a local docker image.
 
+    If a manifest is given (see :func:`bundle_manifest`) and the last bundle
+    of the runtime has the same digest, that bundle is returned without
+    zipping the project again.
+
+    fmt is one of defaults.BUNDLE_FORMATS, tar formats are extracted by the
+    builder while they are downloaded (see labfunctions.runtimes.archive).
+
     Right now AGENT_TOKEN and AGENT_REFRESH_TOKEN are injected dinamically
     generating the keys on the server and puting it encrypted in the .secrets's file
 
@@ -172,6 +321,11 @@ def bundle_project(
 
     (wa / defaults.CLIENT_TMP_FOLDER).mkdir(parents=True, exist_ok=True)
 
+    if manifest:
+        cached = _cached_bundle(wa, manifest, fmt)
+        if cached:
+            return cached
+
     nbvars = secrets.load(str(root))
 
     if privkey:
@@ -180,7 +334,7 @@ def bundle_project(
     zfile = None
 
     if stash and not current:
-        zfile = zip_git_stash(root, wa, spec.name)
+        zfile = zip_git_stash(root, wa, spec.name, fmt=fmt)
         if not zfile:
             raise TypeError(
                 "There isn't changes in the git repository to perform a "
@@ -188,13 +342,17 @@ def bundle_project(
                 "the stash the changes, perform: git add ."
             )
     elif current and not stash:
-        zfile = zip_current(root, wa, spec.name)
+        zfile = zip_current(root, wa, spec.name, fmt=fmt)
     elif not current and not stash:
-        zfile = zip_git_head(root, wa, spec.name)
+        zfile = zip_git_head(root, wa, spec.name, fmt=fmt)
     else:
         raise AttributeError("Bad option: current and stash are different options")
 
     if privkey:
         Path(secrets_file).unlink(missing_ok=True)
 
+    if manifest:
+        zfile.digest = manifest.digest
+        _manifest_path(wa, spec.name).write_text(zfile.json())
+
     return zfile
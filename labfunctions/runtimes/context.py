@@ -1,4 +1,6 @@
+import hashlib
 from pathlib import Path
+from typing import Any, Dict, Optional
 
 from labfunctions import defaults
 from labfunctions.hashes import generate_random
@@ -17,6 +19,14 @@ def make_docker_name(projectid: str, spec: RuntimeSpec) -> str:
     return f"{defaults.DOCKER_AUTHOR}/{projectid}-{spec.name}"
 
 
+def runtime_image(rd: RuntimeData) -> str:
+    """Full name of the docker image of a runtime"""
+    image = f"{rd.docker_name}:{rd.version}"
+    if rd.registry:
+        image = f"{rd.registry}/{image}"
+    return image
+
+
 def local_spec2runtime(projectid: str, spec: RuntimeSpec, version: str) -> RuntimeData:
     rid = f"{projectid}/{spec.name}/{version}"
     docker_name = make_docker_name(projectid, spec)
@@ -45,8 +55,10 @@ def execid_for_build(size=defaults.EXECID_LEN):
     return f"bld{generate_random(size)}"
 
 
-def build_upload_uri(projectid, runtime_name, version) -> str:
-    _name = f"{runtime_name}.{version}.zip"
+def build_upload_uri(
+    projectid, runtime_name, version, fmt=defaults.BUNDLE_FORMAT
+) -> str:
+    _name = f"{runtime_name}.{version}.{fmt}"
     name = secure_filename(_name)
     root = Path(projectid)
 
@@ -54,6 +66,30 @@ def build_upload_uri(projectid, runtime_name, version) -> str:
     return uri
 
 
+def bundle_digest_uri(projectid, digest, fmt=defaults.BUNDLE_FORMAT) -> str:
+    """A copy of the bundle with that digest, it's never overwritten with
+    other content, unlike the upload uri of a version.
+    See labfunctions.runtimes.bundler.bundle_manifest"""
+    name = secure_filename(f"{digest}.{fmt}")
+    return str(Path(projectid) / defaults.PROJECT_BUNDLES / name)
+
+
+def build_key(
+    spec: RuntimeSpec, dockerfile: str, bundle_digest: Optional[str]
+) -> Optional[str]:
+    """
+    Images built from the same bundle, spec and Dockerfile are the same,
+    whatever the version is. Without the digest of the bundle (see
+    labfunctions.runtimes.bundler.bundle_manifest) there isn't a key.
+    """
+    if not bundle_digest:
+        return None
+    h = hashlib.sha256()
+    h.update(spec.json(sort_keys=True).encode())
+    h.update(f"\0{dockerfile}\0{bundle_digest}".encode())
+    return h.hexdigest()
+
+
 def create_build_ctx(
     projectid: str,
     spec: RuntimeSpec,
@@ -61,9 +97,12 @@ def create_build_ctx(
     project_store_class: str,
     project_store_bucket: str,
     registry=None,
+    project_store_opts: Optional[Dict[str, Any]] = None,
+    bundle_format: str = defaults.BUNDLE_FORMAT,
+    bundle_digest: Optional[str] = None,
 ) -> BuildCtx:
     _id = execid_for_build()
-    uri = build_upload_uri(projectid, spec.name, version)
+    uri = build_upload_uri(projectid, spec.name, version, bundle_format)
     docker = make_docker_name(projectid, spec)
     dockerfile = f"Dockerfile.{spec.name}"
     zip_name = uri.split("/")[-1]
@@ -78,5 +117,9 @@ def create_build_ctx(
         execid=_id,
         project_store_class=project_store_class,
         project_store_bucket=project_store_bucket,
+        project_store_opts=project_store_opts or {},
         registry=registry,
+        bundle_format=bundle_format,
+        bundle_digest=bundle_digest,
+        build_key=build_key(spec, dockerfile, bundle_digest),
     )
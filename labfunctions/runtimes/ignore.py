@@ -0,0 +1,107 @@
+"""
+Files excluded from the bundles, using the syntax of .gitignore files:
+
+    # comments and blank lines are skipped
+    *.pyc          a name at any level
+    /data          anchored to the root of the project
+    outputs/       only directories
+    docs/**/*.png  ** matches many levels
+    !keep.pyc      negation, the last pattern matching wins
+
+Like git, files inside an ignored directory can't be included again, so
+ignored directories are not walked.
+"""
+import os
+import re
+from typing import Iterator, List, Optional, Pattern, Tuple
+
+from labfunctions import defaults
+
+# always ignored, extended by the .labignore file of the project
+DEFAULT_IGNORE = [
+    "/.venv/",
+    "/.git/",
+    "/.tox/",
+    f"/{defaults.CLIENT_TMP_FOLDER}/",
+    f"/{defaults.NB_COMPILED_DIR}/",
+]
+
+
+def _translate(pattern: str) -> str:
+    regex = ""
+    ix = 0
+    while ix < len(pattern):
+        c = pattern[ix]
+        if pattern.startswith("**/", ix):
+            regex += "(?:.*/)?"
+            ix += 3
+            continue
+        if pattern.startswith("**", ix):
+            regex += ".*"
+            ix += 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        else:
+            regex += re.escape(c)
+        ix += 1
+    return regex
+
+
+def compile_pattern(line: str) -> Optional[Tuple[Pattern, bool, bool]]:
+    """It returns the regex, if it's a negation and if it only
+    matches directories"""
+    line = line.rstrip("\n").rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    anchored = "/" in line
+    line = line.lstrip("/")
+    prefix = "^" if anchored else "^(?:.*/)?"
+    return re.compile(f"{prefix}{_translate(line)}$"), negate, dir_only
+
+
+class IgnoreRules:
+    def __init__(self, patterns: List[str]):
+        self.rules = [r for r in (compile_pattern(p) for p in patterns) if r]
+
+    @classmethod
+    def from_root(
+        cls, root: str = ".", ignore_file: str = defaults.LABIGNORE_FILE
+    ) -> "IgnoreRules":
+        patterns = list(DEFAULT_IGNORE)
+        try:
+            with open(os.path.join(root, ignore_file), "r") as f:
+                patterns.extend(f.readlines())
+        except FileNotFoundError:
+            pass
+        return cls(patterns)
+
+    def match(self, path: str, is_dir: bool = False) -> bool:
+        """If a path relative to the root is ignored"""
+        ignored = False
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path):
+                ignored = not negate
+        return ignored
+
+    def walk(self, root: str = ".") -> Iterator[str]:
+        """Files not ignored under root, relative to it. Ignored
+        directories are pruned from the walk."""
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel = os.path.relpath(dirpath, root)
+            rel = "" if rel == "." else f"{rel}/"
+            dirnames[:] = sorted(
+                d for d in dirnames if not self.match(f"{rel}{d}", is_dir=True)
+            )
+            for fname in sorted(filenames):
+                if not self.match(f"{rel}{fname}"):
+                    yield f"{rel}{fname}"
@@ -1,5 +1,7 @@
+import hashlib
+import re
 from pathlib import Path
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Optional, Tuple, Union
 
 from labfunctions import defaults
 from labfunctions.conf.jtemplates import get_package_dir, render_to_file
@@ -15,6 +17,38 @@ def generate_dockerfile(dst_root: Path, runtime: RuntimeSpec):
     )
 
 
+_DEPS_STAGE = re.compile(r"^FROM\s+\S+\s+as\s+deps\s*$", re.I | re.M)
+_APP_STAGE = re.compile(r"^FROM\s+deps(\s+as\s+\S+)?\s*$", re.I | re.M)
+
+
+def split_dockerfile(text: str) -> Union[Tuple[str, str], None]:
+    """
+    Dockerfiles generated from the default templates have a "deps" stage
+    with the requirements installed and a last stage, FROM deps, which
+    only copies the code. It returns both parts, or None if the Dockerfile
+    doesn't follow that layout.
+    """
+    app = _APP_STAGE.search(text)
+    if not app or not _DEPS_STAGE.search(text, 0, app.start()):
+        return None
+    return text[: app.start()], text[app.start() :]
+
+
+def app_dockerfile(app_stage: str, deps_image: str) -> str:
+    """The last stage of a split Dockerfile (see :func:`split_dockerfile`)
+    built on top of a deps image already built"""
+    return _APP_STAGE.sub(lambda m: f"FROM {deps_image}{m.group(1) or ''}", app_stage)
+
+
+def deps_key(deps_stages: str, requirements: bytes) -> str:
+    """The deps stages include the base image and the system packages"""
+    h = hashlib.sha256()
+    h.update(deps_stages.encode())
+    h.update(b"\0")
+    h.update(requirements)
+    return h.hexdigest()
+
+
 def get_runtimes_specs(from_file="runtimes.yaml") -> Dict[str, RuntimeSpec]:
     data = open_yaml(from_file)
     runtimes = {k: RuntimeSpec(name=k, **v) for k, v in data["runtimes"].items()}
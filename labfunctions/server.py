@@ -1,6 +1,6 @@
 from contextvars import ContextVar
 from importlib import import_module
-from typing import List
+from typing import Any, Dict, List, Optional
 
 from libq.job_store import RedisJobStore
 from sanic import Sanic
@@ -12,6 +12,7 @@ from labfunctions.cluster import ClusterControl
 from labfunctions.control import JobManager, SchedulerExec
 from labfunctions.db.nosync import AsyncSQL
 from labfunctions.events import EventManager
+from labfunctions.io.kv_cas import AsyncKVCas
 from labfunctions.io.kvspec import AsyncKVSpec
 from labfunctions.redis_conn import create_pool
 from labfunctions.security import auth_from_settings, sanic_init_auth
@@ -47,10 +48,21 @@ def create_db_instance(url) -> AsyncSQL:
 
 
 def create_projects_store(
-    store_class, store_bucket, base_root="/tmp/labstore"
+    store_class,
+    store_bucket,
+    base_root="/tmp/labstore",
+    chunk_size=None,
+    cas=False,
+    opts: Optional[Dict[str, Any]] = None,
 ) -> AsyncKVSpec:
     Class = get_class(store_class)
-    return Class(store_bucket, {"root": base_root})
+    opts = {"root": base_root, **(opts or {})}
+    if chunk_size:
+        opts["chunk_size"] = chunk_size
+    store = Class(store_bucket, opts)
+    if cas:
+        store = AsyncKVCas.wrap(store)
+    return store
 
 
 def create_app(
@@ -99,7 +111,11 @@ def create_app(
         _queue_pool = create_redis(settings.QUEUE_REDIS)
 
         current_app.ctx.kv_store = projects_store_func(
-            settings.PROJECTS_STORE_CLASS_ASYNC, settings.PROJECTS_STORE_BUCKET
+            settings.PROJECTS_STORE_CLASS_ASYNC,
+            settings.PROJECTS_STORE_BUCKET,
+            chunk_size=settings.PROJECTS_STORE_CHUNK_SIZE,
+            cas=settings.PROJECTS_STORE_CAS,
+            opts=settings.PROJECTS_STORE_OPTS,
         )
         current_app.ctx.web_redis = web_redis.client()
         current_app.ctx.queue_redis = _queue_pool
@@ -107,6 +123,11 @@ def create_app(
             _queue_pool, control_queue=settings.CONTROL_QUEUE
         )
         current_app.ctx.job_manager = JobManager(conn=_queue_pool)
+        if settings.KV_GC_INTERVAL:
+            await current_app.ctx.job_manager.register_kv_gc(
+                control_queue=settings.CONTROL_QUEUE,
+                interval=settings.KV_GC_INTERVAL,
+            )
         current_app.ctx.db = _db
 
         if settings.CLUSTER_FILEPATH:
@@ -31,6 +31,12 @@ class AgentConfig(BaseModel):
     agent_name: Optional[str] = None
     workers_n = 1
     max_jobs: int = 10
+    prepull_workers: int = defaults.AGENT_PREPULL_WORKERS
+    images_high_watermark: float = defaults.AGENT_IMAGES_HIGH_WATERMARK
+    images_low_watermark: float = defaults.AGENT_IMAGES_LOW_WATERMARK
+    warm_pool_size: int = 0
+    warm_max_reuse: int = defaults.AGENT_WARM_MAX_REUSE
+    warm_max_age: int = defaults.AGENT_WARM_MAX_AGE
 
 
 class AgentRequest(BaseModel):
@@ -3,13 +3,20 @@ from typing import Any, Dict, List, Optional
 from pydantic import BaseModel, BaseSettings, RedisDsn
 
 from labfunctions.defaults import (
+    AGENT_WARM_MAX_AGE,
+    AGENT_WARM_MAX_REUSE,
     EXECID_LEN,
+    KV_CACHE_MAX_BYTES,
+    KV_CHUNK_SIZE,
+    KV_GC_BATCH_SIZE,
     LABFILE_NAME,
     PROJECTID_MIN_LEN,
     SERVICE_URL,
     WFID_LEN,
 )
 
+from .storage import RetentionRule
+
 
 class ConfigCliType(BaseModel):
     """Config for default values for cli"""
@@ -85,6 +92,15 @@ class ServerSettings(BaseSettings):
     AGENT_ENV_FILE: str = ".env.dev.docker"
     AGENT_HEARTBEAT_CHECK: int = 60 * 5
     AGENT_HEARTBEAT_TTL: int = 80 * 3
+    # if set, agents keep the files downloaded from the projects store
+    # in this folder, see labfunctions.io.kv_disk_cache
+    AGENT_KV_CACHE_DIR: Optional[str] = None
+    AGENT_KV_CACHE_MAX_BYTES: int = KV_CACHE_MAX_BYTES
+    # idle containers kept by runtime, 0 disables the warm pool,
+    # see labfunctions.executors.warm_pool
+    AGENT_WARM_POOL_SIZE: int = 0
+    AGENT_WARM_MAX_REUSE: int = AGENT_WARM_MAX_REUSE
+    AGENT_WARM_MAX_AGE: int = AGENT_WARM_MAX_AGE
 
     # Logs:
     LOGLEVEL: str = "INFO"
@@ -94,6 +110,18 @@ class ServerSettings(BaseSettings):
     PROJECTS_STORE_CLASS_ASYNC = "labfunctions.io.kv_local.AsyncKVLocal"
     PROJECTS_STORE_CLASS_SYNC = "labfunctions.io.kv_local.KVLocal"
     PROJECTS_STORE_BUCKET = "labfunctions"
+    PROJECTS_STORE_CHUNK_SIZE: int = KV_CHUNK_SIZE
+    # extra options for the store class, like {"atomic": true, "shards": 2}
+    # for the local store. They are shared by the web server and the agents.
+    PROJECTS_STORE_OPTS: Dict[str, Any] = {}
+    # store the projects data by content, see labfunctions.io.kv_cas
+    PROJECTS_STORE_CAS: bool = False
+    # what is deleted by the kv gc task, see labfunctions.io.kv_gc
+    # nothing is deleted without rules
+    KV_RETENTION: List[RetentionRule] = []
+    KV_GC_BATCH_SIZE: int = KV_GC_BATCH_SIZE
+    # if set, the gc runs periodically, ex: "24h"
+    KV_GC_INTERVAL: Optional[str] = None
     EXT_KV_LOCAL_ROOT: Optional[str] = None
     EXT_KV_FILE_URL: Optional[str] = None
 
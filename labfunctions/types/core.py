@@ -38,6 +38,10 @@ class NBTask(BaseModel):
     :param notifications_ok: If ok send a notification to discord or slack.
     :param notifications_fail: If not ok, send notification to discord or slack.
     but internally the task also send a notification if the user wants.
+    :param compiled: run the notebook compiled to a python script, without
+    a kernel. The output notebook is only written when it fails.
+    :param compiled_output: write the output notebook of compiled executions
+    when they don't fail too.
     """
 
     nb_name: str
@@ -53,6 +57,8 @@ class NBTask(BaseModel):
     timeout: int = 10800  # secs 3h default
     notifications_ok: Optional[List[str]] = None
     notifications_fail: Optional[List[str]] = None
+    compiled: bool = False
+    compiled_output: bool = False
     # schedule: Optional[ScheduleData] = None
 
 
@@ -85,6 +91,8 @@ class ExecutionNBTask(BaseModel):
     remote_output: Optional[str]
     notifications_ok: Optional[List[str]] = None
     notifications_fail: Optional[List[str]] = None
+    compiled: bool = False
+    compiled_output: bool = False
 
 
 class ExecutionResult(BaseModel):
@@ -110,6 +118,8 @@ class ExecutionResult(BaseModel):
     output_dir: Optional[str] = None
     error_dir: Optional[str] = None
     error_msg: Optional[str] = None
+    # time spent pulling the image, not included in elapsed_secs
+    pull_secs: Optional[float] = None
 
 
 @dataclass
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel
 
@@ -29,6 +29,10 @@ class DockerSpec(BaseModel):
     requirements: str = "requirements.txt"
     gpu: Optional[DockerGPUSpec] = None
     extra: Optional[Dict[str, Any]] = None
+    # jupyter kernels kept warm by the warm containers of the agents and
+    # modules imported in them, see labfunctions.executors.kernel_pool
+    kernels: int = 0
+    preimport: Optional[List[str]] = None
 
 
 class RuntimeSpec(BaseModel):
@@ -38,6 +42,9 @@ class RuntimeSpec(BaseModel):
     gpu_support: bool = False
     version: Optional[str] = None
     registry: Optional[str] = None
+    # agents of these clusters pre-pull the image when a version is
+    # registered, all the clusters if None
+    clusters: Optional[List[str]] = None
 
 
 class RuntimeReq(BaseModel):
@@ -47,6 +54,7 @@ class RuntimeReq(BaseModel):
     project_id: str
     version: str
     registry: Optional[str]
+    build_key: Optional[str] = None
 
 
 class RuntimeData(BaseModel):
@@ -62,6 +70,7 @@ class RuntimeData(BaseModel):
     version: str
     created_at: Optional[str] = None
     registry: Optional[str] = None
+    build_key: Optional[str] = None
     id: Optional[int] = None
 
 
@@ -74,6 +83,21 @@ class ProjectBundleFile(BaseModel):
     stash: Optional[bool] = False
     current: Optional[bool] = False
     format_type: str = "zip"
+    digest: Optional[str] = None
+
+
+class BundleManifest(BaseModel):
+    """
+    Files of a bundle with their hashes (git blob ids for bundles from git,
+    sha256 for the current folder).
+
+    :param digest: hash of the files, the spec and the secrets of the runtime
+    """
+
+    runtime_name: str
+    version: str
+    files: Dict[str, str]
+    digest: str
 
 
 class BuildCtx(BaseModel):
@@ -94,6 +118,15 @@ class BuildCtx(BaseModel):
     :param execid: random id to register this task
     :param project_store_class: which type of storage use to download the bundle
     :param project_store_bucket: bucket to find the bundle file.
+    :param project_store_opts: options for the store.
+    :param bundle_format: zip, tar.zst or tar.gz, see defaults.BUNDLE_FORMATS
+    :param bundle_digest: digest of the bundle, see BundleManifest
+    :param build_key: hash of the bundle digest, the spec and the Dockerfile,
+    see labfunctions.runtimes.context.build_key
+    :param reuse: runtimeid of a runtime built with the same build_key, its
+    image is tagged with this version instead of building it again
+    :param enqueued: False if the runtime was already built with the same
+    build_key, then nothing is done
 
     :param registry: registry to push the docker image built
     """
@@ -108,4 +141,10 @@ class BuildCtx(BaseModel):
     execid: str
     project_store_class: str
     project_store_bucket: str
+    project_store_opts: Dict[str, Any] = {}
     registry: Optional[str] = None
+    bundle_format: str = defaults.BUNDLE_FORMAT
+    bundle_digest: Optional[str] = None
+    build_key: Optional[str] = None
+    reuse: Optional[str] = None
+    enqueued: bool = True
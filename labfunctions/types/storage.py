@@ -0,0 +1,43 @@
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class RetentionRule(BaseModel):
+    """
+    What to keep of the files of a project in the projects store.
+
+    :param projectid: a project id or a glob pattern like "*"
+    :param prefix: folder inside the project, like "uploads" or "outputs/ok"
+    :param keep_last: versions kept of each file; versions are the files
+    of the same folder with the same name until the first dot
+    ("main.v1.zip", "main.v2.zip"), newest first.
+    :param keep_days: files older than this are deleted
+    """
+
+    projectid: str = "*"
+    prefix: str
+    keep_last: Optional[int] = None
+    keep_days: Optional[int] = None
+
+
+class KVGCTask(BaseModel):
+    """
+    :param projects: projects to collect, all the projects if empty.
+    :param max_projects: projects walked by run, the next run continues
+    from the last one.
+    :param dry_run: only the usage is computed, nothing is deleted.
+    """
+
+    projects: List[str] = []
+    max_projects: Optional[int] = None
+    dry_run: bool = False
+
+
+class KVUsage(BaseModel):
+    projectid: str
+    objects: int = 0
+    bytes: int = 0
+    deleted_objects: int = 0
+    deleted_bytes: int = 0
+    updated_at: Optional[str] = None
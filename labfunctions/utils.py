@@ -8,6 +8,7 @@ import resource
 import socket
 import subprocess
 import sys
+import threading
 import unicodedata
 from datetime import datetime
 from functools import wraps
@@ -83,6 +84,70 @@ def run_sync(func, *args, **kwargs):
     return rsp
 
 
+class _StreamEnd:
+    def __init__(self, error=None):
+        self.error = error
+
+
+async def iterate_in_thread(func, *args, maxsize=8):
+    """
+    Iterate a sync generator from async code. The generator runs in its own
+    thread and items are passed through a bounded queue: when the consumer
+    is slower, the thread waits, so memory is bounded to maxsize items.
+
+    :param func: a generator function, called with args in the thread
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize)
+    stop = threading.Event()
+
+    def _put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def _produce():
+        error = None
+        try:
+            for item in func(*args):
+                if stop.is_set():
+                    return
+                _put(item)
+        except Exception as e:  # pylint: disable=broad-except
+            error = e
+        if not stop.is_set():
+            _put(_StreamEnd(error))
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = await queue.get()
+            if isinstance(item, _StreamEnd):
+                if item.error:
+                    raise item.error
+                break
+            yield item
+    finally:
+        # if the consumer stops early, the thread could be waiting for a slot
+        stop.set()
+        while not queue.empty():
+            queue.get_nowait()
+
+
+def iterate_from_thread(agen, loop):
+    """
+    Iterate an async generator from a sync function running in another
+    thread, items are requested one by one to the event loop.
+    """
+    it = agen.__aiter__()
+    while True:
+        fut = asyncio.run_coroutine_threadsafe(it.__anext__(), loop)
+        try:
+            item = fut.result()
+        except StopAsyncIteration:
+            return
+        yield item
+
+
 def get_query_param(request, key, default_val=None):
     val = request.args.get(key, [default_val])
     return val[0]
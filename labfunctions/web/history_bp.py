@@ -5,7 +5,7 @@ from dataclasses import asdict
 
 import httpx
 from sanic import Blueprint
-from sanic.response import json
+from sanic.response import file_stream, json
 from sanic_ext import openapi
 
 from labfunctions import defaults
@@ -157,8 +157,17 @@ async def history_get_output(request, projectid):
     # pylint: disable=unused-argument
     uri = request.args.get("file")
     key = f"{projectid}/{uri}"
-    response = await request.respond(content_type="application/octet-stream")
     kv_store = get_kvstore(request)
+    fpath = kv_store.local_path(key)
+    if fpath:
+        # the file is read directly, in big chunks, without the store
+        return await file_stream(
+            fpath,
+            chunk_size=settings.PROJECTS_STORE_CHUNK_SIZE,
+            mime_type="application/octet-stream",
+        )
+
+    response = await request.respond(content_type="application/octet-stream")
     async for chunk in kv_store.get_stream(key):
         await response.send(chunk)
     await response.eof()
@@ -1,7 +1,7 @@
 # pylint: disable=unused-argument
 import json as std_json
 import pathlib
-from typing import List, Union
+from typing import List
 
 import httpx
 from sanic import Blueprint, Request, Sanic, exceptions
@@ -11,8 +11,13 @@ from sanic_ext import openapi
 from labfunctions import defaults, types
 from labfunctions.conf.server_settings import settings
 from labfunctions.defaults import API_VERSION
+from labfunctions.io.kvspec import KeyReadError, KeyWriteError
 from labfunctions.managers import projects_mg, users_mg
-from labfunctions.runtimes.context import build_upload_uri, create_build_ctx
+from labfunctions.runtimes.context import (
+    build_upload_uri,
+    bundle_digest_uri,
+    create_build_ctx,
+)
 from labfunctions.security import get_auth
 from labfunctions.security.web import protected
 from labfunctions.utils import run_async, secure_filename
@@ -202,27 +207,40 @@ async def project_agents_list(request, projectid: str):
 @projects_bp.post("/<projectid:str>/_build")
 @openapi.body({"application/json": types.RuntimeSpec})
 @openapi.parameter("version", str, "query")
+@openapi.parameter("format", str, "query")
+@openapi.parameter("digest", str, "query")
 @openapi.body({"application/json": types.runtimes.BuildCtx})
 @protected()
 async def project_build(request, projectid):
     """
-    Enqueue docker build image
+    Enqueue docker build image. If the runtime version was already built
+    from the same bundle, nothing is enqueued and 200 is returned.
     """
     # pylint: disable=unused-argument
     spec = types.RuntimeSpec(**request.json)
     version = get_query_param2(request, "version", None)
+    fmt = get_query_param2(request, "format", defaults.BUNDLE_FORMAT)
+    if fmt not in defaults.BUNDLE_FORMATS:
+        return json(dict(msg=f"bad bundle format {fmt}"), 400)
     scheduler = get_scheduler2(request)
     session = request.ctx.session
     ctx = await scheduler.enqueue_build(
-        session, runtime=spec, projectid=projectid, version=version
+        session,
+        runtime=spec,
+        projectid=projectid,
+        version=version,
+        bundle_format=fmt,
+        bundle_digest=get_query_param2(request, "digest", None),
     )
 
-    return json(ctx.dict(), 202)
+    return json(ctx.dict(), 202 if ctx.enqueued else 200)
 
 
 @projects_bp.post("/<projectid:str>/_upload", stream=True)
 @openapi.parameter("version", str, "query")
 @openapi.parameter("runtime", str, "query")
+@openapi.parameter("digest", str, "query")
+@openapi.parameter("format", str, "query")
 @protected()
 async def project_upload(request, projectid):
     """
@@ -233,15 +251,21 @@ async def project_upload(request, projectid):
     root = pathlib.Path(projectid)
     version = get_query_param2(request, "version", None)
     runtime_name = get_query_param2(request, "runtime", None)
+    fmt = get_query_param2(request, "format", defaults.BUNDLE_FORMAT)
+    if fmt not in defaults.BUNDLE_FORMATS:
+        return json(dict(msg=f"bad bundle format {fmt}"), 400)
     session = request.ctx.session
     async with session.begin():
         pd = await projects_mg.get_by_projectid(session, projectid)
 
-    uri = build_upload_uri(pd.projectid, runtime_name, version)
+    uri = build_upload_uri(pd.projectid, runtime_name, version, fmt)
 
     kv = get_kvstore(request)
     rsp = await kv.put_stream(uri, stream_reader(request))
     if rsp:
+        digest = get_query_param2(request, "digest", None)
+        if digest:
+            await _save_bundle(kv, uri, bundle_digest_uri(pd.projectid, digest, fmt))
         return json(dict(msg="ok"), 201)
     else:
         return empty()
@@ -254,6 +278,99 @@ async def project_upload(request, projectid):
     #    return empty()
 
 
+@projects_bp.get("/<projectid:str>/_usage")
+@openapi.parameter("projectid", str, "path")
+@openapi.response(200, types.storage.KVUsage, "usage of the projects store")
+@openapi.response(404, "not found")
+@protected()
+async def project_usage(request, projectid):
+    """
+    Bytes and objects of the project in the projects store,
+    as computed by the last run of the kv gc task
+    """
+    # pylint: disable=unused-argument
+    redis = request.ctx.web_redis
+    data = await redis.get(f"{defaults.KV_GC_USAGE_PREFIX}{projectid}")
+    if data:
+        return json(std_json.loads(data), 200)
+    return json(dict(msg="not found"), 404)
+
+
+@projects_bp.post("/<projectid:str>/_gc")
+@openapi.parameter("projectid", str, "path")
+@openapi.parameter("dry_run", bool, "query")
+@protected()
+async def project_gc(request, projectid):
+    """
+    Enqueue the retention rules of the projects store for this project
+    """
+    # pylint: disable=unused-argument
+    dry_run = get_query_param2(request, "dry_run", "false") == "true"
+    scheduler = get_scheduler2(request)
+    task = types.storage.KVGCTask(projects=[projectid], dry_run=dry_run)
+    job = await scheduler.enqueue_kv_gc(task)
+    return json(dict(jobid=job._id), 202)
+
+
+async def _copy(kv, src: str, dst: str) -> bool:
+    try:
+        return bool(await kv.put_stream(dst, kv.get_stream(src)))
+    except (KeyReadError, KeyWriteError):
+        return False
+
+
+async def _save_bundle(kv, uri: str, digest_uri: str):
+    """Keep a copy of the upload by its digest, the upload uri is
+    overwritten by the next upload of the same version"""
+    if await kv.exists(digest_uri):
+        return
+    if not await _copy(kv, uri, digest_uri):
+        # the next build with this digest will upload it again
+        await kv.delete(digest_uri)
+
+
+@projects_bp.route("/<projectid:str>/_bundles/<digest:str>", methods=["HEAD"])
+@openapi.parameter("projectid", str, "path")
+@openapi.parameter("digest", str, "path")
+@openapi.parameter("format", str, "query")
+@protected()
+async def project_bundle_exists(request, projectid, digest):
+    """
+    Check if a bundle with this digest was already uploaded
+    """
+    # pylint: disable=unused-argument
+    fmt = get_query_param2(request, "format", defaults.BUNDLE_FORMAT)
+    kv = get_kvstore(request)
+    exists = await kv.exists(bundle_digest_uri(projectid, digest, fmt))
+    return empty(200 if exists else 404)
+
+
+@projects_bp.post("/<projectid:str>/_bundles/<digest:str>")
+@openapi.parameter("projectid", str, "path")
+@openapi.parameter("digest", str, "path")
+@openapi.parameter("version", str, "query")
+@openapi.parameter("runtime", str, "query")
+@openapi.parameter("format", str, "query")
+@protected()
+async def project_bundle_link(request, projectid, digest):
+    """
+    Use a bundle already uploaded for a runtime version,
+    instead of uploading it again. The bundle must have the same format.
+    """
+    # pylint: disable=unused-argument
+    version = get_query_param2(request, "version", None)
+    runtime_name = get_query_param2(request, "runtime", None)
+    fmt = get_query_param2(request, "format", defaults.BUNDLE_FORMAT)
+    kv = get_kvstore(request)
+    src = bundle_digest_uri(projectid, digest, fmt)
+    if not await kv.exists(src):
+        return json(dict(msg="not found"), 404)
+    uri = build_upload_uri(projectid, runtime_name, version, fmt)
+    if not await _copy(kv, src, uri):
+        return json(dict(msg="bundle not copied"), 500)
+    return json(dict(msg="ok"), 201)
+
+
 @projects_bp.get("/<projectid:str>/_private_key")
 @openapi.parameter("projectid", str, "path")
 @openapi.response(200, "project")
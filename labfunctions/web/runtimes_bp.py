@@ -1,14 +1,20 @@
+import logging
 from typing import List
 
+from redis.exceptions import RedisError
 from sanic import Blueprint, Request
 from sanic.response import empty, json, stream
 from sanic_ext import openapi
 
+from labfunctions.control.images import publish_runtime
 from labfunctions.defaults import API_VERSION
 from labfunctions.managers import runtimes_mg
+from labfunctions.managers.runtimes_mg import runtime_rid
 from labfunctions.security.web import protected
 from labfunctions.types.runtimes import RuntimeData, RuntimeReq
-from labfunctions.web.utils import get_query_param2
+from labfunctions.web.utils import get_query_param2, get_scheduler2
+
+logger = logging.getLogger(__name__)
 
 runtimes_bp = Blueprint("runtimes", url_prefix="runtimes", version=API_VERSION)
 
@@ -28,6 +34,22 @@ async def runtimes_list(request: Request, projectid: str):
     return json([r.dict() for r in rows], 200)
 
 
+@runtimes_bp.get("/<projectid>/_build_keys/<build_key:str>")
+@openapi.parameter("projectid", str, "path")
+@openapi.parameter("build_key", str, "path")
+@openapi.response(200, RuntimeData, "last runtime built with this key")
+@openapi.response(404, "not found")
+@protected()
+async def runtimes_by_build_key(request: Request, projectid: str, build_key: str):
+    """runtime built from the same bundle and spec, used to reuse its image"""
+    session = request.ctx.session
+    async with session.begin():
+        rd = await runtimes_mg.get_by_build_key(session, projectid, build_key)
+    if rd:
+        return json(rd.dict(), 200)
+    return json({"msg": "not found"}, 404)
+
+
 @runtimes_bp.post("/<projectid>")
 @openapi.body({"application/json": RuntimeReq})
 @openapi.parameter("projectid", str, "path")
@@ -42,6 +64,15 @@ async def runtimes_create(request: Request, projectid):
     code = 201
     if not created:
         code = 200
+    else:
+        # agents pre-pull the image, see labfunctions.control.images
+        scheduler = get_scheduler2(request)
+        rd = RuntimeData(runtimeid=runtime_rid(rq), **rq.dict())
+        try:
+            await publish_runtime(scheduler.conn, rd)
+        except RedisError as e:
+            # the runtime is registered, pre-pulling is best effort
+            logger.warning("Runtime %s not published: %s", rd.runtimeid, e)
     return json({"msg": "ok"}, code)
 
 
@@ -8,8 +8,16 @@ from labfunctions.client.nbclient import NBClient
 from labfunctions.conf.server_settings import settings
 from labfunctions.io.kvspec import GenericKVSpec
 from labfunctions.runtimes import builder
+from labfunctions.runtimes.archive import tar_files
+from labfunctions.runtimes.utils import generate_dockerfile
 
-from .factories import BuildCtxFactory, DockerBuildLogFactory, ProjectDataFactory
+from .factories import (
+    BuildCtxFactory,
+    DockerBuildLogFactory,
+    ProjectDataFactory,
+    RuntimeDataFactory,
+    RuntimeSpecFactory,
+)
 
 # spy = mocker.spy(builder, "docker_build")
 
@@ -40,20 +48,14 @@ def test_builder_BuildTask_init(mocker: MockerFixture, kvstore):
 
 
 def test_builder_BuildTask_get_runtime(mocker: MockerFixture, kvstore, tempdir):
-    def stream_data(any_):
-        for x in range(5):
-            yield str(x).encode()
-
-    mock = mocker.MagicMock()
-    mock.get_stream.return_value = [str(x).encode() for x in range(6)]
-    # mock.get_stream = stream_data
+    kvstore.put("dowload_zip_url", b"012345")
     client = NBClient(url_service="http://localhost:8000")
     task = builder.BuildTask(client, kvstore=kvstore)
-    task.kv = mock
+    spy = mocker.spy(kvstore, "get_file")
     task.get_runtime_file(f"{tempdir}/test.zip", "dowload_zip_url")
-    is_file = Path(f"{tempdir}/test.zip").is_file()
-    assert is_file
-    assert mock.get_stream.called
+    data = Path(f"{tempdir}/test.zip").read_bytes()
+    assert data == b"012345"
+    assert spy.called
 
 
 def test_builder_BuildTask_run(mocker: MockerFixture, kvstore, tempdir):
@@ -130,3 +132,98 @@ def test_builder_exec(mocker: MockerFixture, kvstore):
     assert task_mock.call_args[0][0].execid == ctx.execid
     # assert task_mock.call_args_list[0][0][0] == ctx.projectid
     assert result.error is False
+
+
+def test_builder_BuildTask_run_tar_stream(
+    mocker: MockerFixture, kvstore, tempdir, monkeypatch
+):
+    monkeypatch.chdir(tempdir)
+    Path("main.py").write_text("print(1)")
+    tar_files("bundle.tar.gz", ["main.py"], fmt="tar.gz", prefix="src/")
+    kvstore.put_file("test.current.tar.gz", "bundle.tar.gz")
+    ctx = BuildCtxFactory(
+        download_zip="test.current.tar.gz",
+        zip_name="test.current.tar.gz",
+        bundle_format="tar.gz",
+    )
+    extracted = []
+
+    def _build(path, *args, **kwargs):
+        extracted.extend(sorted(p.name for p in Path(path).iterdir()))
+        return DockerBuildLogFactory()
+
+    mocker.patch.object(kvstore, "local_path", return_value=None)
+    get_stream = mocker.spy(kvstore, "get_stream")
+    get_file = mocker.spy(kvstore, "get_file")
+    cmd = mocker.patch("labfunctions.runtimes.builder.DockerCommand")
+    cmd.return_value.build.side_effect = _build
+
+    task = builder.BuildTask(
+        NBClient(url_service="http://localhost:8000"), kvstore=kvstore
+    )
+    task.run(ctx)
+
+    assert extracted == ["main.py"]
+    assert get_stream.called
+    assert not get_file.called
+
+
+def test_builder_BuildTask_run_reuse(mocker: MockerFixture, kvstore):
+    client = NBClient(url_service="http://localhost:8000")
+    ctx = BuildCtxFactory(build_key="abc", version="v2", registry="testregistry")
+    rd = RuntimeDataFactory(
+        docker_name="nbworkflows/test", version="v1", registry="testregistry"
+    )
+    mocker.patch.object(client, "runtime_by_build_key", return_value=rd)
+    cmd = mocker.patch("labfunctions.runtimes.builder.DockerCommand")
+    cmd.return_value.retag.return_value = DockerBuildLogFactory()
+    extract = mocker.spy(builder.BuildTask, "extract_runtime")
+
+    task = builder.BuildTask(client, kvstore=kvstore)
+    log_run = task.run(ctx)
+
+    assert not log_run.error
+    assert not extract.called
+    assert cmd.return_value.retag.call_args[0] == (
+        "testregistry/nbworkflows/test:v1",
+        "testregistry/nbworkflows/test",
+        "v2",
+    )
+    assert cmd.return_value.retag.call_args[1]["push"]
+
+
+def test_builder_BuildTask_run_split(mocker: MockerFixture, kvstore, tempdir):
+    spec = RuntimeSpecFactory()
+    Path(f"{tempdir}/src").mkdir()
+    generate_dockerfile(Path(f"{tempdir}/src"), spec)
+    Path(f"{tempdir}/src/{spec.container.requirements}").write_text("pandas")
+    ctx = BuildCtxFactory(spec=spec, dockerfile=f"Dockerfile.{spec.name}")
+    dockerfiles = []
+
+    def _build(path, dockerfile, *args, **kwargs):
+        dockerfiles.append(Path(dockerfile).read_text())
+        return DockerBuildLogFactory()
+
+    mocker.patch("labfunctions.runtimes.builder.BuildTask.extract_runtime")
+    mocker.patch(
+        "labfunctions.runtimes.builder.tempfile.TemporaryDirectory"
+    ).return_value.__enter__.return_value = tempdir
+    cmd = mocker.patch("labfunctions.runtimes.builder.DockerCommand")
+    cmd.return_value.build.side_effect = _build
+    cmd.return_value.image_exists.side_effect = [False, True]
+
+    task = builder.BuildTask(
+        NBClient(url_service="http://localhost:8000"), kvstore=kvstore
+    )
+    task.run(ctx)
+    first = list(cmd.return_value.build.call_args_list)
+    task.run(ctx)
+    second = cmd.return_value.build.call_args_list[len(first) :]
+
+    deps_image = cmd.return_value.image_exists.call_args[0][0]
+    assert [c[1].get("target") for c in first] == ["deps", None]
+    assert first[0][1]["tag"] == "nbworkflows/test-deps"
+    assert deps_image.startswith("nbworkflows/test-deps:")
+    assert len(second) == 1
+    assert dockerfiles[-1].startswith(f"FROM {deps_image} as app")
+    assert "pip install" not in dockerfiles[-1]
@@ -2,10 +2,16 @@ from labfunctions import context as ctx
 from labfunctions import defaults
 from labfunctions import defaults as df
 from labfunctions.executors.execid import ExecID
+from labfunctions.runtimes.context import build_key, create_build_ctx
 from labfunctions.types import ProjectData, WorkflowDataWeb
 from tests import factories
 
-from .factories import NBTaskFactory, ProjectDataFactory, RuntimeDataFactory
+from .factories import (
+    NBTaskFactory,
+    ProjectDataFactory,
+    RuntimeDataFactory,
+    RuntimeSpecFactory,
+)
 
 
 def test_context_ExecID():
@@ -38,8 +44,11 @@ def test_context_prepare_runtime():
     rd = RuntimeDataFactory()
     run = ctx.prepare_runtime(rd)
     run2 = ctx.prepare_runtime()
+    rd.registry = "registry.example.com"
+    run3 = ctx.prepare_runtime(rd)
     assert run.endswith(rd.version)
     assert run2.startswith("nuxion")
+    assert run3 == f"registry.example.com/{rd.docker_name}:{rd.version}"
 
 
 def test_context_create_nb_ctx_dummy():
@@ -88,3 +97,26 @@ def test_context_create_nb_ctx_dummy():
 #     exec_task = ctx.create_notebook_ctx_ondemand(pd, task)
 #     res = ctx.make_error_result(exec_task, 10)
 #     assert res.error
+
+
+def test_context_build_key():
+    spec = RuntimeSpecFactory()
+    dockerfile = f"Dockerfile.{spec.name}"
+    k1 = build_key(spec, dockerfile, "abc")
+    k2 = build_key(spec, dockerfile, "abc")
+    k3 = build_key(spec, dockerfile, "abd")
+    k4 = build_key(RuntimeSpecFactory(), dockerfile, "abc")
+    bctx = create_build_ctx(
+        "prj",
+        spec,
+        "v1",
+        "labfunctions.io.kv_local.KVLocal",
+        "test",
+        bundle_digest="abc",
+    )
+
+    assert build_key(spec, dockerfile, None) is None
+    assert k1 == k2
+    assert k1 != k3
+    assert k1 != k4
+    assert bctx.build_key == k1
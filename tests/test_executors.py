@@ -0,0 +1,286 @@
+import fcntl
+import io
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from pathlib import Path
+
+import nbformat
+import papermill as pm
+import pytest
+
+import docker
+from labfunctions.executors.kernel_pool import KernelPool
+from labfunctions.executors.nbtask_base import NBTaskLocal
+from labfunctions.executors.warm_pool import (
+    LABEL_CREATED,
+    LABEL_IMAGE,
+    WARM_DONE_MARK,
+    WarmPool,
+    warm_loop,
+)
+from labfunctions.notebooks import create_notebook_ctx
+from labfunctions.notebooks.compiled import compile_notebooks, compiled_path
+from labfunctions.types import NBTask
+
+
+def _container(mocker, cid, status="running", created=None):
+    c = mocker.MagicMock()
+    c.id = cid
+    c.status = status
+    c.labels = {LABEL_CREATED: str(int(created or time.time()))}
+    return c
+
+
+def _frame(data: bytes) -> bytes:
+    # the multiplexed stream of docker: stdout, size and data
+    return struct.pack(">BxxxL", 1, len(data)) + data
+
+
+def test_executors_warm_loop(tempdir, monkeypatch, mocker):
+    monkeypatch.chdir(tempdir)
+    os.mkdir("data")
+    runs = []
+
+    def _exec(kernels=None):
+        task = json.loads(os.environ["TASK"])
+        created = os.path.exists("data/output.csv") or os.path.exists("outputs")
+        runs.append((task, "LEAKED" in os.environ, created))
+        os.environ["LEAKED"] = "yes"
+        Path("data/output.csv").write_text("x")
+        os.makedirs("outputs/nested")
+        os.chdir("outputs")
+        if len(runs) == 2:
+            raise ValueError("failed")
+        return mocker.MagicMock(error=False)
+
+    mocker.patch("labfunctions.executors.local_exec.local_exec_env", _exec)
+    lines = [json.dumps({"TASK": json.dumps(ix)}) for ix in range(3)]
+    stdin = io.StringIO("\n".join(lines) + "\n")
+    stdout = io.StringIO()
+
+    total = warm_loop(2, stdin=stdin, stdout=stdout)
+    out = stdout.getvalue()
+    os.environ.pop("LEAKED", None)
+
+    assert total == 2
+    assert runs == [(0, False, False), (1, False, False)]
+    assert f"{WARM_DONE_MARK} 0" in out
+    assert f"{WARM_DONE_MARK} 1" in out
+    assert os.path.isdir(f"{tempdir}/data")
+
+
+def test_executors_warm_pool_run(tempdir, mocker):
+    agent, container = socket.socketpair()
+    c = _container(mocker, "c1")
+    cmd = mocker.MagicMock()
+    cmd.docker.containers.list.return_value = [c]
+    cmd.docker.api.attach_socket.return_value = agent
+    pool = WarmPool(cmd, lock_dir=tempdir)
+    received = []
+
+    def _warm():
+        received.append(container.makefile().readline())
+        container.sendall(_frame(b"executed\n"))
+        container.sendall(_frame(f"\n{WARM_DONE_MARK} 0\n".encode()))
+
+    th = threading.Thread(target=_warm)
+    th.start()
+    result = pool.run("nbworkflows/test:v1", {"TASK": "{}"}, timeout=10)
+    th.join()
+    taken = pool.acquire("nbworkflows/test:v1")
+    busy = pool.run("nbworkflows/test:v1", {"TASK": "{}"}, timeout=10)
+    container.close()
+
+    assert json.loads(received[0]) == {"TASK": "{}"}
+    assert result.status == 0
+    assert result.msg.strip() == "executed"
+    assert taken[0] == c
+    assert busy is None
+
+
+def test_executors_warm_pool_fill(tempdir, mocker):
+    dead = _container(mocker, "dead", status="exited")
+    old = _container(mocker, "old", created=time.time() - 3600)
+    idle = _container(mocker, "idle")
+    cmd = mocker.MagicMock()
+    cmd.docker.containers.list.return_value = [dead, old, idle]
+    pool = WarmPool(cmd, size=3, max_age=60, lock_dir=tempdir)
+
+    started = pool.fill("nbworkflows/test:v1")
+
+    assert started == 2
+    assert dead.remove.called
+    assert old.remove.called
+    assert not idle.remove.called
+
+
+def test_executors_warm_pool_reap(tempdir, mocker):
+    dead = _container(mocker, "dead", status="exited")
+    old = _container(mocker, "old", created=time.time() - 3600)
+    busy = _container(mocker, "busy", created=time.time() - 3600)
+    idle = _container(mocker, "idle")
+    cmd = mocker.MagicMock()
+    cmd.docker.containers.list.return_value = [dead, old, busy, idle]
+    pool = WarmPool(cmd, max_age=60, lock_dir=tempdir)
+    fd = open(f"{tempdir}/busy.lock", "w")
+    fcntl.flock(fd, fcntl.LOCK_EX)
+
+    reaped = pool.reap()
+    drained = pool.drain("nbworkflows/test:v1")
+    fd.close()
+
+    assert reaped == 2
+    cmd.docker.containers.list.assert_any_call(all=True, filters={"label": LABEL_IMAGE})
+    assert not busy.remove.called
+    assert idle.remove.called
+    assert drained == 3  # dead and old are still listed by the mock
+
+
+def test_executors_warm_pool_unavailable(tempdir, mocker):
+    exited = _container(mocker, "exited")
+    silent = _container(mocker, "silent")
+    agent, container = socket.socketpair()
+    container.close()
+    cmd = mocker.MagicMock()
+    cmd.docker.api.attach_socket.side_effect = [
+        docker.errors.APIError("cannot attach to a stopped container"),
+        agent,
+    ]
+    pool = WarmPool(cmd, lock_dir=tempdir)
+
+    stopped = pool.execute(exited, {"TASK": "{}"}, timeout=10)
+    died = pool.execute(silent, {"TASK": "{}"}, timeout=10)
+
+    assert stopped is None
+    assert died is None
+    assert exited.remove.called
+    assert silent.remove.called
+
+
+def test_executors_warm_pool_refill(tempdir, mocker):
+    cmd = mocker.MagicMock()
+    cmd.docker.containers.list.return_value = []
+    pool = WarmPool(cmd, size=2, lock_dir=tempdir)
+    pool.want("nbworkflows/test:v1", require_gpu=True)
+    pool.want("nbworkflows/old:v1")
+    old = pool._wanted_path("nbworkflows/old:v1")
+    os.utime(old, (0, 0))
+
+    started = pool.refill()
+    pool.drain("nbworkflows/test:v1")
+
+    assert started == 2
+    assert cmd.docker.containers.run.call_args.kwargs["runtime"] == "nvidia"
+    assert not old.exists()
+    assert pool.wanted() == []
+
+
+def _notebook(path, *sources):
+    nb = nbformat.v4.new_notebook()
+    nb.metadata["kernelspec"] = {"name": "python3", "language": "python"}
+    nb.cells = [nbformat.v4.new_code_cell(src) for src in sources]
+    nbformat.write(nb, path)
+
+
+def test_executors_kernel_pool(tempdir):
+    first, second = f"{tempdir}/first.ipynb", f"{tempdir}/second.ipynb"
+    _notebook(first, "marker = 1")
+    _notebook(second, "import sys", "assert 'colorsys' in sys.modules", "marker")
+    pool = KernelPool(1, preimport=["colorsys"], cwd=tempdir)
+    try:
+        pool.fill()
+        km = pool.acquire("test/rt:v1")
+        kernel_id = km.kernel_id
+        pm.execute_notebook(first, f"{tempdir}/out1.ipynb", km=km)
+        pool.release("test/rt:v1", km)
+
+        km = pool.acquire("test/rt:v1")
+        with pytest.raises(pm.PapermillExecutionError) as e:
+            pm.execute_notebook(second, f"{tempdir}/out2.ipynb", km=km)
+        pool.release("test/rt:v1", km)
+    finally:
+        pool.shutdown()
+
+    # the same kernel, without the names of the previous execution
+    assert km.kernel_id == kernel_id
+    assert e.value.ename == "NameError"
+
+
+def test_executors_kernel_pool_env(tempdir, monkeypatch):
+    nb = f"{tempdir}/env.ipynb"
+    _notebook(nb, "import os", "assert os.environ['LF_EXECID'] == 'second'")
+    pool = KernelPool(1, cwd=tempdir)
+    try:
+        pool.fill()
+        km = pool.acquire("test/rt:v1", env={"LF_EXECID": "first"})
+        kernel_id = km.kernel_id
+        pool.release("test/rt:v1", km)
+
+        monkeypatch.setenv("LF_EXECID", "second")
+        km = pool.acquire("test/rt:v1")
+        pm.execute_notebook(nb, f"{tempdir}/out.ipynb", km=km)
+        pool.release("test/rt:v1", km)
+    finally:
+        pool.shutdown()
+
+    assert km.kernel_id == kernel_id
+
+
+def _compiled_project(root):
+    os.mkdir(f"{root}/notebooks")
+    with open(f"{root}/helper.py", "w") as f:
+        f.write("def double(x):\n    return x * 2\n")
+    nb = nbformat.v4.new_notebook()
+    params = nbformat.v4.new_code_cell("x = 1")
+    params.metadata["tags"] = ["parameters"]
+    nb.cells = [
+        nbformat.v4.new_markdown_cell("# Compiled"),
+        params,
+        nbformat.v4.new_code_cell("from helper import double\nprint(double(x))"),
+        nbformat.v4.new_code_cell("print(1 / x)"),
+    ]
+    nbformat.write(nb, f"{root}/notebooks/nb.ipynb")
+    magic = nbformat.v4.new_notebook()
+    magic.cells = [nbformat.v4.new_code_cell("%matplotlib inline")]
+    nbformat.write(magic, f"{root}/notebooks/magic.ipynb")
+
+
+def test_executors_compiled(tempdir, monkeypatch, mocker):
+    monkeypatch.chdir(tempdir)
+    _compiled_project(tempdir)
+    task = NBTask(nb_name="nb", params={"x": 21}, compiled=True)
+    ctx = create_notebook_ctx("test", task)
+
+    compiled = compile_notebooks(tempdir)
+    result = NBTaskLocal(mocker.MagicMock()).run(ctx)
+
+    assert compiled == 1
+    assert compiled_path("notebooks/nb.ipynb").exists()
+    assert not result.error
+    assert result.output_name is None
+    assert not os.path.exists(ctx.pm_output)
+
+
+def test_executors_compiled_error(tempdir, monkeypatch, mocker):
+    monkeypatch.chdir(tempdir)
+    _compiled_project(tempdir)
+    task = NBTask(nb_name="nb", params={"x": 0}, compiled=True)
+    ctx = create_notebook_ctx("test", task)
+
+    result = NBTaskLocal(mocker.MagicMock()).run(ctx)
+    nb = nbformat.read(f"{ctx.error_dir}/{ctx.output_name}", as_version=4)
+    injected = [
+        c for c in nb.cells if "injected-parameters" in c.metadata.get("tags", [])
+    ]
+    outputs = [c for c in nb.cells if c.get("outputs")]
+
+    assert result.error
+    assert "ZeroDivisionError" in result.error_msg
+    assert "x = 0" in injected[0].source
+    assert len(outputs) == 1
+    assert outputs[0].source == "print(1 / x)"
+    assert "ZeroDivisionError" in outputs[0].outputs[0].text
@@ -114,3 +114,16 @@ async def test_history_mg_create(async_session):
     assert isinstance(model_ok, HistoryModel)
     assert model_err.status == -1
     assert model_ok.status == 0
+
+
+@pytest.mark.asyncio
+async def test_history_bp_get_output(sanic_app, access_token):
+    kv = sanic_app.ctx.kv_store
+    await kv.put("test/outputs/ok/test.ipynb", b"notebook")
+    req, res = await sanic_app.asgi_client.get(
+        f"{version}/history/test/_get_output?file=outputs/ok/test.ipynb",
+        headers={"Authorization": f"Bearer {access_token}"},
+    )
+
+    assert res.status_code == 200
+    assert res.body == b"notebook"
@@ -0,0 +1,304 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+import pytest
+
+from labfunctions.io import cache
+
+
+def test_io_cache_hash_args():
+    h1 = cache.hash_args((1, "a"), {"b": {2, 3}, "c": {"x": 1, "y": 2}})
+    h2 = cache.hash_args((1, "a"), {"c": {"y": 2, "x": 1}, "b": {3, 2}})
+    h3 = cache.hash_args((2, "a"), {"b": {2, 3}, "c": {"x": 1, "y": 2}})
+
+    assert h1 == h2
+    assert h1 != h3
+
+
+def test_io_cache_equivalent_calls():
+    calls = []
+
+    def my_func(x, y=3):
+        calls.append(x)
+        return x * y
+
+    with tempfile.TemporaryDirectory() as tmp:
+        f = cache.frozen_result(wfid="test", cache_dir=tmp)(my_func)
+        keys = {f.cache_key(2, 3), f.cache_key(2, y=3), f.cache_key(2)}
+        results = [f(2, 3), f(2, y=3), f(2), f(x=2)]
+
+    assert len(keys) == 1
+    assert results == [6, 6, 6, 6]
+    assert calls == [2]
+
+
+def test_io_cache_is_valid_date():
+    two_days = (datetime.utcnow() - timedelta(days=2, minutes=1)).isoformat()
+    recent = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+
+    assert not cache.is_valid_date(two_days, 60)
+    assert cache.is_valid_date(recent, 60)
+
+
+def test_io_cache_frozen_result_between_execs():
+    calls = []
+
+    def my_func(x, y=1):
+        calls.append(x)
+        return x * y
+
+    with tempfile.TemporaryDirectory() as tmp:
+        f1 = cache.frozen_result(wfid="test", execid="exec1", cache_dir=tmp)(my_func)
+        f2 = cache.frozen_result(wfid="test", execid="exec2", cache_dir=tmp)(my_func)
+        r1 = f1(2, y=3)
+        r2 = f2(2, y=3)
+        r3 = f2(3, y=3)
+
+    assert r1 == r2 == 6
+    assert r3 == 9
+    assert calls == [2, 3]
+
+
+def test_io_cache_frozen_result_falsy():
+    calls = []
+
+    def empty():
+        calls.append(1)
+        return []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        f = cache.frozen_result(wfid="test", cache_dir=tmp)(empty)
+        f()
+        f()
+
+    assert len(calls) == 1
+
+
+def test_io_cache_evict_local():
+    with tempfile.TemporaryDirectory() as tmp:
+
+        @cache.frozen_result(wfid="test", cache_dir=tmp, max_entries=2)
+        def my_func(x):
+            return x
+
+        for x in range(3):
+            my_func(x)
+            # mtime resolution could be coarse, entries are aged manually
+            for e in Path(tmp).iterdir():
+                meta = e / "meta.json"
+                ts = meta.stat().st_mtime
+                os.utime(meta, (ts - 10, ts - 10))
+
+        keys = [p.name for p in Path(tmp).iterdir()]
+
+    assert len(keys) == 2
+
+
+def test_io_cache_memory_tier():
+    calls = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        @cache.frozen_result(wfid="test", cache_dir=tmp, memory=True)
+        def my_func(x):
+            calls.append(x)
+            return [x]
+
+        r1 = my_func(1)
+        for e in Path(tmp).iterdir():
+            (e / "data.pickle").unlink()
+        r2 = my_func(1)
+
+    assert r1 == r2
+    assert len(calls) == 1
+
+
+def test_io_cache_memory_tier_location():
+    calls = []
+
+    with tempfile.TemporaryDirectory() as tmp1, tempfile.TemporaryDirectory() as tmp2:
+
+        def my_func(x):
+            calls.append(x)
+            return [x]
+
+        cache.frozen_result(wfid="test", cache_dir=tmp1, memory=True)(my_func)(1)
+        cache.frozen_result(wfid="test", cache_dir=tmp2, memory=True)(my_func)(1)
+
+    assert len(calls) == 2
+
+
+def test_io_cache_pickle5():
+    np = pytest.importorskip("numpy")
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        @cache.frozen_result(wfid="test", cache_dir=tmp, serializer="pickle5")
+        def my_func(x):
+            return np.arange(x)
+
+        r1 = my_func(1000)
+        r2 = my_func(1000)
+        r2[0] = 10
+        r3 = my_func(1000)
+        buffers = list(Path(tmp).glob("*/buffer-*.bin"))
+
+    assert np.array_equal(r1, r3)
+    assert r2[0] == 10
+    assert len(buffers) == 1
+
+
+def test_io_cache_pickle5_rewrite():
+    np = pytest.importorskip("numpy")
+    with tempfile.TemporaryDirectory() as tmp:
+        conf = cache.CacheConfig(
+            name="test",
+            ctx=cache.build_ctx("test", "exec"),
+            cache_dir=tmp,
+            serializer="pickle5",
+        )
+        cache.cache_manager_write("key", np.arange(10), conf)
+        cache.cache_manager_write("key", np.arange(20), conf)
+        data, meta = cache.cache_manager_read("key", conf)
+        files = sorted(p.name for p in Path(tmp, "key").iterdir())
+
+    assert np.array_equal(data, np.arange(20))
+    assert files == [
+        f"buffer-{meta['generation']}-0.bin",
+        f"data-{meta['generation']}.pickle",
+        "meta.json",
+    ]
+
+
+def test_io_cache_parquet():
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+
+    calls = []
+    with tempfile.TemporaryDirectory() as tmp:
+
+        @cache.frozen_result(
+            wfid="test", cache_dir=tmp, serializer="parquet", columns=["a"]
+        )
+        def my_func(x):
+            calls.append(x)
+            return pd.DataFrame({"a": range(x), "b": range(x)})
+
+        r1 = my_func(10)
+        r2 = my_func(10)
+        frame = my_func.read_frame(10, filters=[("a", ">=", 5)])
+        missing = my_func.read_frame(11)
+        files = list(Path(tmp).glob("*/data.parquet"))
+
+    assert list(r1.columns) == ["a"]
+    assert list(r2.columns) == ["a"]
+    assert len(frame) == 5
+    assert list(frame.columns) == ["a", "b"]
+    assert missing is None
+    assert len(calls) == 1
+    assert len(files) == 1
+
+
+def test_io_cache_pack_blob():
+    blob = cache.pack_blob({"key": "test"}, b"payload")
+    meta, payload = cache.unpack_blob(blob)
+
+    assert meta["key"] == "test"
+    assert bytes(payload) == b"payload"
+
+
+def test_io_cache_fileserver(monkeypatch):
+    store = {}
+    requests = []
+
+    def handler(request: httpx.Request):
+        requests.append(request.method)
+        if request.method == "PUT":
+            store[request.url.path] = request.read()
+            return httpx.Response(201)
+        if request.url.path in store:
+            return httpx.Response(200, content=store[request.url.path])
+        return httpx.Response(404)
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(cache, "_http_client", client)
+    monkeypatch.setattr(cache.settings, "EXT_KV_FILE_URL", "http://fileserver/bucket")
+
+    @cache.frozen_result(wfid="test", strategy="fileserver")
+    def my_func(x):
+        return x * 2
+
+    r1 = my_func(2)
+    r2 = my_func(2)
+
+    assert r1 == r2 == 4
+    # miss: GET + GET under the single flight lock + PUT, hit: GET
+    assert requests == ["GET", "GET", "PUT", "GET"]
+
+
+def test_io_cache_fileserver_write_failed(monkeypatch):
+    client = httpx.Client(
+        transport=httpx.MockTransport(lambda request: httpx.Response(500))
+    )
+    monkeypatch.setattr(cache, "_http_client", client)
+    monkeypatch.setattr(cache.settings, "EXT_KV_FILE_URL", "http://fileserver/bucket")
+    conf = cache.CacheConfig(
+        name="test",
+        ctx=cache.build_ctx("test", "exec"),
+        strategy="fileserver",
+        memory=True,
+    )
+
+    cache.cache_manager_write("failed", 1, conf)
+    data, meta = cache.cache_manager_read("failed", conf)
+
+    assert data is None
+    assert meta is None
+
+
+def test_io_cache_single_flight():
+    calls = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        @cache.frozen_result(wfid="test", cache_dir=tmp)
+        def my_func(x):
+            calls.append(x)
+            time.sleep(0.2)
+            return x
+
+        threads = [threading.Thread(target=my_func, args=(1,)) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert len(calls) == 1
+    assert len(cache._flights) == 0
+
+
+@pytest.mark.asyncio
+async def test_io_cache_async_single_flight():
+    calls = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        @cache.frozen_result(wfid="test", cache_dir=tmp)
+        async def my_func(x):
+            calls.append(x)
+            await asyncio.sleep(0.1)
+            return x * 2
+
+        results = await asyncio.gather(*[my_func(2) for _ in range(4)])
+        r = await my_func(2)
+
+    assert results == [4, 4, 4, 4]
+    assert r == 4
+    assert len(calls) == 1
+    assert len(cache._async_flights) == 0
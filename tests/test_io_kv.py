@@ -1,10 +1,19 @@
+import gzip
+import os
 import tempfile
 from io import BytesIO
 
+import httpx
 import pytest
 
+from labfunctions.io.kv_files import AsyncKVFiles, KVFiles
 from labfunctions.io.kv_local import AsyncKVLocal, KVLocal
-from labfunctions.io.kvspec import AsyncKVSpec, GenericKVSpec
+from labfunctions.io.kvspec import (
+    AsyncKVSpec,
+    GenericKVSpec,
+    KeyWriteError,
+    decompress_legacy,
+)
 
 
 def write_stream():
@@ -63,3 +72,221 @@ async def test_io_kv_local_async_stream_rw():
         value = obj.getvalue().decode()
 
     assert "0" in value
+
+
+def test_io_kv_local_batch():
+    with tempfile.TemporaryDirectory() as f:
+        kv = KVLocal(f, {"root": f, "concurrency": 2})
+        kv.put_many({"a/1": b"1", "a/2": b"2", "b/1": b"3"})
+        keys = kv.list("a/")
+        values = kv.get_many(["a/1", "b/1", "missing"])
+        exists = kv.exists_many(["a/2", "missing"])
+        kv.delete_many(["a/1", "missing"])
+        final = kv.list()
+
+    assert keys == ["a/1", "a/2"]
+    assert values == {"a/1": b"1", "b/1": b"3", "missing": None}
+    assert exists == {"a/2": True, "missing": False}
+    assert final == ["a/2", "b/1"]
+
+
+@pytest.mark.asyncio
+async def test_io_kv_local_async_batch():
+    with tempfile.TemporaryDirectory() as f:
+        kv = AsyncKVLocal(f, {"root": f, "concurrency": 2})
+        await kv.put_many({"a/1": b"1", "a/2": b"2", "b/1": b"3"})
+        keys = await kv.list("a")
+        values = await kv.get_many(["a/1", "missing"])
+        exists = await kv.exists_many(["a/2", "missing"])
+        await kv.delete_many(["a/1", "missing"])
+        final = await kv.list()
+
+    assert keys == ["a/1", "a/2"]
+    assert values == {"a/1": b"1", "missing": None}
+    assert exists == {"a/2": True, "missing": False}
+    assert final == ["a/2", "b/1"]
+
+
+def test_io_kv_files_list():
+    index = {
+        "/bucket/": [
+            {"name": "a", "type": "directory"},
+            {"name": "b", "type": "directory"},
+            {
+                "name": "c.txt",
+                "type": "file",
+                "mtime": "Sat, 01 Jan 2022 10:00:00 GMT",
+                "size": 5,
+            },
+        ],
+        "/bucket/a/": [
+            {"name": "1", "type": "file"},
+            {"name": "x", "type": "directory"},
+        ],
+        "/bucket/a/x/": [{"name": "2", "type": "file"}],
+    }
+
+    def handler(request: httpx.Request):
+        if request.url.path in index:
+            return httpx.Response(200, json=index[request.url.path])
+        return httpx.Response(404)
+
+    kv = KVFiles("bucket", {"url": "http://fileserver"})
+    kv._client = httpx.Client(transport=httpx.MockTransport(handler))
+    all_keys = kv.list()
+    a_keys = kv.list("a/")
+    infos = {info.key: info for info in kv.scan()}
+
+    assert all_keys == ["a/1", "a/x/2", "c.txt"]
+    assert a_keys == ["a/1", "a/x/2"]
+    assert infos["c.txt"].size == 5
+    assert infos["c.txt"].mtime == 1641031200
+    assert infos["a/1"].size is None
+
+
+def test_io_kv_local_get_range():
+    with tempfile.TemporaryDirectory() as f:
+        kv = KVLocal(f)
+        kv.put("test", b"hello world")
+        head = kv.get_range("test", 0, 4)
+        middle = kv.get_range("test", 6)
+        tail = kv.get_range("test", -5)
+        out = kv.get_range("test", 20)
+
+    assert head == b"hello"
+    assert middle == b"world"
+    assert tail == b"world"
+    assert out == b""
+
+
+def _range_handler(request: httpx.Request):
+    data = b"hello world"
+    if request.url.path != "/bucket/test":
+        return httpx.Response(404)
+    if request.headers.get("range") == "bytes=-5":
+        return httpx.Response(206, content=data[-5:])
+    # the range is ignored
+    return httpx.Response(200, content=data)
+
+
+def test_io_kv_files_get_range():
+    kv = KVFiles("bucket", {"url": "http://fileserver"})
+    kv._client = httpx.Client(transport=httpx.MockTransport(_range_handler))
+
+    assert kv.get_range("test", -5) == b"world"
+    assert kv.get_range("test", 0, 4) == b"hello"
+    assert kv.get_range("missing", 0, 4) is None
+
+
+@pytest.mark.asyncio
+async def test_io_kv_files_async_get():
+    kv = AsyncKVFiles("bucket", {"url": "http://fileserver"})
+    kv._client = httpx.AsyncClient(transport=httpx.MockTransport(_range_handler))
+
+    tail = await kv.get_range("test", -5)
+    missing = await kv.get("missing")
+    await kv.close()
+
+    assert tail == b"world"
+    assert missing is None
+
+
+@pytest.mark.asyncio
+async def test_io_kv_local_async_chunks():
+    with tempfile.TemporaryDirectory() as f:
+        kv = AsyncKVLocal(f, {"root": f, "chunk_size": 4})
+        await kv.put("test", b"hello world")
+        chunks = [chunk async for chunk in kv.get_stream("test")]
+        fpath = kv.local_path("test")
+        outside = kv.local_path("../test")
+        missing = kv.local_path("missing")
+
+    assert chunks == [b"hell", b"o wo", b"rld"]
+    assert fpath.endswith("test")
+    assert outside is None
+    assert missing is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(
+    not os.environ.get("STORAGE_EMULATOR_HOST"), reason="a fake gcs server is needed"
+)
+async def test_io_kv_gcs_async_stream():
+    """
+    It runs against a fake gcs server:
+        docker run -p 4443:4443 fsouza/fake-gcs-server -scheme http
+        export STORAGE_EMULATOR_HOST=http://localhost:4443
+    """
+    pytest.importorskip("google.cloud.storage")
+    from labfunctions.io.kv_gcs import AsyncKVGS, create_client
+
+    client = create_client({})
+    if not client.lookup_bucket("labfunctions-test"):
+        client.create_bucket("labfunctions-test")
+
+    kv = AsyncKVGS("labfunctions-test", {"chunk_size": 4, "queue_size": 2})
+
+    async def astream():
+        for x in range(10):
+            yield str(x).encode()
+
+    await kv.put_stream("test", astream())
+    chunks = [chunk async for chunk in kv.get_stream("test")]
+
+    assert b"".join(chunks) == b"0123456789"
+    assert chunks[0] == b"0123"
+
+
+def test_io_kv_local_atomic_shards():
+    with tempfile.TemporaryDirectory() as f:
+        kv = KVLocal("test", {"root": f, "atomic": True, "fsync": True, "shards": 2})
+        kv.put("a/1", b"1")
+        kv.put_stream("a/2", write_stream())
+        rel = os.path.relpath(kv.uri("a/1"), f"{f}/test")
+        keys = kv.list("a/")
+        value = kv.get("a/1")
+        files = [n for _, _, names in os.walk(f) for n in names]
+
+        with pytest.raises(KeyWriteError):
+
+            def broken():
+                yield b"partial"
+                raise IndexError()
+
+            kv.put_stream("a/1", broken())
+        after = kv.get("a/1")
+        tmp_files = [n for _, _, names in os.walk(f) for n in names if "tmp" in n]
+
+    # two levels of shards
+    assert rel.count("/") == 3 and rel.endswith("/a/1")
+    assert keys == ["a/1", "a/2"]
+    assert value == b"1"
+    assert sorted(files) == ["1", "2"]
+    assert after == b"1"
+    assert tmp_files == []
+
+
+@pytest.mark.asyncio
+async def test_io_kv_local_async_atomic():
+    with tempfile.TemporaryDirectory() as f:
+        kv = AsyncKVLocal("test", {"root": f, "atomic": True, "shards": 1})
+        await kv.put("a/1", b"1")
+        await kv.put_stream("a/2", write_stream())
+        keys = await kv.list()
+        value = await kv.get("a/2")
+
+    assert keys == ["a/1", "a/2"]
+    assert value == b"0123456789"
+
+
+def test_io_kv_decompress_legacy():
+    with tempfile.TemporaryDirectory() as f:
+        kv = KVLocal("test", {"root": f})
+        kv.put("legacy.txt.gz", gzip.compress(b"written by smart_open"))
+        kv.put("plain.gz", b"not compressed")
+        kv.put("other.txt", gzip.compress(b"other"))
+        rewritten = decompress_legacy(kv)
+        value = kv.get("legacy.txt.gz")
+
+    assert rewritten == ["legacy.txt.gz"]
+    assert value == b"written by smart_open"
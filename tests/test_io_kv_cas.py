@@ -0,0 +1,150 @@
+import tempfile
+
+import pytest
+
+from labfunctions.io.kv_cas import AsyncKVCas, KVCas, hash_bytes
+from labfunctions.io.kv_local import AsyncKVLocal, KVLocal
+
+
+def write_stream():
+    for x in range(10):
+        yield str(x).encode()
+
+
+def test_io_kv_cas_dedup():
+    digest = hash_bytes(b"hello world")
+    with tempfile.TemporaryDirectory() as f:
+        kv = KVCas(
+            "test", {"store_class": "labfunctions.io.kv_local.KVLocal", "root": f}
+        )
+        kv.put("a/1", b"hello world")
+        kv.put("b/1", b"hello world")
+        blobs = kv.store.list("_cas/blobs/")
+        count = kv.refcount(digest)
+        value = kv.get("b/1")
+        keys = kv.list()
+
+        kv.delete("a/1")
+        count_after = kv.refcount(digest)
+        kv.put("b/1", b"other")
+        deleted = not kv.has_blob(digest)
+
+    assert len(blobs) == 1
+    assert count == 2
+    assert value == b"hello world"
+    assert keys == ["a/1", "b/1"]
+    assert count_after == 1
+    assert deleted
+
+
+def test_io_kv_cas_stream_and_raw_keys():
+    with tempfile.TemporaryDirectory() as f:
+        store = KVLocal("test", {"root": f})
+        store.put("raw", b"written without cas")
+        kv = KVCas.wrap(store)
+        kv.put_stream("stream", write_stream())
+        value = b"".join(kv.get_stream("stream"))
+        raw = kv.get("raw")
+        linked = kv.put_digest("copy", hash_bytes(b"0123456789"))
+        missing = kv.put_digest("copy2", hash_bytes(b"missing"))
+        keys = kv.list()
+        scanned = sorted(info.key for info in kv.scan())
+        sizes = {info.key: info.size for info in kv.scan()}
+
+    assert value == b"0123456789"
+    assert raw == b"written without cas"
+    assert linked
+    assert not missing
+    assert keys == ["copy", "raw", "stream"]
+    assert scanned == keys
+    assert sizes == {"copy": 10, "raw": 19, "stream": 10}
+
+
+@pytest.mark.asyncio
+async def test_io_kv_cas_async():
+    digest = hash_bytes(b"0123456789")
+    with tempfile.TemporaryDirectory() as f:
+        kv = AsyncKVCas.wrap(AsyncKVLocal("test", {"root": f}))
+        await kv.put("a", b"0123456789")
+        await kv.put_stream("b", write_stream())
+        value = await kv.get("b")
+        with open(kv.local_path("b"), "rb") as fd:
+            local = fd.read()
+        count = await kv.refcount(digest)
+        await kv.delete("a")
+        await kv.delete("b")
+        deleted = not await kv.has_blob(digest)
+
+    assert value == b"0123456789"
+    assert local == b"0123456789"
+    assert count == 2
+    assert deleted
+
+
+def test_io_kv_cas_put_failed(mocker):
+    with tempfile.TemporaryDirectory() as f:
+        store = KVLocal("test", {"root": f})
+        kv = KVCas.wrap(store)
+        mocker.patch.object(store, "put", return_value=False)
+        written = kv.put("a", b"hello world")
+        exists = kv.exists("a")
+
+    assert not written
+    assert not exists
+
+
+def test_io_kv_cas_concurrent_unlink(mocker):
+    digest = hash_bytes(b"hello world")
+    with tempfile.TemporaryDirectory() as f:
+        store = KVLocal("test", {"root": f})
+        kv = KVCas.wrap(store)
+        kv.put("a", b"hello world")
+        put = store.put
+
+        def _put(key, bdata):
+            if key == kv._layout.ref("b"):
+                # the last key of the blob is deleted meanwhile
+                kv.delete("a")
+            return put(key, bdata)
+
+        mocker.patch.object(store, "put", side_effect=_put)
+        kv.put("b", b"hello world")
+        value = kv.get("b")
+        count = kv.refcount(digest)
+
+    assert value == b"hello world"
+    assert count == 1
+
+
+def test_io_kv_cas_delete_raw_value():
+    with tempfile.TemporaryDirectory() as f:
+        store = KVLocal("test", {"root": f})
+        store.put("a/1", b"legacy")
+        kv = KVCas.wrap(store)
+        kv.put("a/1", b"new")
+        kv.delete("a/1")
+        exists = kv.exists("a/1")
+        keys = kv.list()
+
+    assert not exists
+    assert keys == []
+
+
+def test_io_kv_cas_send_raised(mocker):
+    digest = hash_bytes(b"hello world")
+    with tempfile.TemporaryDirectory() as f:
+        store = KVLocal("test", {"root": f})
+        kv = KVCas.wrap(store)
+        put = store.put
+
+        def _put(key, bdata):
+            if key == kv._layout.blob(digest):
+                raise OSError("disk full")
+            return put(key, bdata)
+
+        mocker.patch.object(store, "put", side_effect=_put)
+        with pytest.raises(OSError):
+            kv.put("a", b"hello world")
+        count = kv.refcount(digest)
+
+    assert count == 0
@@ -0,0 +1,96 @@
+import tempfile
+from pathlib import Path
+
+from pytest_mock import MockerFixture
+
+from labfunctions.io import kv_disk_cache
+from labfunctions.io.kv_disk_cache import KVDiskCache
+from labfunctions.io.kv_local import KVLocal
+
+
+def test_io_kv_disk_cache_read_through(mocker: MockerFixture):
+    with tempfile.TemporaryDirectory() as f:
+        store = KVLocal("test", {"root": f"{f}/store"})
+        store.put("bundle.zip", b"0123456789")
+        kv = KVDiskCache.wrap(store, f"{f}/cache")
+        spy = mocker.spy(store, "get_stream")
+
+        first = b"".join(kv.get_stream("bundle.zip"))
+        second = b"".join(kv.get_stream("bundle.zip"))
+        tail = kv.get_range("bundle.zip", -4)
+        calls = spy.call_count
+
+        store.put("bundle.zip", b"changed")
+        changed = b"".join(kv.get_stream("bundle.zip"))
+
+    assert first == second == b"0123456789"
+    assert tail == b"6789"
+    assert calls == 1
+    assert changed == b"changed"
+    assert spy.call_count == 2
+
+
+def test_io_kv_disk_cache_evict():
+    with tempfile.TemporaryDirectory() as f:
+        store = KVLocal("test", {"root": f"{f}/store"})
+        kv = KVDiskCache.wrap(store, f"{f}/cache", max_bytes=15)
+        for x in range(3):
+            store.put(f"key{x}", b"0123456789")
+            kv.get(f"key{x}")
+        cached = list(Path(f"{f}/cache").glob("*/*.data"))
+        path = kv.local_path("key0")
+        is_cached = path.startswith(f"{f}/cache")
+
+    assert len(cached) == 1
+    assert is_cached
+
+
+def test_io_kv_disk_cache_evict_counted(mocker: MockerFixture):
+    spy = mocker.spy(kv_disk_cache, "evict_lru")
+    with tempfile.TemporaryDirectory() as f:
+        store = KVLocal("test", {"root": f"{f}/store"})
+        kv = KVDiskCache.wrap(store, f"{f}/cache", max_bytes=25)
+        for x in range(3):
+            store.put(f"key{x}", b"0123456789")
+            kv.get(f"key{x}")
+        cached = list(Path(f"{f}/cache").glob("*/*.data"))
+
+    # the first entry walks the folder, the third goes over max_bytes
+    assert spy.call_count == 2
+    assert len(cached) == 2
+
+
+def test_io_kv_disk_cache_create():
+    with tempfile.TemporaryDirectory() as f:
+        kv = KVDiskCache(
+            "test",
+            {
+                "store_class": "labfunctions.io.kv_local.KVLocal",
+                "root": f"{f}/store",
+                "cache_dir": f"{f}/cache",
+            },
+        )
+        kv.put("a", b"1")
+        value = kv.get("a")
+
+    assert isinstance(kv.store, KVLocal)
+    assert value == b"1"
+
+
+def test_io_kv_disk_cache_too_big(mocker: MockerFixture):
+    with tempfile.TemporaryDirectory() as f:
+        store = KVLocal("test", {"root": f"{f}/store"})
+        store.put("bundle.zip", b"0123456789")
+        kv = KVDiskCache.wrap(store, f"{f}/cache", max_bytes=5)
+        spy = mocker.spy(store, "get_stream")
+
+        path = kv.local_path("bundle.zip")
+        store_path = store.local_path("bundle.zip")
+        calls = spy.call_count
+        value = b"".join(kv.get_stream("bundle.zip"))
+        cached = list(Path(f"{f}/cache").glob("*/*"))
+
+    assert path == store_path
+    assert calls == 0
+    assert value == b"0123456789"
+    assert cached == []
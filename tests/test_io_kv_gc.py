@@ -0,0 +1,85 @@
+import os
+import tempfile
+import time
+
+from labfunctions.io.kv_gc import KVCollector, key_age, match_rule, next_projects
+from labfunctions.io.kv_local import KVLocal
+from labfunctions.io.kvspec import KeyInfo
+from labfunctions.types.storage import RetentionRule
+
+DAY = 86400
+
+
+def _put(kv: KVLocal, key: str, age_days: float, now: float):
+    kv.put(key, b"0123456789")
+    ts = now - age_days * DAY
+    os.utime(kv.uri(key), (ts, ts))
+
+
+def test_io_kv_gc_match_rule():
+    rules = [
+        RetentionRule(prefix="outputs", keep_days=30),
+        RetentionRule(prefix="outputs/errors", keep_days=7),
+        RetentionRule(projectid="prj1", prefix="outputs", keep_days=365),
+    ]
+
+    assert match_rule(rules, "prj2", "outputs/ok/20220101/a.ipynb").keep_days == 30
+    assert match_rule(rules, "prj1", "outputs/ok/20220101/a.ipynb").keep_days == 365
+    assert match_rule(rules, "prj1", "outputs/errors/x").keep_days == 7
+    assert match_rule(rules, "prj1", "outputsx/a") is None
+
+
+def test_io_kv_gc_key_age():
+    now = time.time()
+    from_path = key_age(KeyInfo("prj/outputs/ok/20220101/a.ipynb"), now)
+    from_mtime = key_age(KeyInfo("prj/outputs/ok/20220101/a.ipynb", 1, now - DAY), now)
+
+    assert from_path > 30
+    assert round(from_mtime) == 1
+    assert key_age(KeyInfo("prj/uploads/main.zip"), now) is None
+
+
+def test_io_kv_gc_next_projects():
+    projects = ["c", "a", "b", "d"]
+
+    assert next_projects(projects, None, None) == ["a", "b", "c", "d"]
+    assert next_projects(projects, None, 3) == ["a", "b", "c"]
+    assert next_projects(projects, "c", 3) == ["d"]
+    assert next_projects(projects, "d", 3) == ["a", "b", "c"]
+
+
+def test_io_kv_gc_collect():
+    now = time.time()
+    rules = [
+        RetentionRule(prefix="uploads", keep_last=2),
+        RetentionRule(prefix="outputs", keep_days=30),
+    ]
+    with tempfile.TemporaryDirectory() as f:
+        kv = KVLocal("test", {"root": f})
+        for x in range(4):
+            _put(kv, f"prj/uploads/main.v{x}.zip", 10 - x, now)
+        _put(kv, "prj/uploads/other.v0.zip", 20, now)
+        _put(kv, "prj/outputs/ok/day/old.ipynb", 40, now)
+        _put(kv, "prj/outputs/ok/day/new.ipynb", 1, now)
+        _put(kv, "prj/src/main.py", 100, now)
+        _put(kv, "prj2/outputs/ok/day/old.ipynb", 40, now)
+
+        dry = KVCollector(kv, rules, now=now, dry_run=True).collect("prj")
+        keys_dry = kv.list("prj/")
+        usage = KVCollector(kv, rules, now=now, batch_size=2).collect("prj")
+        keys = kv.list()
+
+    assert dry.deleted_objects == 3
+    assert len(keys_dry) == 8
+    assert usage.objects == 5
+    assert usage.bytes == 50
+    assert usage.deleted_objects == 3
+    assert usage.deleted_bytes == 30
+    assert keys == [
+        "prj/outputs/ok/day/new.ipynb",
+        "prj/src/main.py",
+        "prj/uploads/main.v2.zip",
+        "prj/uploads/main.v3.zip",
+        "prj/uploads/other.v0.zip",
+        "prj2/outputs/ok/day/old.ipynb",
+    ]
@@ -0,0 +1,108 @@
+import os
+import re
+import tempfile
+
+import httpx
+import pytest
+
+from labfunctions.io.kv_cas import KVCas
+from labfunctions.io.kv_files import KVFiles
+from labfunctions.io.kv_local import KVLocal
+from labfunctions.io.kv_multipart import download_parts, split_parts
+from labfunctions.io.kvspec import KeyReadError
+
+DATA = b"0123456789abcdefghij"
+
+
+def test_io_kv_multipart_split_parts():
+    assert split_parts(10, 4) == [(0, 3), (4, 7), (8, 9)]
+    assert split_parts(8, 4) == [(0, 3), (4, 7)]
+    assert split_parts(0, 4) == []
+
+
+class FileServer:
+    """A fileserver answering HEAD and ranged GETs, the ranges in
+    fail are answered with errors"""
+
+    def __init__(self):
+        self.ranges = []
+        self.fail = set()
+
+    def __call__(self, request: httpx.Request):
+        if request.url.path != "/bucket/big":
+            return httpx.Response(404)
+        headers = {"etag": '"v1"', "content-length": str(len(DATA))}
+        if request.method == "HEAD":
+            return httpx.Response(200, headers=headers)
+        m = re.match(r"bytes=(\d+)-(\d+)", request.headers.get("range", ""))
+        if not m:
+            return httpx.Response(200, content=DATA)
+        start, end = int(m.group(1)), int(m.group(2))
+        self.ranges.append(start)
+        if start in self.fail:
+            return httpx.Response(500)
+        return httpx.Response(206, content=DATA[start : end + 1])
+
+
+def test_io_kv_multipart_files_resume():
+    server = FileServer()
+    opts = {
+        "url": "http://fileserver",
+        "part_size": 4,
+        "multipart_threshold": 8,
+        "part_retries": 1,
+        "concurrency": 2,
+    }
+    kv = KVFiles("bucket", opts)
+    kv._client = httpx.Client(transport=httpx.MockTransport(server))
+    with tempfile.TemporaryDirectory() as f:
+        dst = f"{f}/big"
+        server.fail = {8}
+        with pytest.raises(KeyReadError):
+            kv.get_file("big", dst)
+        first = sorted(server.ranges)
+
+        server.ranges, server.fail = [], set()
+        kv.get_file("big", dst)
+        with open(dst, "rb") as fd:
+            data = fd.read()
+        leftovers = sorted(os.listdir(f))
+
+    # parts not started when the error was raised are cancelled
+    missing = {0, 4, 8, 12, 16} - (set(first) - {8})
+    assert 8 in first
+    assert sorted(server.ranges) == sorted(missing)
+    assert data == DATA
+    assert leftovers == ["big"]
+
+
+def test_io_kv_multipart_local():
+    with tempfile.TemporaryDirectory() as f:
+        kv = KVLocal("test", {"root": f"{f}/store"})
+        kv.put("big", DATA)
+        fetched = download_parts(kv, "big", f"{f}/big", kv.stat("big"), part_size=3)
+        with open(f"{f}/big", "rb") as fd:
+            data = fd.read()
+
+    assert fetched == 7
+    assert data == DATA
+
+
+def test_io_kv_multipart_cas_put_file():
+    with tempfile.TemporaryDirectory() as f:
+        src = f"{f}/src"
+        with open(src, "wb") as fd:
+            fd.write(DATA)
+        kv = KVCas.wrap(KVLocal("test", {"root": f"{f}/store"}))
+        kv.put_file("a", src)
+        kv.put_file("b", src)
+        kv.get_file("b", f"{f}/dst")
+        with open(f"{f}/dst", "rb") as fd:
+            data = fd.read()
+        blobs = kv.store.list("_cas/blobs/")
+        info = kv.stat("a")
+
+    assert data == DATA
+    assert len(blobs) == 1
+    assert info.key == "a"
+    assert info.size == len(DATA)
@@ -1,4 +1,4 @@
-from labfunctions.io import MemoryStore
+from labfunctions.io import LRUMemoryCache, MemoryStore, get_memory_cache
 
 
 def test_io_memory_store():
@@ -9,3 +9,31 @@ def test_io_memory_store():
 
     assert id(ms) == id(ms2)
     assert ms["test"] == ms2["test"]
+
+
+def test_io_memory_lru_cache():
+    lru = LRUMemoryCache(max_bytes=10)
+    lru.put("a", 1, size=4)
+    lru.put("b", 2, size=4)
+    lru.get("a")
+    lru.put("c", 3, size=4)
+    too_big = lru.put("d", 4, size=11)
+
+    assert lru.get("a") == (1, None)
+    assert lru.get("b") is None
+    assert lru.total_bytes == 8
+    assert not too_big
+
+
+def test_io_memory_get_memory_cache():
+    lru = get_memory_cache("test")
+    lru2 = get_memory_cache("test")
+    assert id(lru) == id(lru2)
+
+
+def test_io_memory_get_memory_cache_max_bytes():
+    small = get_memory_cache("test", max_bytes=10)
+    big = get_memory_cache("test", max_bytes=100)
+
+    assert small.max_bytes == 10
+    assert big.max_bytes == 100
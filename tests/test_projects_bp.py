@@ -4,6 +4,10 @@ import pytest
 from pytest_mock import MockerFixture
 from sanic import Sanic, response
 
+from labfunctions.io.kv_local import AsyncKVLocal
+from labfunctions.runtimes.context import build_upload_uri, bundle_digest_uri
+from labfunctions.web.projects_bp import _save_bundle
+
 from .factories import ProjectDataFactory, ProjectReqFactory
 
 # @pytest.mark.asyncio
@@ -87,3 +91,40 @@ async def test_project_bp_delete(
     req, res = await sanic_app.asgi_client.delete("/v1/projects/test", headers=headers)
     assert res.status_code == 200
     assert res.json["msg"] == "deleted"
+
+
+@pytest.mark.asyncio
+async def test_project_bp_bundle_link(
+    async_session, sanic_app, access_token, tempdir, mocker: MockerFixture
+):
+    kv = AsyncKVLocal("test", {"root": tempdir})
+    mocker.patch("labfunctions.web.projects_bp.get_kvstore", return_value=kv)
+    headers = {"Authorization": f"Bearer {access_token}"}
+    url = "/v1/projects/test/_bundles/abc?runtime=default&version=current&format=zip"
+
+    _, missing = await sanic_app.asgi_client.post(url, headers=headers)
+    await kv.put(bundle_digest_uri("test", "abc", "zip"), b"bundle")
+    _, linked = await sanic_app.asgi_client.post(url, headers=headers)
+    uploaded = await kv.get(build_upload_uri("test", "default", "current", "zip"))
+    mocker.patch.object(kv, "put_stream", return_value=False)
+    _, failed = await sanic_app.asgi_client.post(url, headers=headers)
+
+    assert missing.status_code == 404
+    assert linked.status_code == 201
+    assert uploaded == b"bundle"
+    assert failed.status_code == 500
+
+
+@pytest.mark.asyncio
+async def test_project_bp_save_bundle(tempdir):
+    kv = AsyncKVLocal("test", {"root": tempdir})
+    upload = build_upload_uri("test", "default", "current", "zip")
+    digest_uri = bundle_digest_uri("test", "abc", "zip")
+
+    await kv.put(upload, b"first")
+    await _save_bundle(kv, upload, digest_uri)
+    # the version is uploaded again with other content
+    await kv.put(upload, b"second")
+    await _save_bundle(kv, upload, digest_uri)
+
+    assert await kv.get(digest_uri) == b"first"
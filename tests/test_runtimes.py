@@ -1,10 +1,36 @@
+import asyncio
+import json
+import os
+import tarfile
+from io import BufferedReader
 from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
 
 import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
 
+from labfunctions import secrets
+from labfunctions.control.images import (
+    ImageCollector,
+    ImagePuller,
+    images_used,
+    mark_used,
+    runtimes_channels,
+)
 from labfunctions.defaults import API_VERSION
 from labfunctions.managers import runtimes_mg
-from labfunctions.runtimes import generate_dockerfile
+from labfunctions.runtimes import bundle_manifest, bundle_project, generate_dockerfile
+from labfunctions.runtimes.archive import (
+    DeflatedZipFile,
+    IterStream,
+    deflate_file,
+    extract_tar,
+    tar_files,
+    zip_files,
+)
+from labfunctions.runtimes.bundler import current_paths
+from labfunctions.runtimes.context import runtime_image
+from labfunctions.runtimes.ignore import IgnoreRules
 from labfunctions.types.runtimes import RuntimeData, RuntimeReq
 
 from .factories import (
@@ -46,6 +72,29 @@ async def test_runtimes_mg_create(async_session, mocker):
     assert not repeated
 
 
+@pytest.mark.asyncio
+async def test_runtimes_mg_create_rebuilt(async_session):
+    spec = RuntimeSpecFactory()
+    rq = RuntimeReq(
+        runtime_name=spec.name,
+        docker_name=f"nbworkflows/{spec.name}",
+        spec=spec,
+        project_id="test",
+        version="current",
+        build_key="first",
+    )
+    await runtimes_mg.create(async_session, rq)
+    # current built again from a bundle with another digest
+    rebuilt = rq.copy(update={"build_key": "second"})
+    inserted = await runtimes_mg.create(async_session, rebuilt)
+    stale = await runtimes_mg.get_by_build_key(async_session, "test", "first")
+    rd = await runtimes_mg.get_by_build_key(async_session, "test", "second")
+
+    assert not inserted
+    assert stale is None
+    assert rd.runtimeid == f"test/{spec.name}/current"
+
+
 @pytest.mark.asyncio
 async def test_runtimes_mg_delete(async_session):
     rows = await runtimes_mg.get_list(async_session, "test")
@@ -58,6 +107,7 @@ async def test_runtimes_mg_delete(async_session):
 async def test_runtimes_bp_create(async_session, sanic_app, access_token, mocker):
     rq = RuntimeReqFactory()
     mocker.patch("labfunctions.web.runtimes_bp.runtimes_mg.create", return_value=True)
+    published = mocker.patch("labfunctions.web.runtimes_bp.publish_runtime")
     _, res = await sanic_app.asgi_client.post(
         f"{version}/runtimes/test",
         headers={"Authorization": f"Bearer {access_token}"},
@@ -72,6 +122,26 @@ async def test_runtimes_bp_create(async_session, sanic_app, access_token, mocker
 
     assert res.status_code == 201
     assert res2.status_code == 200
+    assert published.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_runtimes_bp_create_not_published(
+    async_session, sanic_app, access_token, mocker
+):
+    rq = RuntimeReqFactory()
+    mocker.patch("labfunctions.web.runtimes_bp.runtimes_mg.create", return_value=True)
+    mocker.patch(
+        "labfunctions.web.runtimes_bp.publish_runtime",
+        side_effect=RedisConnectionError("connection refused"),
+    )
+    _, res = await sanic_app.asgi_client.post(
+        f"{version}/runtimes/test",
+        headers={"Authorization": f"Bearer {access_token}"},
+        json=rq.dict(),
+    )
+
+    assert res.status_code == 201
 
 
 @pytest.mark.asyncio
@@ -107,3 +177,273 @@ def test_runtimes_dockerfile(tempdir):
     generate_dockerfile(Path(tempdir), spec)
 
     assert Path(f"{tempdir}/Dockerfile.{spec.name}").is_file()
+
+
+def test_runtimes_bundle_manifest(tempdir, monkeypatch):
+    monkeypatch.chdir(tempdir)
+    spec = RuntimeSpecFactory()
+    Path("main.py").write_text("print(1)")
+    Path(".venv").mkdir()
+    Path(".venv/lib.py").write_text("print(2)")
+
+    m1 = bundle_manifest(spec, current=True)
+    m2 = bundle_manifest(spec, current=True)
+    Path("main.py").write_text("print(3)")
+    m3 = bundle_manifest(spec, current=True)
+    m4 = bundle_manifest(RuntimeSpecFactory(), current=True)
+
+    assert list(m1.files) == ["main.py"]
+    assert m1.version == "current"
+    assert m1.digest == m2.digest
+    assert m1.digest != m3.digest
+    assert m3.digest != m4.digest
+
+
+def test_runtimes_bundle_project_reuse(tempdir, monkeypatch):
+    monkeypatch.chdir(tempdir)
+    spec = RuntimeSpecFactory()
+    Path(spec.container.requirements).write_text("labfunctions")
+    Path("local.nbvars").write_text("SECRET=1")
+    pv = secrets.generate_private_key()
+
+    manifest = bundle_manifest(spec, pv, current=True)
+    z1 = bundle_project(tempdir, spec, pv, current=True, manifest=manifest)
+    mtime = Path(z1.filepath).stat().st_mtime_ns
+    z2 = bundle_project(
+        tempdir,
+        spec,
+        pv,
+        current=True,
+        manifest=bundle_manifest(spec, pv, current=True),
+    )
+    Path("local.nbvars").write_text("SECRET=2")
+    changed = bundle_manifest(spec, pv, current=True)
+
+    assert z1.digest == manifest.digest
+    assert z2.digest == manifest.digest
+    assert Path(z2.filepath).stat().st_mtime_ns == mtime
+    assert changed.digest != manifest.digest
+
+
+def test_runtimes_ignore_rules():
+    rules = IgnoreRules(
+        ["# comment", "*.pyc", "!keep.pyc", "/data", "outputs/", "docs/**/*.png"]
+    )
+
+    assert rules.match("a/b/mod.pyc")
+    assert not rules.match("a/keep.pyc")
+    assert rules.match("data", is_dir=True)
+    assert not rules.match("src/data", is_dir=True)
+    assert rules.match("src/outputs", is_dir=True)
+    assert not rules.match("src/outputs")
+    assert rules.match("docs/img/a/b.png")
+    assert rules.match("docs/b.png")
+    assert not rules.match("src/docs/b.png")
+
+
+def test_runtimes_zip_current(tempdir, monkeypatch):
+    monkeypatch.chdir(tempdir)
+    Path(".labignore").write_text("*.log\noutputs/\n")
+    for p in ["src/pkg", ".venv/lib", "outputs", ".nb_tmp"]:
+        Path(p).mkdir(parents=True)
+    Path("src/pkg/mod.py").write_text("print(1)\n" * 1000)
+    Path("src/pkg/big.bin").write_bytes(b"0" * 2048)
+    Path("src/run.log").write_text("log")
+    Path(".venv/lib/x.py").write_text("x")
+    Path("outputs/a.ipynb").write_text("{}")
+    Path(".gitignore").write_text("*.pyc")
+
+    paths = list(current_paths())
+    zip_files(".nb_tmp/a.zip", paths, prefix="src/", workers=2, max_inmemory=1024)
+    with ZipFile(".nb_tmp/a.zip") as z:
+        names = z.namelist()
+        broken = z.testzip()
+        mod = z.read("src/src/pkg/mod.py")
+
+    assert paths == [".gitignore", ".labignore", "src/pkg/big.bin", "src/pkg/mod.py"]
+    assert names == [f"src/{p}" for p in paths]
+    assert broken is None
+    assert mod == b"print(1)\n" * 1000
+
+
+def test_runtimes_deflated_zipfile(tempdir, monkeypatch):
+    monkeypatch.chdir(tempdir)
+    Path("a.py").write_text("print(1)\n" * 100)
+    Path("empty.py").write_text("")
+
+    with DeflatedZipFile("a.zip", "w", ZIP_DEFLATED) as z:
+        z.write_deflated(ZipInfo.from_file("a.py", "a.py"), deflate_file("a.py"))
+        z.writestr("b.py", "print(2)")
+        z.write_deflated(
+            ZipInfo.from_file("empty.py", "empty.py"), deflate_file("empty.py")
+        )
+        with z.open("c.py", "w") as f:
+            f.write(b"print(3)")
+            with pytest.raises(ValueError):
+                z.write_deflated(ZipInfo("d.py"), deflate_file("a.py"))
+    with ZipFile("a.zip") as z:
+        names = z.namelist()
+        broken = z.testzip()
+        data = [z.read(n) for n in names]
+
+    assert names == ["a.py", "b.py", "empty.py", "c.py"]
+    assert broken is None
+    assert data == [b"print(1)\n" * 100, b"print(2)", b"", b"print(3)"]
+
+
+@pytest.mark.parametrize("fmt", ["tar.gz", "tar.zst"])
+def test_runtimes_tar_stream(tempdir, monkeypatch, fmt):
+    if fmt == "tar.zst":
+        pytest.importorskip("zstandard")
+    monkeypatch.chdir(tempdir)
+    Path("src/pkg").mkdir(parents=True)
+    Path("src/pkg/mod.py").write_text("print(1)")
+    Path("main.py").write_text("print(2)")
+
+    total = tar_files(f"a.{fmt}", ["main.py", "src/pkg/mod.py"], fmt=fmt, prefix="x/")
+    data = Path(f"a.{fmt}").read_bytes()
+    chunks = [data[i : i + 7] for i in range(0, len(data), 7)]
+    extracted = extract_tar(BufferedReader(IterStream(chunks)), "out", fmt)
+
+    assert total == 2
+    assert extracted == 2
+    assert Path("out/x/src/pkg/mod.py").read_text() == "print(1)"
+
+
+def test_runtimes_tar_outside(tempdir, monkeypatch):
+    monkeypatch.chdir(tempdir)
+    Path("evil.py").write_text("print(1)")
+    with tarfile.open("a.tar.gz", "w:gz") as tar:
+        tar.add("evil.py", "../evil.py")
+
+    with open("a.tar.gz", "rb") as f, pytest.raises(tarfile.ExtractError):
+        extract_tar(f, "out", "tar.gz")
+
+
+@pytest.mark.parametrize("kind", [tarfile.SYMTYPE, tarfile.LNKTYPE])
+def test_runtimes_tar_link_outside(tempdir, monkeypatch, kind):
+    monkeypatch.chdir(tempdir)
+    link = tarfile.TarInfo("src/passwd")
+    link.type = kind
+    link.linkname = "../../etc/passwd" if kind == tarfile.SYMTYPE else "../etc/passwd"
+    with tarfile.open("a.tar.gz", "w:gz") as tar:
+        tar.addfile(link)
+
+    with open("a.tar.gz", "rb") as f, pytest.raises(tarfile.ExtractError):
+        extract_tar(f, "out", "tar.gz")
+    assert not os.path.lexists("out/src/passwd")
+
+
+def test_runtimes_iter_stream():
+    stream = BufferedReader(IterStream([b"0123", b"", b"456789"]), buffer_size=3)
+
+    assert stream.read(5) == b"01234"
+    assert stream.read() == b"56789"
+
+
+def test_runtimes_image_prepull(tempdir, mocker):
+    rd = RuntimeDataFactory(registry="reg.io/lab", docker_name="nbworkflows/test")
+    cmd = mocker.MagicMock()
+    cmd.ensure_image.side_effect = [1.5, None]
+    puller = ImagePuller(
+        "redis://localhost:6379", "gpu", state_dir=tempdir, docker_cmd=cmd
+    )
+    first = puller.pull(runtime_image(rd))
+    second = puller.pull(runtime_image(rd))
+
+    assert runtime_image(rd) == f"reg.io/lab/nbworkflows/test:{rd.version}"
+    assert runtimes_channels(None) == ["lf.runtimes._all"]
+    assert puller.channels == ["lf.runtimes.gpu", "lf.runtimes._all"]
+    assert first == 1.5
+    assert second is None
+    assert puller.pulls == {runtime_image(rd): 1.5}
+
+
+def test_runtimes_image_prepull_history(tempdir, mocker):
+    cmd = mocker.MagicMock()
+    cmd.ensure_image.return_value = 1.0
+    mocker.patch("labfunctions.control.images.defaults.AGENT_PREPULL_HISTORY", 2)
+    puller = ImagePuller(
+        "redis://localhost:6379", "gpu", state_dir=tempdir, docker_cmd=cmd
+    )
+    for image in ["a:1", "b:1", "a:1", "c:1"]:
+        puller.pull(image)
+
+    assert list(puller.pulls) == ["a:1", "c:1"]
+
+
+@pytest.mark.asyncio
+async def test_runtimes_image_prepull_reconnect(tempdir, mocker):
+    rd = RuntimeDataFactory()
+    pubsub = mocker.MagicMock()
+    pubsub.subscribe = mocker.AsyncMock(
+        side_effect=[RedisConnectionError("down"), None]
+    )
+    pubsub.close = mocker.AsyncMock()
+
+    async def _listen():
+        yield {"type": "message", "channel": "lf.runtimes.gpu", "data": rd.json()}
+        await asyncio.Event().wait()
+
+    pubsub.listen = _listen
+    redis = mocker.MagicMock(close=mocker.AsyncMock())
+    redis.pubsub.return_value = pubsub
+    mocker.patch("labfunctions.control.images.create_pool", return_value=redis)
+    sleep = mocker.patch("labfunctions.control.images.asyncio.sleep")
+    puller = ImagePuller("redis://localhost:6379", "gpu", state_dir=tempdir)
+    received = asyncio.Event()
+    mocker.patch.object(puller, "submit", side_effect=lambda rd: received.set())
+
+    task = asyncio.create_task(puller.listen())
+    await asyncio.wait_for(received.wait(), 5)
+    task.cancel()
+
+    assert pubsub.subscribe.call_count == 2
+    assert sleep.call_args_list[0][0][0] == 1
+
+
+def test_runtimes_image_collect(tempdir, mocker):
+    order = ["old:1", "queued:1", "mid:1", "new:1"]
+    for image in order:
+        mark_used(image, tempdir)
+    for fp in Path(tempdir).iterdir():
+        ix = order.index(fp.read_text())
+        os.utime(fp, (ix, ix))
+    # the last one was used right now
+    mark_used("new:1", tempdir)
+    # checked before each image, mid:1 brings it below the low watermark
+    usage = iter([0.9, 0.9, 0.9, 0.9, 0.6, 0.6])
+    mocker.patch(
+        "labfunctions.control.images.disk_usage", side_effect=lambda _: next(usage)
+    )
+    cmd = mocker.MagicMock()
+    cmd.remove_image.return_value = True
+    pool = mocker.MagicMock()
+    gc = ImageCollector(
+        "redis://",
+        ["gpu.default"],
+        state_dir=tempdir,
+        docker_cmd=cmd,
+        warm_pool=pool,
+    )
+
+    removed = gc.collect(keep={"queued:1"})
+    left = [image for _, image in images_used(tempdir)]
+
+    assert removed == ["old:1", "mid:1"]
+    assert left == ["queued:1", "new:1"]
+    assert [c.args[0] for c in pool.drain.call_args_list] == ["old:1", "mid:1"]
+
+
+@pytest.mark.asyncio
+async def test_runtimes_image_queued(mocker):
+    job = {"params": {"data": {"runtime": "reg/nbworkflows/test:v1"}}}
+    redis = mocker.MagicMock()
+    redis.lrange = mocker.AsyncMock(return_value=[b"exec1", b"exec2"])
+    redis.mget = mocker.AsyncMock(return_value=[json.dumps(job), None])
+    gc = ImageCollector("redis://", ["gpu.default"])
+
+    images = await gc.queued_images(redis)
+
+    assert images == {"reg/nbworkflows/test:v1"}
+    redis.mget.assert_called_once_with(["sq:job::exec1", "sq:job::exec2"])
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from pathlib import Path
 from tempfile import TemporaryDirectory
@@ -113,3 +114,68 @@ def test_utils_get_version():
 def test_utils_pkg_route():
     here = utils.pkg_route()
     assert here.endswith("labfunctions")
+
+
+@pytest.mark.asyncio
+async def test_utils_iterate_in_thread():
+    produced = []
+
+    def gen(n):
+        for x in range(n):
+            produced.append(x)
+            yield x
+
+    items = []
+    async for x in utils.iterate_in_thread(gen, 10, maxsize=2):
+        items.append(x)
+        if x == 0:
+            await asyncio.sleep(0.1)
+            # the producer waits for the consumer
+            assert len(produced) <= 4
+
+    assert items == list(range(10))
+
+
+@pytest.mark.asyncio
+async def test_utils_iterate_in_thread_break():
+    produced = []
+
+    def gen():
+        for x in range(100):
+            produced.append(x)
+            yield x
+
+    stream = utils.iterate_in_thread(gen, maxsize=2)
+    async for x in stream:
+        break
+    await stream.aclose()
+    await asyncio.sleep(0.1)
+
+    assert len(produced) < 10
+
+
+@pytest.mark.asyncio
+async def test_utils_iterate_in_thread_error():
+    def gen():
+        yield 1
+        raise IndexError("test")
+
+    items = []
+    with pytest.raises(IndexError):
+        async for x in utils.iterate_in_thread(gen):
+            items.append(x)
+
+    assert items == [1]
+
+
+@pytest.mark.asyncio
+async def test_utils_iterate_from_thread():
+    async def agen():
+        for x in range(3):
+            await asyncio.sleep(0)
+            yield x
+
+    loop = asyncio.get_running_loop()
+    items = await utils.run_async(lambda: list(utils.iterate_from_thread(agen(), loop)))
+
+    assert items == [0, 1, 2]